@@ -0,0 +1,46 @@
+import json
+import os
+
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                            '..', 'vars', 'instance_types.json')
+
+
+class FilterModule(object):
+    '''
+    Filters to size components from the EC2 instance type catalog in
+    `vars/instance_types.json`, which the CloudFormation templates are
+    rendered from too.
+    '''
+
+    def filters(self):
+        return {
+            'instance_spec': self.instance_spec,
+            'instance_types': self.instance_types
+        }
+
+    def instance_spec(self, instance_type, key=None):
+        """Looks up the specification of an EC2 instance type
+
+            ansible_ec2_instance_type | instance_spec
+            ansible_ec2_instance_type | instance_spec('vcpus')
+
+        Arguments
+        :param instance_type: Name of the instance type (e.g. r3.2xlarge)
+        :param key: Field of the specification to return, all of them if
+                    not given
+        """
+        with open(CATALOG_PATH, 'r') as f:
+            spec = json.load(f)[instance_type]
+        return spec if key is None else spec[key]
+
+    def instance_types(self, key):
+        """Lists the instance types in the catalog with a feature
+
+            'hvm' | instance_types
+
+        Arguments
+        :param key: Field of the specification which must be set
+        """
+        with open(CATALOG_PATH, 'r') as f:
+            catalog = json.load(f)
+        return sorted(name for name, spec in catalog.items() if spec[key])
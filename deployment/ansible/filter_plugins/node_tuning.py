@@ -0,0 +1,169 @@
+import math
+
+MIB = 1024
+
+# Memory kept back on every node for the OS and page cache, and for the
+# HDFS datanode
+OS_RESERVED_MIB = 1024
+OS_RESERVED_FRACTION = 0.05
+DATANODE_HEAP_MIB = 1024
+
+# Larger heaps make for long garbage collection pauses, and larger in-memory
+# maps for long minor compactions; memory beyond them is left to Spark
+MAX_HEAP_MIB = 16 * MIB
+MAX_NATIVE_MAP_MIB = 16 * MIB
+
+# Heap of the external shuffle service on each follower, and the least
+# heap and memory overhead outside it Spark gives an executor
+SHUFFLE_SERVICE_HEAP_MIB = 512
+MIN_EXECUTOR_HEAP_MIB = 512
+MIN_EXECUTOR_OVERHEAD_MIB = 384
+
+
+def _round(mib, granularity=64):
+    return int(mib) // granularity * granularity
+
+
+def _clamp(value, low, high):
+    return max(low, min(value, high))
+
+
+def node_memory(spec):
+    """Memory of a node left for Accumulo and Spark, in MiB
+
+    Arguments
+    :param spec: Instance type specification from instance_spec
+    """
+    reserved = max(OS_RESERVED_MIB, spec['memory_mib'] * OS_RESERVED_FRACTION)
+    return spec['memory_mib'] - reserved - DATANODE_HEAP_MIB
+
+
+class FilterModule(object):
+    '''
+    Filters to size Accumulo, the Spark executors and HDFS sharing a node
+    from the hardware of its instance type and the size of the cluster.
+    '''
+
+    def filters(self):
+        return {
+            'accumulo_tuning': self.accumulo_tuning,
+            'spark_tuning': self.spark_tuning,
+            'hdfs_tuning': self.hdfs_tuning
+        }
+
+    def accumulo_tuning(self, spec, memory_fraction=0.3, cpu_fraction=0.25):
+        """Works out Accumulo's memory and concurrency settings for a node
+
+            ansible_ec2_instance_type | instance_spec | accumulo_tuning(0.3, 0.25)
+
+        The tablet server gets `memory_fraction` of the memory left once
+        the OS and datanode are provided for, and Spark the rest. Two
+        fifths of it goes to the native in-memory map, outside the heap,
+        and the heap holds the data and index block caches and the sort
+        buffer. Neither grows past 16G, and Spark gets what is left over.
+
+        Write-ahead logs roll over at the size of the in-memory map
+        (between 1G and 4G), and compactions may use `cpu_fraction` of the
+        cores. The leader's master, monitor and garbage collector are
+        sized from the whole of its memory.
+
+        Returns a dict of sizes in MiB (`*_mib`) and thread counts, with
+        the tablet server's heap and in-memory map in `memory_mib` and the
+        cores set aside for it in `cores`.
+
+        Arguments
+        :param spec: Instance type specification from instance_spec
+        :param memory_fraction: Share of the memory left for Accumulo
+        :param cpu_fraction: Share of the cores compactions may use
+        """
+        accumulo_mib = node_memory(spec) * float(memory_fraction)
+        native_map_mib = _clamp(_round(accumulo_mib * 0.4), 512, MAX_NATIVE_MAP_MIB)
+        heap_mib = _clamp(_round(accumulo_mib * 0.6), MIB, MAX_HEAP_MIB)
+        compaction_threads = _clamp(int(spec['vcpus'] * float(cpu_fraction)), 2, 8)
+        return {
+            'memory_mib': heap_mib + native_map_mib,
+            'cores': max(1, int(round(spec['vcpus'] * float(cpu_fraction)))),
+            'tserver_heap_mib': heap_mib,
+            'tserver_new_mib': _clamp(_round(heap_mib / 4), 256, 2 * MIB),
+            'native_map_mib': native_map_mib,
+            'data_cache_mib': _round(heap_mib * 0.3),
+            'index_cache_mib': _round(heap_mib * 0.1),
+            'sort_buffer_mib': _clamp(_round(heap_mib * 0.1), 128, MIB),
+            'walog_max_mib': _clamp(native_map_mib, MIB, 4 * MIB),
+            'minor_compactions': compaction_threads,
+            'major_compactions': compaction_threads,
+            'master_heap_mib': _clamp(_round(spec['memory_mib'] * 0.05), MIB, 4 * MIB),
+            'monitor_heap_mib': MIB,
+            'gc_heap_mib': _clamp(_round(spec['memory_mib'] * 0.02), 256, MIB)
+        }
+
+    def spark_tuning(self, spec, accumulo, executor_cores=0, parallelism_per_core=2):
+        """Works out the size of the Spark executors on a node
+
+            ansible_ec2_instance_type | instance_spec | spark_tuning(accumulo)
+
+        Spark gets the memory and cores Accumulo leaves, less the heap of
+        the external shuffle service. The executors split them evenly, as
+        close to `executor_cores` each as the node's cores allow, and
+        each keeps a tenth of its memory (at least 384M) for overhead
+        outside its heap, as Spark does.
+
+        Executors get a heap of at least 512M. Nodes with less than 7.5G
+        (c3.large and c4.large) can't leave Spark even that much once
+        Accumulo is provided for, so Spark gets enough for a single
+        executor of the least size and the node is overcommitted.
+
+        Returns a dict with the `cores` and `memory_mib` Spark gets, the
+        `executors` per node, each with `executor_cores`,
+        `executor_memory_mib` and `memory_overhead_mib`, the heap of the
+        shuffle service in `shuffle_service_mib` and the `parallelism` a
+        node's cores can take.
+
+        Arguments
+        :param spec: Instance type specification from instance_spec
+        :param accumulo: Accumulo's share of the node from accumulo_tuning
+        :param executor_cores: Cores each executor should have, or 0 for a
+                               single executor per node with all of them
+        :param parallelism_per_core: Tasks to split work into for each core
+        """
+        cores = max(1, spec['vcpus'] - accumulo['cores'])
+        memory_mib = max(node_memory(spec) - accumulo['memory_mib'] - SHUFFLE_SERVICE_HEAP_MIB,
+                         MIN_EXECUTOR_HEAP_MIB + MIN_EXECUTOR_OVERHEAD_MIB)
+        executors = max(1, int(round(cores / float(int(executor_cores) or cores))))
+        executor_cores = cores // executors
+        budget_mib = memory_mib / executors
+        overhead_mib = max(MIN_EXECUTOR_OVERHEAD_MIB, _round(budget_mib * 0.1 / 1.1))
+        return {
+            'cores': cores,
+            'memory_mib': _round(memory_mib),
+            'executors': executors,
+            'executor_cores': executor_cores,
+            'executor_memory_mib': max(MIN_EXECUTOR_HEAP_MIB, _round(budget_mib - overhead_mib)),
+            'memory_overhead_mib': overhead_mib,
+            'shuffle_service_mib': SHUFFLE_SERVICE_HEAP_MIB,
+            'parallelism': cores * int(parallelism_per_core)
+        }
+
+    def hdfs_tuning(self, spec, datanodes):
+        """Works out the thread pools of HDFS for a node and cluster
+
+            ansible_ec2_instance_type | instance_spec | hdfs_tuning(hdfs_datanodes)
+
+        The namenode's handlers grow with the log of the number of
+        datanodes (20 ln N, from 10 up to 200), half as many serve the
+        datanodes themselves, and each datanode gets handlers and transfer
+        threads for each of its instance store volumes.
+
+        Arguments
+        :param spec: Instance type specification from instance_spec
+        :param datanodes: Most datanodes the cluster is expected to have
+        """
+        namenode_handlers = _clamp(int(20 * math.log(max(int(datanodes), 1))), 10, 200)
+        volumes = max(1, spec['instance_store_count'])
+        return {
+            'volumes': volumes,
+            'namenode_handlers': namenode_handlers,
+            'namenode_service_handlers': max(10, namenode_handlers // 2),
+            'datanode_handlers': _clamp(4 * volumes, 10, 64),
+            'max_transfer_threads': _clamp(2048 * volumes, 4096, 16384)
+        }
@@ -0,0 +1,218 @@
+"""Scales the Mesos follower group to the load on the cluster
+
+Each step reads the load on the cluster, protects followers holding HDFS
+blocks from scale-in, works out how many followers the load needs and
+moves the group's desired capacity towards it within the group's bounds.
+
+The load is measured in CPUs: what Mesos tasks are using, plus a CPU for
+each task that is staging or waiting in a Spark stage. Memory in use is
+taken into account the same way. The group grows when there is more
+pending work than idle capacity, or when utilization passes a threshold,
+and shrinks a follower at a time once utilization falls low enough with
+nothing pending. Growing waits out a cooldown after the last scale-out,
+so new followers have time to register with Mesos before they are
+counted, and shrinking waits out a longer cooldown after any change.
+"""
+
+import logging
+import math
+import time
+
+from collections import namedtuple
+
+from metrics import MetricsError
+
+
+logger = logging.getLogger('autoscaling')
+
+Decision = namedtuple('Decision', ['current', 'desired', 'reason', 'applied'])
+
+
+class ScalingPolicy(object):
+    """Thresholds and cooldowns of the controller"""
+
+    def __init__(self, target_utilization=0.7, scale_out_threshold=0.85,
+                 scale_in_threshold=0.4, scale_out_cooldown=300,
+                 scale_in_cooldown=900, max_scale_in_step=1, cpus_per_task=1):
+        """
+        Args:
+          target_utilization (float): share of the cluster's CPU and memory
+            the followers should be using after scaling
+          scale_out_threshold (float): utilization above which to scale out
+          scale_in_threshold (float): utilization below which to scale in
+          scale_out_cooldown (float): seconds after a scale-out before
+            scaling out again
+          scale_in_cooldown (float): seconds after any scaling before
+            scaling in
+          max_scale_in_step (int): most followers to remove at once
+          cpus_per_task (float): CPUs a pending task is assumed to need
+        """
+        self.target_utilization = target_utilization
+        self.scale_out_threshold = scale_out_threshold
+        self.scale_in_threshold = scale_in_threshold
+        self.scale_out_cooldown = scale_out_cooldown
+        self.scale_in_cooldown = scale_in_cooldown
+        self.max_scale_in_step = max_scale_in_step
+        self.cpus_per_task = cpus_per_task
+
+    def desired_capacity(self, metrics, current):
+        """Works out how many followers the load needs
+
+        Bounds and cooldowns are left to the controller.
+
+        Args:
+          metrics (ClusterMetrics): current load on the cluster
+          current (int): current desired capacity of the group
+
+        Returns:
+          tuple: (desired capacity, reason)
+        """
+        if not metrics.agents or not metrics.cpus_total:
+            return current, 'no Mesos agents have registered'
+
+        pending_tasks = metrics.tasks_staging + metrics.spark_pending_tasks
+        pending_cpus = pending_tasks * self.cpus_per_task
+        idle_cpus = metrics.cpus_total - metrics.cpus_used
+        cpu_utilization = metrics.cpus_used / float(metrics.cpus_total)
+        mem_utilization = (metrics.mem_used / float(metrics.mem_total)
+                           if metrics.mem_total else 0)
+        utilization = max(cpu_utilization, mem_utilization)
+
+        cpus_per_agent = metrics.cpus_total / float(metrics.agents)
+        mem_per_agent = metrics.mem_total / float(metrics.agents)
+        needed = (metrics.cpus_used + pending_cpus) / (cpus_per_agent * self.target_utilization)
+        if mem_per_agent:
+            needed = max(needed, metrics.mem_used / (mem_per_agent * self.target_utilization))
+        needed = int(math.ceil(needed))
+
+        load = '{:.0%} utilized, {} pending tasks in {} pending Spark stages'.format(
+            utilization, pending_tasks, metrics.spark_pending_stages)
+        if pending_cpus > idle_cpus or utilization > self.scale_out_threshold:
+            return max(needed, current + 1), load
+        if not pending_tasks and utilization < self.scale_in_threshold:
+            return max(needed, current - self.max_scale_in_step), load
+        return current, load
+
+
+class ScalingController(object):
+    """Adjusts the desired capacity of a group to the load on the cluster"""
+
+    def __init__(self, reader, group, policy=None, dry_run=False, clock=time.time):
+        """
+        Args:
+          reader (ClusterMetricsReader): reads the load on the cluster
+          group (AutoScalingGroup): the follower group
+          policy (ScalingPolicy): thresholds and cooldowns
+          dry_run (bool): whether to only log what would be changed
+          clock (callable): returns the current time in seconds
+        """
+        self.reader = reader
+        self.group = group
+        self.policy = policy or ScalingPolicy()
+        self.dry_run = dry_run
+        self.clock = clock
+        self.last_scale_out = None
+        self.last_scale_in = None
+
+    def _since(self, timestamp, now):
+        """Returns the seconds since a timestamp, which may be None for never"""
+        return float('inf') if timestamp is None else now - timestamp
+
+    def protect_hdfs_nodes(self, state, hdfs_blocks):
+        """Protects followers holding HDFS blocks from scale-in
+
+        Followers that no longer hold any blocks lose their protection.
+
+        Args:
+          state (GroupState): current state of the group
+          hdfs_blocks (dict): datanode IP address to block count
+
+        Returns:
+          int: number of in-service followers which are protected
+        """
+        protect = []
+        unprotect = []
+        for instance in state.instances:
+            holds_blocks = hdfs_blocks.get(instance.private_ip, 0) > 0
+            if holds_blocks and not instance.protected:
+                protect.append(instance.instance_id)
+            elif not holds_blocks and instance.protected:
+                unprotect.append(instance.instance_id)
+        for instance_ids, protected in ((protect, True), (unprotect, False)):
+            if instance_ids:
+                logger.info('%s scale-in protection %s %s',
+                            'Would set' if self.dry_run else 'Setting',
+                            'on' if protected else 'off', ', '.join(instance_ids))
+                if not self.dry_run:
+                    self.group.set_instance_protection(instance_ids, protected)
+        return len([instance for instance in state.instances
+                    if instance.lifecycle_state == 'InService' and
+                    hdfs_blocks.get(instance.private_ip, 0) > 0])
+
+    def step(self):
+        """Reads the load and scales the group once
+
+        Returns:
+          Decision
+        """
+        now = self.clock()
+        metrics = self.reader.read()
+        state = self.group.describe()
+        current = state.desired
+
+        desired, reason = self.policy.desired_capacity(metrics, current)
+        desired = min(max(desired, state.min_size), state.max_size)
+
+        protected = None
+        if metrics.hdfs_blocks is not None:
+            protected = self.protect_hdfs_nodes(state, metrics.hdfs_blocks)
+        if desired < current:
+            if protected is None and self.reader.namenode_url:
+                desired, reason = current, 'HDFS block counts are unavailable'
+            elif protected is not None and protected > desired:
+                desired = min(current, protected)
+                reason = '{} followers hold HDFS blocks'.format(protected)
+
+        last_scaled = max([timestamp for timestamp in (self.last_scale_out, self.last_scale_in)
+                           if timestamp is not None] or [None])
+        if desired > current and self._since(self.last_scale_out, now) < \
+                self.policy.scale_out_cooldown:
+            desired, reason = current, 'cooling down after scaling out'
+        elif desired < current and self._since(last_scaled, now) < \
+                self.policy.scale_in_cooldown:
+            desired, reason = current, 'cooling down after scaling'
+
+        applied = False
+        if desired != current:
+            logger.info('%s desired capacity from %d to %d (%s)',
+                        'Would change' if self.dry_run else 'Changing',
+                        current, desired, reason)
+            if not self.dry_run:
+                self.group.set_desired_capacity(desired)
+                applied = True
+            if desired > current:
+                self.last_scale_out = now
+            else:
+                self.last_scale_in = now
+        return Decision(current, desired, reason, applied)
+
+    def run(self, interval=60, iterations=None):
+        """Steps the controller every `interval` seconds
+
+        Failures to read the load are logged and the step is skipped.
+
+        Args:
+          interval (float): seconds between steps
+          iterations (int): number of steps to run, forever if None
+        """
+        count = 0
+        while iterations is None or count < iterations:
+            try:
+                decision = self.step()
+                if decision.desired == decision.current:
+                    logger.info('Holding at %d followers (%s)', decision.current, decision.reason)
+            except MetricsError as e:
+                logger.warning('%s', e)
+            count += 1
+            if iterations is None or count < iterations:
+                time.sleep(interval)
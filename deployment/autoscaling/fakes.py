@@ -0,0 +1,210 @@
+"""Local stand-ins for the follower group and the cluster's endpoints
+
+FakeAutoScalingGroup keeps its instances in memory and launches or
+terminates them when its desired capacity changes, skipping instances that
+are protected from scale-in as AWS does. FakeCluster serves the Mesos
+master, Spark driver and namenode endpoints the controller reads over HTTP
+on localhost, with an agent and a datanode for every in-service instance
+of the group. The load on it is set by changing its attributes:
+
+    group = FakeAutoScalingGroup(desired=2, min_size=1, max_size=6)
+    cluster = FakeCluster(group)
+    cluster.start()
+    cluster.tasks_staging = 40
+    controller = ScalingController(
+        ClusterMetricsReader(cluster.url, namenode_url=cluster.url), group)
+    controller.step()
+"""
+
+import json
+import threading
+import urlparse
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from groups import GroupInstance, GroupState
+from metrics import NAMENODE_INFO_QUERY
+
+
+class FakeAutoScalingGroup(object):
+    """Auto scaling group kept in memory"""
+
+    def __init__(self, desired=2, min_size=1, max_size=10, name='asgMesosFollower'):
+        """
+        Args:
+          desired (int): desired capacity to start with
+          min_size (int): least instances the group may have
+          max_size (int): most instances the group may have
+          name (str): name of the group
+        """
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.desired = 0
+        self.instances = []
+        self.actions = []
+        self._launched = 0
+        self._lock = threading.Lock()
+        self.set_desired_capacity(desired)
+        self.actions = []
+
+    def _launch(self):
+        self._launched += 1
+        return GroupInstance('i-{:08x}'.format(self._launched),
+                             '10.0.{}.{}'.format(1 + self._launched // 250,
+                                                 4 + self._launched % 250),
+                             'InService', False)
+
+    def describe(self):
+        with self._lock:
+            return GroupState(self.desired, self.min_size, self.max_size,
+                              list(self.instances))
+
+    def set_desired_capacity(self, desired):
+        """Launches or terminates instances to match a desired capacity
+
+        Newer instances are terminated first. Protected instances are kept
+        even if that leaves the group above its desired capacity.
+
+        Raises:
+          ValueError: if the capacity is outside the group's bounds
+        """
+        if not self.min_size <= desired <= self.max_size:
+            raise ValueError('New SetDesiredCapacity value {} is outside of '
+                             'bounds [{}, {}]'.format(desired, self.min_size, self.max_size))
+        with self._lock:
+            self.actions.append(('SetDesiredCapacity', desired))
+            self.desired = desired
+            while len(self.instances) < desired:
+                self.instances.append(self._launch())
+            for instance in reversed(list(self.instances)):
+                if len(self.instances) <= desired:
+                    break
+                if not instance.protected:
+                    self.instances.remove(instance)
+
+    def set_instance_protection(self, instance_ids, protected):
+        with self._lock:
+            self.actions.append(('SetInstanceProtection', sorted(instance_ids), protected))
+            self.instances = [instance._replace(protected=protected)
+                              if instance.instance_id in instance_ids else instance
+                              for instance in self.instances]
+
+
+class FakeCluster(object):
+    """Mesos master, Spark driver and namenode served from localhost
+
+    Each in-service instance of the group is an agent with `cpus_per_agent`
+    CPUs and `mem_per_agent` MB of memory. Load is set with `cpus_used`,
+    `mem_used` and `offered` (dicts of instance IP to the amount in use or
+    offered on it), `tasks_staging`, `spark_stages` (list of dicts with
+    `status`, `numTasks`, `numActiveTasks` and `numCompleteTasks`) and
+    `hdfs_blocks` (dict of instance IP to block count).
+    """
+
+    def __init__(self, group, cpus_per_agent=8, mem_per_agent=61440):
+        """
+        Args:
+          group (FakeAutoScalingGroup): group whose instances are the agents
+          cpus_per_agent (float): CPUs each agent has
+          mem_per_agent (float): MB of memory each agent has
+        """
+        self.group = group
+        self.cpus_per_agent = cpus_per_agent
+        self.mem_per_agent = mem_per_agent
+        self.cpus_used = {}
+        self.mem_used = {}
+        self.offered = {}
+        self.tasks_staging = 0
+        self.spark_stages = []
+        self.hdfs_blocks = {}
+        self.server = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def agent_ips(self):
+        return [instance.private_ip for instance in self.group.describe().instances
+                if instance.lifecycle_state == 'InService']
+
+    def master_state(self):
+        ips = self.agent_ips()
+        slaves = [{'id': 'S{}'.format(i), 'pid': 'slave(1)@{}:5051'.format(ip), 'hostname': ip,
+                   'resources': {'cpus': self.cpus_per_agent, 'mem': self.mem_per_agent},
+                   'used_resources': {'cpus': self.cpus_used.get(ip, 0),
+                                      'mem': self.mem_used.get(ip, 0)}}
+                  for i, ip in enumerate(ips)]
+        offered = [self.offered.get(ip, {}) for ip in ips]
+        framework = {'id': 'spark-driver', 'name': 'GeoTrellis', 'active': True,
+                     'webui_url': '{}/spark'.format(self.url),
+                     'offered_resources': {
+                         'cpus': sum(resources.get('cpus', 0) for resources in offered),
+                         'mem': sum(resources.get('mem', 0) for resources in offered)}}
+        return {'slaves': slaves, 'frameworks': [framework]}
+
+    def metrics_snapshot(self):
+        ips = self.agent_ips()
+        return {'master/cpus_total': self.cpus_per_agent * len(ips),
+                'master/cpus_used': sum(self.cpus_used.get(ip, 0) for ip in ips),
+                'master/mem_total': self.mem_per_agent * len(ips),
+                'master/mem_used': sum(self.mem_used.get(ip, 0) for ip in ips),
+                'master/tasks_staging': self.tasks_staging,
+                'master/slaves_active': len(ips)}
+
+    def namenode_info(self):
+        live_nodes = {'{}:50010'.format(ip): {'xferaddr': '{}:50010'.format(ip),
+                                              'numBlocks': self.hdfs_blocks.get(ip, 0)}
+                      for ip in self.agent_ips()}
+        return {'beans': [{'name': NAMENODE_INFO_QUERY,
+                           'LiveNodes': json.dumps(live_nodes)}]}
+
+    def respond(self, path, query):
+        """Returns the document for a request, or None if there is none"""
+        if path == '/master/state.json':
+            return self.master_state()
+        if path == '/metrics/snapshot':
+            return self.metrics_snapshot()
+        if path == '/jmx' and query.get('qry') == [NAMENODE_INFO_QUERY]:
+            return self.namenode_info()
+        if path == '/spark/api/v1/applications':
+            return [{'id': 'app-0001', 'name': 'GeoTrellis'}]
+        if path == '/spark/api/v1/applications/app-0001/stages':
+            status = query.get('status', [None])[0]
+            return [stage for stage in self.spark_stages
+                    if status is None or stage['status'].lower() == status]
+        return None
+
+    def start(self):
+        """Serves the endpoints on a free port in a background thread"""
+        cluster = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse.urlparse(self.path)
+                document = cluster.respond(url.path, urlparse.parse_qs(url.query))
+                if document is None:
+                    self.send_error(404)
+                    return
+                body = json.dumps(document)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
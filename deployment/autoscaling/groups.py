@@ -0,0 +1,77 @@
+"""Access to the follower auto scaling group
+
+The controller only needs to read the group's bounds and instances, set its
+desired capacity and protect instances from scale-in, so groups are wrapped
+in a small interface which fakes.FakeAutoScalingGroup also implements.
+"""
+
+from collections import namedtuple
+
+from cfn.connections import get_connection
+
+
+GroupState = namedtuple('GroupState', ['desired', 'min_size', 'max_size', 'instances'])
+
+GroupInstance = namedtuple('GroupInstance', ['instance_id', 'private_ip',
+                                             'lifecycle_state', 'protected'])
+
+
+class AutoScalingGroup(object):
+    """Auto scaling group on AWS"""
+
+    def __init__(self, name, region, profile_name):
+        """
+        Args:
+          name (str): name of the auto scaling group
+          region (str): AWS region of the group
+          profile_name (str): AWS profile to use for authentication
+        """
+        self.name = name
+        self.region = region
+        self.profile_name = profile_name
+
+    def _connect(self, service):
+        return get_connection(service, self.region, self.profile_name)
+
+    def describe(self):
+        """Returns the current size, bounds and instances of the group
+
+        Returns:
+          GroupState
+        """
+        group = self._connect('autoscale').get_all_groups(names=[self.name])[0]
+        instance_ids = [instance.instance_id for instance in group.instances]
+        private_ips = {}
+        if instance_ids:
+            private_ips = {instance.id: instance.private_ip_address
+                           for instance in self._connect('ec2').get_only_instances(instance_ids)}
+        # boto doesn't know about scale-in protection, but keeps unknown
+        # elements of an instance as attributes
+        instances = [GroupInstance(instance.instance_id,
+                                   private_ips.get(instance.instance_id),
+                                   instance.lifecycle_state,
+                                   getattr(instance, 'ProtectedFromScaleIn', 'false') == 'true')
+                     for instance in group.instances]
+        return GroupState(int(group.desired_capacity), int(group.min_size),
+                          int(group.max_size), instances)
+
+    def set_desired_capacity(self, desired):
+        """Sets the number of instances the group should have
+
+        Args:
+          desired (int): new desired capacity
+        """
+        self._connect('autoscale').set_desired_capacity(self.name, desired)
+
+    def set_instance_protection(self, instance_ids, protected):
+        """Protects instances from, or exposes them to, scale-in
+
+        Args:
+          instance_ids (list): IDs of instances in the group
+          protected (bool): whether the instances should be protected
+        """
+        conn = self._connect('autoscale')
+        params = {'AutoScalingGroupName': self.name,
+                  'ProtectedFromScaleIn': 'true' if protected else 'false'}
+        conn.build_list_params(params, list(instance_ids), 'InstanceIds')
+        conn.get_status('SetInstanceProtection', params)
@@ -0,0 +1,161 @@
+"""Reads the load on a cluster from Mesos, Spark and HDFS
+
+The Mesos master reports the CPU and memory each agent has, uses and has
+offered to frameworks, along with tasks that are staging. Spark drivers
+register with Mesos as frameworks, and the pending and active stages of
+each one are read from its REST API to find work that hasn't been given
+to Mesos yet. The namenode reports how many HDFS blocks each datanode
+holds, which is what decides whether a follower is safe to terminate.
+"""
+
+import json
+import logging
+import urllib2
+
+from collections import namedtuple
+
+
+logger = logging.getLogger('autoscaling')
+
+NAMENODE_INFO_QUERY = 'Hadoop:service=NameNode,name=NameNodeInfo'
+
+ClusterMetrics = namedtuple('ClusterMetrics', [
+    'agents',                # number of registered Mesos agents
+    'cpus_total',
+    'cpus_used',
+    'cpus_offered',
+    'mem_total',             # MB
+    'mem_used',
+    'mem_offered',
+    'tasks_staging',         # Mesos tasks launched but not yet running
+    'spark_pending_stages',  # stages waiting on their parents
+    'spark_pending_tasks',   # tasks of pending and active stages not yet running
+    'hdfs_blocks'            # dict of datanode IP to block count, None if unknown
+])
+
+
+class MetricsError(Exception):
+    """Raised when the cluster's load can't be read"""
+    pass
+
+
+def get_json(url, timeout=5):
+    """Fetches and decodes a JSON document
+
+    Args:
+      url (str): URL of the document
+      timeout (float): seconds to wait for a response
+
+    Returns:
+      the decoded document
+    """
+    response = urllib2.urlopen(url, timeout=timeout)
+    try:
+        return json.load(response)
+    finally:
+        response.close()
+
+
+class ClusterMetricsReader(object):
+    """Reads ClusterMetrics from a Mesos master and optionally a namenode"""
+
+    def __init__(self, mesos_url, namenode_url=None, timeout=5):
+        """
+        Args:
+          mesos_url (str): URL of the Mesos master, e.g.
+            `http://mesos-leader.service.geotrellis-spark.internal:5050`
+          namenode_url (str): URL of the namenode web UI, e.g.
+            `http://namenode.service.geotrellis-spark.internal:50070`.
+            Without one, HDFS block counts are not read.
+          timeout (float): seconds to wait for each response
+        """
+        self.mesos_url = mesos_url.rstrip('/')
+        self.namenode_url = namenode_url.rstrip('/') if namenode_url else None
+        self.timeout = timeout
+
+    def _get(self, url):
+        return get_json(url, self.timeout)
+
+    def read_spark(self, frameworks):
+        """Counts the pending stages and tasks of the Spark drivers
+
+        Drivers which can't be reached are skipped, as they are usually
+        shutting down.
+
+        Args:
+          frameworks (list): active frameworks from the master's state
+
+        Returns:
+          tuple: (pending stages, pending tasks)
+        """
+        pending_stages = 0
+        pending_tasks = 0
+        for framework in frameworks:
+            webui_url = framework.get('webui_url')
+            if not webui_url:
+                continue
+            api_url = '{}/api/v1/applications'.format(webui_url.rstrip('/'))
+            try:
+                for application in self._get(api_url):
+                    stages_url = '{}/{}/stages?status='.format(api_url, application['id'])
+                    for stage in self._get(stages_url + 'pending'):
+                        pending_stages += 1
+                        pending_tasks += stage['numTasks']
+                    for stage in self._get(stages_url + 'active'):
+                        pending_tasks += max(0, stage['numTasks'] - stage['numActiveTasks'] -
+                                             stage['numCompleteTasks'])
+            except (IOError, ValueError, KeyError) as e:
+                logger.warning('Unable to read stages of framework %s from %s: %s',
+                               framework.get('name'), webui_url, e)
+        return pending_stages, pending_tasks
+
+    def read_hdfs_blocks(self):
+        """Reads how many blocks each live datanode holds
+
+        Returns:
+          dict: datanode IP address to block count, or None if there is no
+            namenode or it can't be reached
+        """
+        if self.namenode_url is None:
+            return None
+        try:
+            info = self._get('{}/jmx?qry={}'.format(self.namenode_url, NAMENODE_INFO_QUERY))
+            live_nodes = json.loads(info['beans'][0]['LiveNodes'])
+        except (IOError, ValueError, KeyError, IndexError) as e:
+            logger.warning('Unable to read HDFS block counts from %s: %s', self.namenode_url, e)
+            return None
+        return {node['xferaddr'].rsplit(':', 1)[0]: node['numBlocks']
+                for node in live_nodes.itervalues()}
+
+    def read(self):
+        """Reads the current load on the cluster
+
+        Returns:
+          ClusterMetrics
+
+        Raises:
+          MetricsError: if the Mesos master can't be read
+        """
+        try:
+            state = self._get('{}/master/state.json'.format(self.mesos_url))
+            snapshot = self._get('{}/metrics/snapshot'.format(self.mesos_url))
+        except (IOError, ValueError) as e:
+            raise MetricsError('Unable to read Mesos master at {}: {}'.format(self.mesos_url, e))
+
+        frameworks = [framework for framework in state.get('frameworks', [])
+                      if framework.get('active', True)]
+        offered = [framework.get('offered_resources', {}) for framework in frameworks]
+        spark_pending_stages, spark_pending_tasks = self.read_spark(frameworks)
+        return ClusterMetrics(
+            agents=len(state.get('slaves', [])),
+            cpus_total=snapshot.get('master/cpus_total', 0),
+            cpus_used=snapshot.get('master/cpus_used', 0),
+            cpus_offered=sum(resources.get('cpus', 0) for resources in offered),
+            mem_total=snapshot.get('master/mem_total', 0),
+            mem_used=snapshot.get('master/mem_used', 0),
+            mem_offered=sum(resources.get('mem', 0) for resources in offered),
+            tasks_staging=int(snapshot.get('master/tasks_staging', 0)),
+            spark_pending_stages=spark_pending_stages,
+            spark_pending_tasks=spark_pending_tasks,
+            hdfs_blocks=self.read_hdfs_blocks()
+        )
@@ -0,0 +1,264 @@
+"""Benchmarks of the stack graph scheduler
+
+Graphs are run by a GraphExecutor against FakeAWS, with resource creation
+times scaled down so a benchmark finishes in seconds. Each run records its
+wall-clock time, the critical path through the graph (the time a perfect
+scheduler would take given the simulated stack durations), the difference
+between the two as scheduler overhead, CPU time and the API calls made to
+each service. The real graph from build_graph is benchmarked alongside
+synthetic graphs of any size, and the results can be saved as JSON to
+compare between versions.
+"""
+
+import logging
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from datetime import datetime
+
+from troposphere import Output, Parameter, Ref, cloudformation
+
+import connections
+import majorkirby as mk
+
+from fakeaws import FakeAWS
+from majorkirby import GlobalConfigNode, GraphExecutor, StackNode
+from stacks import build_graph
+
+
+# Seconds each resource type takes to create, roughly a hundredth of what
+# it takes on AWS
+DEFAULT_LATENCIES = {
+    'default': 0.05,
+    'AWS::EC2::VPC': 0.2,
+    'AWS::EC2::Instance': 0.6,
+    'AWS::AutoScaling::AutoScalingGroup': 1.5,
+    'AWS::CloudFormation::WaitConditionHandle': 0.1
+}
+
+DEFAULT_SIZES = (50, 100, 250, 500)
+
+
+class SyntheticNode(StackNode):
+    """Node with a few placeholder resources, used to build large graphs
+
+    The node has an input for the `Out` output of each node upstream of it,
+    wired to a template parameter.
+    """
+    INPUTS = {'Region': ['global:Region']}
+    OUTPUTS = ('Out',)
+    RESOURCES = 3
+
+    def __init__(self, name, upstream=(), **kwargs):
+        """
+        Args:
+          name (str): name of the node, which must be unique in the graph
+          upstream (list): SyntheticNodes this node takes an input from
+          **kwargs (dict): other input connections, such as `globalconfig`
+        """
+        self.NAME = name
+        for node in upstream:
+            kwargs[node.NAME] = node
+        super(SyntheticNode, self).__init__(**kwargs)
+        for node in upstream:
+            self.inputs['{}Out'.format(node.NAME)] = ['{}:Out'.format(node.NAME)]
+
+    def set_up_stack(self):
+        super(SyntheticNode, self).set_up_stack()
+        self.region = self.get_input('Region')
+        for input_name in sorted(self.inputs):
+            if input_name != 'Region':
+                self.add_parameter(Parameter(input_name, Type='String'),
+                                   source=input_name)
+        handles = [self.add_resource(cloudformation.WaitConditionHandle(
+            'Handle{}'.format(i))) for i in range(self.RESOURCES)]
+        self.add_output(Output('Out', Value=Ref(handles[0])))
+
+
+def build_synthetic_graph(size, region='us-east-1', fan_in=2, window=10,
+                          seed=0):
+    """Builds a random acyclic graph of SyntheticNodes
+
+    Each node takes inputs from up to `fan_in` nodes picked from the
+    `window` nodes created before it, so a smaller window makes a deeper
+    graph.
+
+    Args:
+      size (int): number of nodes
+      region (str): region of the stacks
+      fan_in (int): most inputs a node takes from other nodes
+      window (int): how many of the preceding nodes inputs are picked from
+      seed: seed for picking the inputs
+
+    Returns:
+      list: the sinks of the graph
+    """
+    rng = random.Random(seed)
+    global_config = GlobalConfigNode(Region=region)
+    nodes = []
+    upstream_nodes = set()
+    for i in range(size):
+        candidates = nodes[-window:]
+        upstream = rng.sample(candidates, min(fan_in, len(candidates)))
+        upstream_nodes.update(upstream)
+        nodes.append(SyntheticNode('Synthetic{:04d}'.format(i), upstream,
+                                   globalconfig=global_config))
+    return [node for node in nodes if node not in upstream_nodes]
+
+
+def critical_path(executor, aws):
+    """Returns the shortest possible time to run a graph
+
+    Args:
+      executor (GraphExecutor): executor which has run the graph
+      aws (FakeAWS): the fake the graph was run against, which knows how
+        long each stack took
+
+    Returns:
+      float: seconds along the slowest chain of stacks
+    """
+    finish = {}
+    for node in executor.order:
+        if node not in executor.nodes:
+            continue
+        stack = aws.stacks.get(getattr(node, 'region', None), {}).get(node.stack_name)
+        duration = stack.duration if stack is not None else 0
+        finish[node] = duration + max([finish[node.input_connections[required]]
+                                       for required in node.requires] or [0])
+    return max(finish.values() or [0])
+
+
+def run_graph(name, sinks, aws, poll_interval):
+    """Runs a graph against a fake and measures it
+
+    Args:
+      name (str): name of the graph in the results
+      sinks (list): sinks of the graph
+      aws (FakeAWS): fake to run the graph against
+      poll_interval (float): seconds between status checks
+
+    Returns:
+      dict: measurements of the run
+    """
+    connections.reset()
+    connections.set_backend(aws)
+
+    start = time.time()
+    cpu_start = time.clock()
+    executor = GraphExecutor(sinks, poll_interval=poll_interval)
+    compile_time = time.time() - start
+    succeeded = executor.run()
+    wall_time = time.time() - start
+    cpu_time = time.clock() - cpu_start
+
+    path = critical_path(executor, aws)
+    api_calls = connections.get_call_counts()
+    return {
+        'graph': name,
+        'nodes': len(executor.nodes),
+        'succeeded': succeeded,
+        'failed_nodes': len([node for node in executor.nodes
+                             if node.state == node.states.FAILED]),
+        'wall_time': wall_time,
+        'compile_time': compile_time,
+        'critical_path': path,
+        'scheduler_overhead': wall_time - path,
+        'cpu_time': cpu_time,
+        'api_calls': api_calls,
+        'api_calls_total': sum(sum(actions.itervalues())
+                               for actions in api_calls.itervalues())
+    }
+
+
+def get_revision():
+    """Returns the git revision of the checkout, if there is one"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w'),
+            cwd=os.path.dirname(os.path.realpath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(aws_profile, gt_config, sizes=DEFAULT_SIZES, latencies=None,
+                   api_latency=0, failure_rate=0, poll_interval=0.05, seed=0,
+                   fan_in=2, window=10):
+    """Benchmarks the real graph and synthetic graphs of each size
+
+    Status polling is scaled down with the latencies: stacks are polled
+    every `poll_interval` seconds, backing off to 15 times that.
+
+    Args:
+      aws_profile (str): name of AWS profile the real graph is built with
+      gt_config (dict): dictionary representation of `geotrellis-cluster.config`
+      sizes (list): number of nodes in each synthetic graph
+      latencies (dict): seconds each resource type takes, merged over
+        DEFAULT_LATENCIES
+      api_latency (float): seconds each API call takes
+      failure_rate (float): chance of each resource failing
+      poll_interval (float): seconds between status checks
+      seed: seed for the synthetic graphs and failures
+      fan_in (int): most inputs a synthetic node takes from other nodes
+      window (int): how many preceding synthetic nodes inputs are picked from
+
+    Returns:
+      dict: the settings and the results of each run
+    """
+    started = datetime.utcnow().isoformat()
+    latencies = dict(DEFAULT_LATENCIES, **(latencies or {}))
+
+    def fake_aws():
+        return FakeAWS(placeholder_images=True, latencies=latencies,
+                       api_latency=api_latency, failure_rate=failure_rate,
+                       seed=seed)
+
+    intervals = (mk.StackStatusTracker.MIN_INTERVAL,
+                 mk.StackStatusTracker.MAX_INTERVAL)
+    template_cache = mk.template_cache
+    log_level = mk.default_logger.level
+    cache_dir = tempfile.mkdtemp()
+    mk.StackStatusTracker.MIN_INTERVAL = poll_interval
+    mk.StackStatusTracker.MAX_INTERVAL = poll_interval * 15
+    mk.default_logger.setLevel(logging.CRITICAL)
+    results = []
+    try:
+        for size in [None] + list(sizes):
+            # every run starts with an empty template cache
+            mk.template_cache = mk.TemplateCache(os.path.join(cache_dir, str(size)))
+            if size is None:
+                # don't let placeholder AMIs into the on-disk AMI cache
+                follower, leader = build_graph(
+                    aws_profile, dict(gt_config, AMICacheTTL='0'))
+                results.append(run_graph('real', [leader, follower],
+                                         fake_aws(), poll_interval))
+            else:
+                sinks = build_synthetic_graph(size, gt_config['Region'],
+                                              fan_in, window, seed)
+                results.append(run_graph('synthetic-{}'.format(size), sinks,
+                                         fake_aws(), poll_interval))
+    finally:
+        (mk.StackStatusTracker.MIN_INTERVAL,
+         mk.StackStatusTracker.MAX_INTERVAL) = intervals
+        mk.template_cache = template_cache
+        mk.default_logger.setLevel(log_level)
+        connections.set_backend(connections.BotoBackend())
+        shutil.rmtree(cache_dir)
+
+    return {
+        'revision': get_revision(),
+        'started': started,
+        'settings': {
+            'latencies': latencies,
+            'api_latency': api_latency,
+            'failure_rate': failure_rate,
+            'poll_interval': poll_interval,
+            'seed': seed,
+            'fan_in': fan_in,
+            'window': window
+        },
+        'results': results
+    }
@@ -0,0 +1,133 @@
+"""Builds the user data of the Mesos followers
+
+A follower's user data is a gzipped MIME multipart message, which
+cloud-init unpacks, of two parts:
+
+  - the cloud-config of the stack type, `cloud-config/<type>-follower.yml`
+  - a script setting up the instance store disks and HDFS tuning profile
+    of the instance type, `cloud-config/instance-store.sh` with the type,
+    its devices, the disk layout and the filesystem prepended
+
+cloud-init runs the script before the cloud-config's `runcmd`, so the
+disks are mounted by the time the commands there start services on them.
+"""
+
+import base64
+import gzip
+import os
+import StringIO
+
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from template_utils import GTCloudFormationException, get_instance_spec, read_file
+
+
+INSTANCE_STORE_SCRIPT = os.path.join('cloud-config', 'instance-store.sh')
+
+DISK_LAYOUTS = ('jbod', 'raid0')
+FILESYSTEMS = ('ext4', 'xfs')
+
+# fixed, so the same user data renders the same template
+MIME_BOUNDARY = '==GeoTrellisUserData=='
+
+# user data may be at most 16 KB before it is base64 encoded
+MAX_USER_DATA_BYTES = 16384
+
+
+def check_disk_settings(layout, filesystem):
+    """Checks a disk layout and filesystem are ones the script knows
+
+    Raises:
+      GTCloudFormationException: if either isn't
+    """
+    if layout not in DISK_LAYOUTS:
+        raise GTCloudFormationException('Disk layout must be one of {}, not {}'.format(
+            ', '.join(DISK_LAYOUTS), layout))
+    if filesystem not in FILESYSTEMS:
+        raise GTCloudFormationException('Filesystem must be one of {}, not {}'.format(
+            ', '.join(FILESYSTEMS), filesystem))
+
+
+def instance_store_script(instance_type, layout='jbod', filesystem='ext4'):
+    """Renders the script setting up the instance store disks of an instance type
+
+    The disks are expected where get_block_device_mappings attaches them,
+    from `/dev/sdb` (`/dev/xvdb` on HVM instances) onwards.
+
+    Args:
+      instance_type (str): name of the instance type
+      layout (str): `jbod` or `raid0`
+      filesystem (str): `ext4` or `xfs`
+
+    Returns:
+      str: the script
+    """
+    check_disk_settings(layout, filesystem)
+    count = get_instance_spec(instance_type)['instance_store_count']
+    return '\n'.join([
+        '#!/bin/bash',
+        '# Instance store disks of {}'.format(instance_type),
+        'INSTANCE_TYPE={}'.format(instance_type),
+        'DEVICES="{}"'.format(' '.join(chr(ord('b') + index) for index in range(count))),
+        'LAYOUT={}'.format(layout),
+        'FILESYSTEM={}'.format(filesystem),
+        '',
+        read_file(INSTANCE_STORE_SCRIPT)
+    ])
+
+
+def multipart_user_data(parts):
+    """Combines cloud-init parts into a MIME multipart message
+
+    Args:
+      parts (list): (content, MIME subtype, file name) tuples, e.g.
+        `(script, 'x-shellscript', 'setup.sh')`
+
+    Returns:
+      str: the message
+    """
+    message = MIMEMultipart(boundary=MIME_BOUNDARY)
+    for content, subtype, file_name in parts:
+        part = MIMEText(content, subtype)
+        part.add_header('Content-Disposition', 'attachment', filename=file_name)
+        message.attach(part)
+    return message.as_string()
+
+
+def compress_user_data(user_data):
+    """Gzips user data and encodes it as LaunchConfiguration UserData expects
+
+    Raises:
+      GTCloudFormationException: if the user data is too large even
+        compressed
+    """
+    buf = StringIO.StringIO()
+    # without a timestamp, so the output only changes with the input
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(user_data)
+    compressed = buf.getvalue()
+    if len(compressed) > MAX_USER_DATA_BYTES:
+        raise GTCloudFormationException(
+            'User data is {} bytes compressed, more than the {} EC2 allows'.format(
+                len(compressed), MAX_USER_DATA_BYTES))
+    return base64.b64encode(compressed)
+
+
+def follower_user_data(cloud_config, instance_type, layout='jbod', filesystem='ext4'):
+    """Builds the compressed user data of followers of an instance type
+
+    Args:
+      cloud_config (str): cloud-config of the stack type
+      instance_type (str): name of the instance type
+      layout (str): `jbod` or `raid0`
+      filesystem (str): `ext4` or `xfs`
+
+    Returns:
+      str: base64 encoded user data
+    """
+    return compress_user_data(multipart_user_data([
+        (cloud_config, 'cloud-config', 'cloud-config.yml'),
+        (instance_store_script(instance_type, layout, filesystem),
+         'x-shellscript', 'instance-store.sh')
+    ]))
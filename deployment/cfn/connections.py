@@ -0,0 +1,143 @@
+"""Registry of AWS connections shared between the stack nodes of a run
+
+Stack nodes and helpers ask the registry for a connection instead of
+opening their own, so a run opens one connection per service, region and
+profile, which is shared by every worker thread of a GraphExecutor. boto
+builds and signs each request separately and keeps its HTTP connections in
+a locked pool, so one connection can serve several threads.
+
+Every request made through a registered connection is counted per service
+and action, which is useful when tracking down API throttling. Calls can
+also be counted for a single thread with counting_calls, which is how stack
+nodes attribute calls to themselves.
+
+Connections are opened by a backend, which can be swapped out with
+set_backend. The default backend connects to AWS with boto; fakeaws
+provides an in-memory one for working offline.
+"""
+
+import threading
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+import boto.ec2
+import boto.ec2.autoscale
+from boto import cloudformation, route53
+
+
+CONNECTORS = {
+    'autoscale': boto.ec2.autoscale.connect_to_region,
+    'cloudformation': cloudformation.connect_to_region,
+    'ec2': boto.ec2.connect_to_region,
+    'route53': route53.connect_to_region
+}
+
+
+class BotoBackend(object):
+    """Backend which opens real AWS connections with boto"""
+
+    def connect(self, service, region, profile_name):
+        return CONNECTORS[service](region, profile_name=profile_name)
+
+
+_lock = threading.RLock()
+_backend = BotoBackend()
+_connections = {}
+_call_counts = defaultdict(lambda: defaultdict(int))
+_local = threading.local()
+
+
+def _count_calls(service, conn):
+    """Wraps a connection's make_request so each API call is counted
+
+    Args:
+      service (str): name of the service the connection belongs to
+      conn (AWSAuthConnection): connection to instrument
+    """
+    make_request = conn.make_request
+
+    def counted_make_request(action, *args, **kwargs):
+        with _lock:
+            _call_counts[service][action] += 1
+        thread_counts = getattr(_local, 'call_counts', None)
+        if thread_counts is not None:
+            thread_counts[service][action] += 1
+        return make_request(action, *args, **kwargs)
+
+    conn.make_request = counted_make_request
+
+
+def get_connection(service, region, profile_name):
+    """Returns the shared connection for a service in a region
+
+    Args:
+      service (str): name of the service (e.g. `cloudformation`, `ec2`)
+      region (str): AWS region to connect to
+      profile_name (str): AWS profile to use for authentication
+
+    Returns:
+      boto connection for the service
+    """
+    key = (service, region, profile_name)
+    with _lock:
+        if key not in _connections:
+            conn = _backend.connect(service, region, profile_name)
+            _count_calls(service, conn)
+            _connections[key] = conn
+        return _connections[key]
+
+
+def set_backend(backend):
+    """Replaces the backend used to open connections
+
+    Connections opened through the previous backend are dropped.
+
+    Args:
+      backend: object with a `connect(service, region, profile_name)` method
+        returning a connection that makes its calls through `make_request`
+    """
+    global _backend
+    with _lock:
+        _backend = backend
+        _connections.clear()
+
+
+def get_call_counts():
+    """Returns a copy of the API call counters
+
+    Returns:
+      dict: mapping of service name to a dict of action name and count.
+        REST services such as Route 53 are counted by HTTP method.
+    """
+    with _lock:
+        return {service: dict(actions)
+                for service, actions in _call_counts.iteritems()}
+
+
+@contextmanager
+def counting_calls():
+    """Counts the API calls made by the current thread inside the block
+
+    Yields:
+      dict: mapping of service name to a dict of action name and count,
+        filled in as calls are made
+    """
+    previous = getattr(_local, 'call_counts', None)
+    counts = defaultdict(lambda: defaultdict(int))
+    _local.call_counts = counts
+    try:
+        yield counts
+    finally:
+        _local.call_counts = previous
+        if previous is not None:
+            for service, actions in counts.iteritems():
+                for action, count in actions.iteritems():
+                    previous[service][action] += count
+
+
+def reset():
+    """Drops every registered connection and zeroes the call counters"""
+    with _lock:
+        _connections.clear()
+        _call_counts.clear()
@@ -0,0 +1,560 @@
+"""In-memory stand-in for the AWS APIs used by the stack graph
+
+FakeAWS answers the EC2, CloudFormation and Route 53 calls the stack nodes
+make from local state, so a graph can be planned or run without a network
+connection or an AWS account. It is installed as the backend of the
+connection registry:
+
+    connections.set_backend(FakeAWS.from_file('fixtures.json'))
+
+The state can be seeded from a fixtures file recorded from a real account
+with record_fixtures. Stacks created against the fake take as long as
+their slowest resource, per the configured latencies, and resources can be
+made to fail at random to exercise error handling. Outputs are derived from
+the templates.
+"""
+
+import hashlib
+import json
+import random
+import threading
+import time
+
+from datetime import datetime
+
+from boto.exception import BotoServerError
+
+from connections import BotoBackend
+from spot import TIMESTAMP_FORMAT, get_price_history
+
+
+class Record(object):
+    """Attribute bag standing in for the objects boto returns"""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class ResultSet(list):
+    """List with the pagination token of a boto ResultSet"""
+    next_token = None
+
+
+def fake_id(prefix, *parts):
+    """Returns a stable, AWS-looking ID (e.g. `vpc-1a2b3c4d`)
+
+    Args:
+      prefix (str): prefix of the ID
+      *parts: values the ID is derived from
+    """
+    digest = hashlib.sha1('|'.join(str(part) for part in parts)).hexdigest()
+    return '{}-{}'.format(prefix, digest[:8])
+
+
+def server_error(code, message):
+    """Returns a BotoServerError like the ones raised for failed API calls"""
+    error = BotoServerError(400, 'Bad Request')
+    error.error_code = code
+    error.message = message
+    return error
+
+
+# ID prefixes for the physical IDs of resources in fake stacks
+ID_PREFIXES = {
+    'AWS::EC2::VPC': 'vpc',
+    'AWS::EC2::Subnet': 'subnet',
+    'AWS::EC2::SecurityGroup': 'sg',
+    'AWS::EC2::Instance': 'i',
+    'AWS::EC2::InternetGateway': 'igw',
+    'AWS::EC2::RouteTable': 'rtb',
+    'AWS::EC2::VPCEndpoint': 'vpce'
+}
+
+
+class FakeStack(object):
+    """A CloudFormation stack held by FakeAWS"""
+
+    def __init__(self, name, template_body=None, parameters=None, tags=None,
+                 status='CREATE_COMPLETE', outputs=None):
+        self.stack_name = name
+        self.template_body = template_body
+        self.parameters = dict(parameters or [])
+        self.tags = dict(tags or {})
+        self.stack_status = status
+        self.events = []
+        self.pending_events = []
+        self.duration = 0
+        self.change_sets = {}
+        if outputs is not None:
+            self.output_values = dict(outputs)
+        else:
+            self.output_values = self._derive_outputs()
+
+    @property
+    def outputs(self):
+        return [Record(key=key, value=value)
+                for key, value in sorted(self.output_values.iteritems())]
+
+    @property
+    def resources(self):
+        if self.template_body is None:
+            return {}
+        return json.loads(self.template_body).get('Resources', {})
+
+    def physical_id(self, logical_id):
+        """Returns the fake physical ID of a resource in the stack"""
+        resource_type = self.resources.get(logical_id, {}).get('Type')
+        prefix = ID_PREFIXES.get(resource_type, logical_id.lower())
+        return fake_id(prefix, self.stack_name, logical_id)
+
+    def _resolve(self, value):
+        """Resolves an output value of the template"""
+        if isinstance(value, dict) and 'Ref' in value:
+            ref = value['Ref']
+            if ref in self.parameters:
+                return self.parameters[ref]
+            template = json.loads(self.template_body)
+            if ref in template.get('Parameters', {}):
+                return template['Parameters'][ref].get('Default')
+            return self.physical_id(ref)
+        if isinstance(value, dict) and 'Fn::GetAtt' in value:
+            logical_id, attribute = value['Fn::GetAtt']
+            return fake_id(attribute.lower(), self.stack_name, logical_id)
+        if isinstance(value, dict) and 'Fn::Join' in value:
+            delimiter, values = value['Fn::Join']
+            return delimiter.join(self._resolve(item) for item in values)
+        return value
+
+    def _derive_outputs(self):
+        if self.template_body is None:
+            return {}
+        template = json.loads(self.template_body)
+        return {key: self._resolve(output['Value'])
+                for key, output in template.get('Outputs', {}).iteritems()}
+
+    def schedule_event(self, at, logical_resource_id, resource_type, status,
+                       reason=None):
+        """Schedules an event to happen at a time (in seconds since the epoch)"""
+        sequence = len(self.events) + len(self.pending_events)
+        self.pending_events.append((at, sequence, Record(
+            event_id=fake_id('event', self.stack_name, sequence),
+            stack_name=self.stack_name,
+            logical_resource_id=logical_resource_id,
+            resource_type=resource_type,
+            resource_status=status,
+            resource_status_reason=reason,
+            timestamp=datetime.utcfromtimestamp(at)
+        )))
+        self.pending_events.sort(key=lambda pending: pending[:2])
+
+    def advance(self):
+        """Moves events which are due into the stack's history"""
+        now = time.time()
+        while self.pending_events and self.pending_events[0][0] <= now:
+            _, _, event = self.pending_events.pop(0)
+            self.events.append(event)
+            if (event.resource_type == 'AWS::CloudFormation::Stack' and
+                    event.logical_resource_id == self.stack_name):
+                self.stack_status = event.resource_status
+                if event.resource_status.endswith('_COMPLETE'):
+                    self.output_values = self._derive_outputs()
+
+    def run_operation(self, operation, aws):
+        """Schedules a create or update of every resource
+
+        All of the resources are worked on at once, each taking the latency
+        configured for its type, so the stack finishes with its slowest
+        resource. If a resource fails the stack rolls back.
+
+        Args:
+          operation (str): `CREATE` or `UPDATE`
+          aws (FakeAWS): the fake, for its latencies and failure rate
+        """
+        start = time.time()
+        finish = start
+        failed = False
+        self.schedule_event(start, self.stack_name, 'AWS::CloudFormation::Stack',
+                            operation + '_IN_PROGRESS')
+        for logical_id, resource in sorted(self.resources.iteritems()):
+            resource_type = resource.get('Type')
+            done = start + aws.get_latency(resource_type)
+            finish = max(finish, done)
+            self.schedule_event(start, logical_id, resource_type,
+                                operation + '_IN_PROGRESS')
+            if not failed and aws.rng.random() < aws.failure_rate:
+                failed = True
+                self.schedule_event(done, logical_id, resource_type,
+                                    operation + '_FAILED', 'Simulated failure')
+            else:
+                self.schedule_event(done, logical_id, resource_type,
+                                    operation + '_COMPLETE')
+        if failed:
+            status = 'ROLLBACK_COMPLETE' if operation == 'CREATE' else 'UPDATE_ROLLBACK_COMPLETE'
+        else:
+            status = operation + '_COMPLETE'
+        self.schedule_event(finish, self.stack_name, 'AWS::CloudFormation::Stack',
+                            status)
+        self.duration = finish - start
+        self.advance()
+
+
+class FakeConnection(object):
+    """Base for the fake service connections
+
+    Every API method calls make_request with the name of its action, so
+    the connection registry counts calls to the fake just like real ones.
+    """
+
+    def __init__(self, aws, region):
+        self.aws = aws
+        self.region = region
+
+    def make_request(self, action, *args, **kwargs):
+        if self.aws.api_latency:
+            time.sleep(self.aws.api_latency)
+
+
+class FakeEC2Connection(FakeConnection):
+
+    def get_all_zones(self):
+        self.make_request('DescribeAvailabilityZones')
+        return [Record(name=name, region_name=self.region)
+                for name in self.aws.get_zones(self.region)]
+
+    def get_all_images(self, image_ids=None, owners=None, filters=None):
+        self.make_request('DescribeImages')
+        filters = filters or {}
+        images = []
+        for image in self.aws.images.get(self.region, []):
+            tags = image.get('tags', {})
+            if image_ids and image['id'] not in image_ids:
+                continue
+            if 'tag-key' in filters and filters['tag-key'] not in tags:
+                continue
+            if any(tags.get(key[len('tag:'):]) != value
+                   for key, value in filters.iteritems()
+                   if key.startswith('tag:')):
+                continue
+            images.append(Record(**dict(image, tags=dict(tags))))
+        if not images and self.aws.placeholder_images and 'tag:Name' in filters:
+            tags = {key[len('tag:'):]: value
+                    for key, value in filters.iteritems()
+                    if key.startswith('tag:')}
+            tags['Created'] = '1970-01-01'
+            images.append(Record(
+                id=fake_id('ami', self.region, *sorted(tags.iteritems())),
+                tags=tags,
+                virtualization_type='hvm',
+                sriov_net_support='simple'))
+        elif not images and self.aws.placeholder_images and image_ids:
+            images.extend(Record(id=image_id, tags={}, virtualization_type='hvm',
+                                 sriov_net_support='simple')
+                          for image_id in image_ids)
+        return images
+
+    def get_spot_price_history(self, start_time=None, end_time=None, instance_type=None,
+                               product_description=None, availability_zone=None,
+                               dry_run=False, max_results=None, next_token=None,
+                               filters=None):
+        """Returns the recorded spot prices, whatever their age"""
+        self.make_request('DescribeSpotPriceHistory')
+        return ResultSet([
+            Record(**point) for point in self.aws.spot_prices.get(self.region, [])
+            if instance_type in (None, point['instance_type']) and
+            availability_zone in (None, point['availability_zone'])])
+
+
+class FakeCloudFormationConnection(FakeConnection):
+
+    def _get_stack(self, stack_name):
+        stack = self.aws.stacks.get(self.region, {}).get(stack_name)
+        if stack is None:
+            raise server_error('ValidationError',
+                               'Stack with id {} does not exist'.format(stack_name))
+        stack.advance()
+        return stack
+
+    def describe_stacks(self, stack_name_or_id=None, next_token=None):
+        self.make_request('DescribeStacks')
+        with self.aws.lock:
+            if stack_name_or_id is None:
+                stacks = self.aws.stacks.get(self.region, {}).values()
+                for stack in stacks:
+                    stack.advance()
+                return ResultSet(stacks)
+            return ResultSet([self._get_stack(stack_name_or_id)])
+
+    def describe_stack_events(self, stack_name_or_id=None, next_token=None):
+        self.make_request('DescribeStackEvents')
+        with self.aws.lock:
+            events = list(reversed(self._get_stack(stack_name_or_id).events))
+        start = int(next_token or 0)
+        page = ResultSet(events[start:start + self.aws.page_size])
+        if start + self.aws.page_size < len(events):
+            page.next_token = str(start + self.aws.page_size)
+        return page
+
+    def create_stack(self, stack_name, template_body=None, parameters=None,
+                     tags=None, **kwargs):
+        self.make_request('CreateStack')
+        with self.aws.lock:
+            stacks = self.aws.stacks.setdefault(self.region, {})
+            if stack_name in stacks:
+                raise server_error('AlreadyExistsException',
+                                   'Stack [{}] already exists'.format(stack_name))
+            stack = FakeStack(stack_name, template_body, parameters, tags,
+                              status='CREATE_IN_PROGRESS')
+            stacks[stack_name] = stack
+            stack.run_operation('CREATE', self.aws)
+        return fake_id('stack', self.region, stack_name)
+
+    def update_stack(self, stack_name, template_body=None, parameters=None,
+                     tags=None, use_previous_template=None, **kwargs):
+        self.make_request('UpdateStack')
+        with self.aws.lock:
+            stack = self._get_stack(stack_name)
+            if use_previous_template:
+                template_body = stack.template_body
+            parameters = dict(parameters or [])
+            tags = dict(tags or {})
+            if (template_body == stack.template_body and parameters == stack.parameters and
+                    tags == stack.tags):
+                raise server_error('ValidationError', 'No updates are to be performed.')
+            stack.template_body = template_body
+            stack.parameters = parameters
+            stack.tags = tags
+            stack.run_operation('UPDATE', self.aws)
+        return fake_id('stack', self.region, stack_name)
+
+    def _diff(self, stack, template_body, parameters):
+        """Returns the changes between a stack and a new template
+
+        Resources which are unchanged but refer to a parameter whose value
+        changed are modified too.
+        """
+        old = stack.resources
+        new = json.loads(template_body).get('Resources', {})
+        changed_parameters = [key for key in set(stack.parameters) | set(parameters)
+                              if stack.parameters.get(key) != parameters.get(key)]
+        changes = []
+        for logical_id in sorted(set(old) | set(new)):
+            if logical_id not in old:
+                action = 'Add'
+            elif logical_id not in new:
+                action = 'Remove'
+            elif old[logical_id] != new[logical_id]:
+                action = 'Modify'
+            elif any(json.dumps({'Ref': key}) in json.dumps(new[logical_id])
+                     for key in changed_parameters):
+                action = 'Modify'
+            else:
+                continue
+            resource = new.get(logical_id) or old.get(logical_id)
+            changes.append({'Type': 'Resource', 'ResourceChange': {
+                'Action': action,
+                'LogicalResourceId': logical_id,
+                'ResourceType': resource.get('Type'),
+                'Replacement': 'False'
+            }})
+        return changes
+
+    def _do_request(self, action, params, path, verb):
+        """Answers the CloudFormation calls boto has no method for"""
+        self.make_request(action)
+        with self.aws.lock:
+            stack = self._get_stack(params['StackName'])
+            name = params['ChangeSetName']
+            result = {}
+            if action == 'CreateChangeSet':
+                if name in stack.change_sets:
+                    raise server_error('AlreadyExistsException',
+                                       'ChangeSet {} already exists'.format(name))
+                parameters = {}
+                tags = {}
+                for key, value in params.iteritems():
+                    if key.endswith('.ParameterKey'):
+                        prefix = key[:-len('ParameterKey')]
+                        parameters[value] = params[prefix + 'ParameterValue']
+                    elif key.startswith('Tags.') and key.endswith('.Key'):
+                        tags[value] = params[key[:-len('Key')] + 'Value']
+                changes = self._diff(stack, params['TemplateBody'], parameters)
+                stack.change_sets[name] = {
+                    'ChangeSetName': name,
+                    'StackName': stack.stack_name,
+                    'Status': 'CREATE_COMPLETE' if changes else 'FAILED',
+                    'StatusReason': None if changes else
+                    "The submitted information didn't contain changes.",
+                    'Changes': changes,
+                    'TemplateBody': params['TemplateBody'],
+                    'Parameters': parameters,
+                    'Tags': tags
+                }
+                result = {'Id': fake_id('changeset', stack.stack_name, name)}
+            elif action == 'DescribeChangeSet':
+                change_set = stack.change_sets.get(name)
+                if change_set is None:
+                    raise server_error('ChangeSetNotFound',
+                                       'ChangeSet [{}] does not exist'.format(name))
+                result = {key: value for key, value in change_set.iteritems()
+                          if key not in ('TemplateBody', 'Parameters', 'Tags')}
+            elif action == 'DeleteChangeSet':
+                stack.change_sets.pop(name, None)
+            elif action == 'ExecuteChangeSet':
+                change_set = stack.change_sets.pop(name)
+                stack.template_body = change_set['TemplateBody']
+                stack.parameters = change_set['Parameters']
+                stack.tags = change_set['Tags']
+                stack.change_sets.clear()
+                stack.run_operation('UPDATE', self.aws)
+        return {'{}Response'.format(action): {'{}Result'.format(action): result}}
+
+
+class FakeRoute53Connection(FakeConnection):
+
+    def get_all_hosted_zones(self, start_marker=None, zone_list=None):
+        self.make_request('GET')
+        with self.aws.lock:
+            hosted_zones = [dict(zone) for zone in self.aws.hosted_zones]
+        return {'ListHostedZonesResponse': {'HostedZones': hosted_zones,
+                                            'IsTruncated': 'false'}}
+
+    def create_hosted_zone(self, domain_name, caller_ref=None, comment='',
+                           private_zone=False, vpc_id=None, vpc_region=None):
+        self.make_request('POST')
+        hosted_zone = {
+            'Id': '/hostedzone/{}'.format(
+                fake_id('Z', domain_name, comment).upper().replace('-', '')),
+            'Name': domain_name,
+            'Config': {'Comment': comment,
+                       'PrivateZone': 'true' if private_zone else 'false'},
+            'VPC': {'VPCId': vpc_id, 'VPCRegion': vpc_region}
+        }
+        with self.aws.lock:
+            self.aws.hosted_zones.append(hosted_zone)
+        return {'CreateHostedZoneResponse': {'HostedZone': hosted_zone}}
+
+
+class FakeAWS(object):
+    """Backend for the connection registry which keeps everything in memory
+
+    Regions without recorded availability zones get three (`a`, `b` and
+    `c`).
+    """
+
+    CONNECTIONS = {
+        'cloudformation': FakeCloudFormationConnection,
+        'ec2': FakeEC2Connection,
+        'route53': FakeRoute53Connection
+    }
+
+    def __init__(self, fixtures=None, placeholder_images=False, page_size=100,
+                 latencies=None, api_latency=0, failure_rate=0, seed=None):
+        """
+        Args:
+          fixtures (dict): state to start from, in the format written by
+            record_fixtures
+          placeholder_images (bool): answer image lookups which match nothing
+            with a placeholder image, so graphs can be planned before any
+            AMIs have been built
+          page_size (int): number of stack events per page
+          latencies (dict): seconds each resource type takes to create or
+            update. The `default` key is used for types which aren't listed.
+          api_latency (float): seconds each API call takes
+          failure_rate (float): chance of each resource failing
+          seed: seed for the random failures
+        """
+        fixtures = fixtures or {}
+        self.lock = threading.RLock()
+        self.placeholder_images = placeholder_images
+        self.page_size = page_size
+        self.latencies = latencies or {}
+        self.api_latency = api_latency
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.zones = fixtures.get('zones', {})
+        self.images = fixtures.get('images', {})
+        self.hosted_zones = list(fixtures.get('hosted_zones', []))
+        self.spot_prices = fixtures.get('spot_prices', {})
+        self.stacks = {}
+        for region, stacks in fixtures.get('stacks', {}).iteritems():
+            for stack in stacks:
+                self.stacks.setdefault(region, {})[stack['name']] = FakeStack(
+                    stack['name'], stack.get('template_body'),
+                    tags=stack.get('tags'), status=stack.get('status', 'CREATE_COMPLETE'),
+                    outputs=stack.get('outputs'))
+
+    @classmethod
+    def from_file(cls, fixtures_path, **kwargs):
+        """Creates a FakeAWS from a fixtures file written by record_fixtures"""
+        with open(fixtures_path, 'r') as f:
+            return cls(json.load(f), **kwargs)
+
+    def get_latency(self, resource_type):
+        return self.latencies.get(resource_type, self.latencies.get('default', 0))
+
+    def get_zones(self, region):
+        if region in self.zones:
+            return self.zones[region]
+        return [region + suffix for suffix in 'abc']
+
+    def connect(self, service, region, profile_name):
+        return self.CONNECTIONS[service](self, region)
+
+
+def record_fixtures(region, profile_name, instance_types=()):
+    """Records the state FakeAWS needs from a real AWS account
+
+    Availability zones, tagged AMIs owned by the account, hosted zones, the
+    stacks in the region and the recent spot prices of some instance types
+    are recorded. Connections are made directly with boto, rather than
+    through the registry, so recording works while a FakeAWS backend is
+    installed.
+
+    Args:
+      region (str): AWS region to record
+      profile_name (str): AWS profile to use for authentication
+      instance_types (list): instance types to record spot prices for
+
+    Returns:
+      dict: fixtures which can be saved as JSON and passed to FakeAWS
+    """
+    boto_backend = BotoBackend()
+    ec2_conn = boto_backend.connect('ec2', region, profile_name)
+    cfn_conn = boto_backend.connect('cloudformation', region, profile_name)
+    route53_conn = boto_backend.connect('route53', region, profile_name)
+
+    images = ec2_conn.get_all_images(owners='self',
+                                     filters={'tag-key': 'Created'})
+    hosted_zones = route53_conn.get_all_hosted_zones()
+    zones = [zone.name for zone in ec2_conn.get_all_zones()]
+    spot_prices = get_price_history(ec2_conn, instance_types, zones)
+    stacks = []
+    next_token = None
+    while True:
+        page = cfn_conn.describe_stacks(next_token=next_token)
+        stacks.extend(page)
+        next_token = page.next_token
+        if not next_token:
+            break
+
+    return {
+        'zones': {region: zones},
+        'images': {region: [{'id': image.id,
+                             'tags': dict(image.tags),
+                             'virtualization_type': image.virtualization_type,
+                             'sriov_net_support': image.sriov_net_support}
+                            for image in images]},
+        'hosted_zones': hosted_zones['ListHostedZonesResponse']['HostedZones'],
+        'spot_prices': {region: [{'instance_type': instance_type,
+                                  'availability_zone': zone,
+                                  'price': price,
+                                  'timestamp': timestamp.strftime(TIMESTAMP_FORMAT)}
+                                 for (instance_type, zone), points in sorted(spot_prices.iteritems())
+                                 for timestamp, price in points]},
+        'stacks': {region: [{'name': stack.stack_name,
+                             'status': stack.stack_status,
+                             'tags': dict(stack.tags),
+                             'outputs': {output.key: output.value
+                                         for output in stack.outputs}}
+                            for stack in stacks]}
+    }
@@ -4,12 +4,20 @@ from troposphere import (
     Parameter,
     Tags,
     Ref,
-    Base64,
+    Join,
+    Output,
+    Select,
     ec2)
 
+import cloud_config
+import spot
 import template_utils as utils
 import troposphere.autoscaling as asg
 
+from boto.exception import BotoServerError
+
+from connections import get_connection
+
 
 class MesosFollower(utils.GTStackNode):
     """Stack node for mesos follower machines
@@ -19,37 +27,171 @@ class MesosFollower(utils.GTStackNode):
 
     Most of the configuration comes from the `geotrellis-cluster.config`
     file; however, it does depend on a few outputs from the VPC stack
+
+    Followers are launched by a single auto scaling group unless they are
+    given several instance types (`MesosFollowerInstanceTypes`) or zones
+    (`MesosFollowerZones`), in which case they are spread over spot pools
+    chosen by `spot.choose_pools`, each with a group of its own. The VPC
+    stack gives them a subnet in each zone, in `MesosSubnet`. The pools are
+    recorded in the `SpotPools` output and kept by later launches, unless
+    `rechoose_spot_pools` is set.
+
+    The user data of each instance type sets up its instance store disks,
+    see `cloud_config`.
+
+    With `MesosPlacementGroup` set, the followers are launched into the
+    VPC stack's cluster placement group, EBS-optimized where their
+    instance type allows, from an AMI with enhanced networking.
     """
 
     INPUTS = {
         'NameSpace': ['global:NameSpace'],
-        'AvailabilityZone': ['VPC:AvailabilityZone'],
         'Tags': ['global:Tags'],
         'Region': ['global:Region'],
         'StackType': ['global:StackType'],
         'KeyName': ['global:KeyName'],
         'IPAccess': ['global:IPAccess'],
-        'PrivateHostedZoneId': ['VPC:PrivateHostedZoneId'],
+        'PrivateHostedZoneId': ['R53PrivateHostedZone:PrivateHostedZoneId'],
         'MesosFollowerAMI': ['global:MesosFollowerAMI'],
+        'AMICacheTTL': ['global:AMICacheTTL'],
         'NumFollowers': ['global:NumFollowers'],
+        'MesosFollowerMinSize': ['global:MesosFollowerMinSize'],
+        'MesosFollowerMaxSize': ['global:MesosFollowerMaxSize'],
         'MesosFollowerInstanceProfile': ['global:MesosFollowerInstanceProfile'],
         'MesosFollowerSpotPrice': ['global:MesosFollowerSpotPrice'],
         'MesosSubnet': ['VPC:MesosSubnet'],
         'MesosFollowerInstanceType': ['global:MesosFollowerInstanceType'],
+        'MesosFollowerInstanceTypes': ['global:MesosFollowerInstanceTypes'],
+        'MesosFollowerPools': ['global:MesosFollowerPools'],
+        'MesosFollowerDiskLayout': ['global:MesosFollowerDiskLayout'],
+        'MesosFollowerFilesystem': ['global:MesosFollowerFilesystem'],
+        'MesosPlacementGroup': ['global:MesosPlacementGroup'],
+        'PlacementGroup': ['VPC:PlacementGroup'],
+        'FollowerZones': ['VPC:FollowerZones'],
         'VpcId': ['global:VpcId', 'VPC:VpcId']
     }
 
     ATTRIBUTES = {'NameSpace': 'NameSpace'}
 
+    OUTPUTS = ('MesosFollowerGroup', 'SpotPools')
+
     DEFAULTS = {
         'Tags': {},
         'MesosFollowerSpotPrice': None,
         'NumFollowers': '2',
-        'MesosFollowerAMI': None
+        'MesosFollowerMinSize': None,
+        'MesosFollowerMaxSize': None,
+        'MesosFollowerInstanceTypes': None,
+        'MesosFollowerPools': None,
+        'MesosFollowerDiskLayout': 'jbod',
+        'MesosFollowerFilesystem': 'ext4',
+        'MesosPlacementGroup': 'none',
+        'PlacementGroup': None,
+        'MesosFollowerAMI': None,
+        'AMICacheTTL': '0'
     }
 
     MACHINE_TYPE = 'mesos-follower'
     AMI_INPUT = 'MesosFollowerAMI'
+    USER_DATA = 'cloud-config/%s-follower.yml'
+
+    # choose the spot pools from the current prices even if the stack has some
+    rechoose_spot_pools = False
+
+    @property
+    def spot_pools(self):
+        """Pools the followers are spread over, or None for a single group
+
+        The pools of the deployed stack which can still be used are kept,
+        with the followers split between them again, so a change in spot
+        prices doesn't replace groups. New pools are chosen if there are
+        none, or if rechoose_spot_pools is set.
+        """
+        if getattr(self, '_spot_pools', False) is not False:
+            return self._spot_pools
+        instance_types = spot.parse_instance_types(
+            self.get_input('MesosFollowerInstanceTypes') or
+            self.get_input('MesosFollowerInstanceType'))
+        zones = self.get_input('FollowerZones').split(',')
+        if len(instance_types) == 1 and len(zones) == 1:
+            self._spot_pools = None
+            return None
+
+        capacity = float(self.get_input('NumFollowers'))
+        if not self.rechoose_spot_pools:
+            deployed = self.deployed_spot_pools(instance_types, zones)
+            if deployed:
+                self.logger.info('%s keeps the spot pools of the deployed stack',
+                                 self.stack_name)
+                self._spot_pools = spot.split_capacity(deployed, capacity)
+                return self._spot_pools
+
+        spot_price = self.get_input('MesosFollowerSpotPrice')
+        history = {}
+        if spot_price:
+            with self.span('spot_prices'):
+                conn = get_connection('ec2', self.get_input('Region'), self.aws_profile)
+                history = spot.get_price_history(
+                    conn, [instance_type for instance_type, _ in instance_types], zones)
+        max_pools = self.get_input('MesosFollowerPools')
+        self._spot_pools = spot.choose_pools(
+            instance_types, zones, history,
+            float(spot_price) if spot_price else None,
+            capacity,
+            max_pools=int(max_pools) if max_pools else None)
+        return self._spot_pools
+
+    def deployed_spot_pools(self, instance_types, zones):
+        """Pools recorded in the `SpotPools` output of the deployed stack
+
+        Args:
+          instance_types (list): (instance type, weight) tuples
+          zones (list): names of the availability zones followers can run in
+
+        Returns:
+          list: the SpotPools which can still be used, empty if the stack
+            doesn't exist or has none
+        """
+        conn = get_connection('cloudformation', self.get_input('Region'), self.aws_profile)
+        try:
+            stack = conn.describe_stacks(self.stack_name)[0]
+        except BotoServerError:
+            return []
+        outputs = dict((output.key, output.value) for output in stack.outputs)
+        if not outputs.get('SpotPools'):
+            return []
+        return spot.parse_pools(outputs['SpotPools'], instance_types, zones)
+
+    def instance_user_data(self, instance_type):
+        """Compressed user data for followers of an instance type"""
+        return cloud_config.follower_user_data(
+            self.user_data, instance_type,
+            layout=self.get_input('MesosFollowerDiskLayout'),
+            filesystem=self.get_input('MesosFollowerFilesystem'))
+
+    @property
+    def in_placement_group(self):
+        return self.get_input('MesosPlacementGroup') != 'none'
+
+    def launch_config_network_args(self, instance_type):
+        """Launch configuration properties for the network mode of an instance type"""
+        if self.in_placement_group and utils.is_ebs_optimizable(instance_type):
+            return {'EbsOptimized': True}
+        return {}
+
+    def _fingerprint_extras(self):
+        extras = super(MesosFollower, self)._fingerprint_extras()
+        extras['spot_pools'] = spot.format_pools(self.spot_pools or [])
+        extras['instance_store_script'] = utils.read_file(cloud_config.INSTANCE_STORE_SCRIPT)
+        return extras
+
+    def plan(self):
+        plan = super(MesosFollower, self).plan()
+        if self.spot_pools:
+            plan['detail'] += ', {} pools: {}'.format(len(self.spot_pools), ', '.join(
+                '{}x {} in {}'.format(pool.instances, pool.instance_type, pool.zone)
+                for pool in self.spot_pools))
+        return plan
 
     def set_up_stack(self):
         self.region = self.get_input('Region')
@@ -89,7 +231,7 @@ class MesosFollower(utils.GTStackNode):
 
         mesos_follower_subnet_param = self.add_parameter(Parameter(
             'MesosSubnet', Type='CommaDelimitedList',
-            Description='A list of subnets to associate with the Mesos leaders'
+            Description='Subnet of each zone the Mesos followers are spread over'
         ), source='MesosSubnet')
 
         mesos_follower_security_group = self.add_resource(ec2.SecurityGroup(
@@ -110,6 +252,7 @@ class MesosFollower(utils.GTStackNode):
                     IpProtocol='tcp', CidrIp=utils.VPC_CIDR, FromPort=0, ToPort=65535
                 )
             ] + [
+                # S3 included, through the VPC's endpoint if it has one
                 ec2.SecurityGroupRule(IpProtocol='tcp', CidrIp=utils.ALLOW_ALL_CIDR,
                                       FromPort=p, ToPort=p)
                 for p in [80, 443]
@@ -121,67 +264,103 @@ class MesosFollower(utils.GTStackNode):
             AssociatePublicIpAddress=True,
             ImageId=self.ami,
             IamInstanceProfile=Ref(mesos_follower_instance_profile_param),
-            InstanceType=Ref(mesos_follower_instance_type_param),
             KeyName=Ref(keyname_param),
-            SecurityGroups=[Ref(mesos_follower_security_group)],
-            UserData=Base64(utils.read_file('cloud-config/%s-follower.yml' % self.get_input('StackType')))
+            SecurityGroups=[Ref(mesos_follower_security_group)]
         )
 
+        extra_group_args = {}
+        if self.in_placement_group:
+            self.check_ami_enhanced_networking()
+            placement_group_param = self.add_parameter(Parameter(
+                'PlacementGroup', Type='String',
+                Description='Cluster placement group of the Mesos followers'
+            ), source='PlacementGroup')
+            extra_group_args['PlacementGroup'] = Ref(placement_group_param)
+
         mesos_follower_spot_price = self.get_input('MesosFollowerSpotPrice')
+
+        if self.spot_pools:
+            self.set_up_spot_pools(extra_launch_config_args, mesos_follower_spot_price,
+                                   mesos_follower_subnet_param, extra_group_args)
+            return
+
         if mesos_follower_spot_price:
             extra_launch_config_args['SpotPrice'] = mesos_follower_spot_price
 
+        instance_type = self.get_input('MesosFollowerInstanceType')
         mesos_follower_launch_config = self.add_resource(asg.LaunchConfiguration(
             'lcMesosFollower',
-            BlockDeviceMappings=[
-                {
-                    "DeviceName": "/dev/sdb",
-                    "VirtualName": "ephemeral0"
-                },
-                {
-                    "DeviceName": "/dev/sdc",
-                    "VirtualName": "ephemeral1"
-                },
-                {
-                    "DeviceName": "/dev/sdd",
-                    "VirtualName": "ephemeral2"
-                },
-                {
-                    "DeviceName": "/dev/sde",
-                    "VirtualName": "ephemeral3"
-                },
-                {
-                    "DeviceName": "/dev/sdf",
-                    "VirtualName": "ephemeral4"
-                },
-                {
-                    "DeviceName": "/dev/sdg",
-                    "VirtualName": "ephemeral5"
-                },
-                {
-                    "DeviceName": "/dev/sdh",
-                    "VirtualName": "ephemeral6"
-                },
-                {
-                    "DeviceName": "/dev/sdi",
-                    "VirtualName": "ephemeral7"
-                }
-            ],
-            **extra_launch_config_args
+            BlockDeviceMappings=utils.get_block_device_mappings(instance_type),
+            InstanceType=Ref(mesos_follower_instance_type_param),
+            UserData=self.instance_user_data(instance_type),
+            **dict(extra_launch_config_args, **self.launch_config_network_args(instance_type))
         ))
 
-        availability_zone = self.get_input('AvailabilityZone')
         num_followers = self.get_input('NumFollowers')
-        self.add_resource(asg.AutoScalingGroup(
+        # the autoscaling controller moves the desired capacity between these
+        min_followers = self.get_input('MesosFollowerMinSize') or num_followers
+        max_followers = self.get_input('MesosFollowerMaxSize') or num_followers
+        self.create_resource(asg.AutoScalingGroup(
             'asgMesosFollower',
-            AvailabilityZones=[availability_zone],
+            AvailabilityZones=self.get_input('FollowerZones').split(','),
             Cooldown=300,
             DesiredCapacity=num_followers,
             HealthCheckGracePeriod=600,
             HealthCheckType='EC2',
             LaunchConfigurationName=Ref(mesos_follower_launch_config),
-            MaxSize=num_followers,
-            MinSize=num_followers,
+            MaxSize=max_followers,
+            MinSize=min_followers,
             VPCZoneIdentifier=Ref(mesos_follower_subnet_param),
-            Tags=[asg.Tag('Name', 'MesosFollower', True)]
-        ))
+            Tags=[asg.Tag('Name', 'MesosFollower', True)],
+            **extra_group_args
+        ), output='MesosFollowerGroup')
+
+    def set_up_spot_pools(self, launch_config_args, spot_price, subnets_param, group_args):
+        """Adds a launch configuration for each instance type and a group for each pool
+
+        Args:
+          launch_config_args (dict): properties every launch configuration shares
+          spot_price (str): bid for one unit of capacity, or None for
+            on-demand instances
+          subnets_param (Parameter): subnet of each follower zone, in the
+            order of `FollowerZones`
+          group_args (dict): properties every auto scaling group shares
+        """
+        zones = self.get_input('FollowerZones').split(',')
+
+        launch_configs = {}
+        groups = []
+        for pool in self.spot_pools:
+            type_name = pool.instance_type.title().replace('.', '')
+            if pool.instance_type not in launch_configs:
+                args = dict(launch_config_args,
+                            **self.launch_config_network_args(pool.instance_type))
+                if spot_price:
+                    args['SpotPrice'] = '{:.4f}'.format(float(spot_price) * pool.weight)
+                launch_configs[pool.instance_type] = self.add_resource(asg.LaunchConfiguration(
+                    'lcMesosFollower{}'.format(type_name),
+                    BlockDeviceMappings=utils.get_block_device_mappings(pool.instance_type),
+                    InstanceType=pool.instance_type,
+                    UserData=self.instance_user_data(pool.instance_type),
+                    **args
+                ))
+
+            groups.append(self.add_resource(asg.AutoScalingGroup(
+                'asgMesosFollower{}{}'.format(type_name, pool.zone.title().replace('-', '')),
+                AvailabilityZones=[pool.zone],
+                Cooldown=300,
+                DesiredCapacity=pool.instances,
+                HealthCheckGracePeriod=600,
+                HealthCheckType='EC2',
+                LaunchConfigurationName=Ref(launch_configs[pool.instance_type]),
+                MaxSize=pool.instances,
+                MinSize=pool.instances,
+                VPCZoneIdentifier=[Select(zones.index(pool.zone), Ref(subnets_param))],
+                Tags=[asg.Tag('Name', 'MesosFollower', True),
+                      asg.Tag('SpotPool', '{} {}'.format(pool.instance_type, pool.zone), True)],
+                **group_args
+            )))
+
+        self.add_output(Output('MesosFollowerGroup',
+                               Value=Join(',', [Ref(group) for group in groups])))
+        self.add_output(Output('SpotPools', Value=spot.format_pools(self.spot_pools)))
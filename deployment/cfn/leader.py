@@ -1,6 +1,7 @@
 from troposphere import (
     Parameter,
     Ref,
+    Select,
     GetAtt,
     Tags,
     Base64,
@@ -8,6 +9,9 @@ from troposphere import (
 
 import template_utils as utils
 import troposphere.route53 as r53
+import yaml
+
+from spot import parse_instance_types
 
 
 class MesosLeader(utils.GTStackNode):
@@ -22,21 +26,51 @@ class MesosLeader(utils.GTStackNode):
         'Region': ['global:Region'],
         'PrivateHostedZoneId': ['R53PrivateHostedZone:PrivateHostedZoneId'],
         'MesosLeaderAMI': ['global:MesosLeaderAMI'],
+        'AMICacheTTL': ['global:AMICacheTTL'],
         'MesosLeaderInstanceProfile': ['global:MesosLeaderInstanceProfile'],
         'MesosSubnet': ['VPC:MesosSubnet'],
         'MesosLeaderInstanceType': ['global:MesosLeaderInstanceType'],
+        'MesosFollowerInstanceType': ['global:MesosFollowerInstanceType'],
+        'MesosFollowerInstanceTypes': ['global:MesosFollowerInstanceTypes'],
+        'MesosPlacementGroup': ['global:MesosPlacementGroup'],
+        'PlacementGroup': ['VPC:PlacementGroup'],
         'VpcId': ['global:VpcId', 'VPC:VpcId']
     }
 
     DEFAULTS = {
         'Tags': {},
-        'MesosLeaderAMI': None
+        'MesosLeaderAMI': None,
+        'MesosFollowerInstanceTypes': None,
+        'MesosPlacementGroup': 'none',
+        'PlacementGroup': None,
+        'AMICacheTTL': '0'
     }
 
     ATTRIBUTES = {'NameSpace': 'NameSpace'}
 
+    OUTPUTS = ()
+
     MACHINE_TYPE = 'mesos-leader'
     AMI_INPUT = 'MesosLeaderAMI'
+    USER_DATA = 'cloud-config/%s-leader.yml'
+
+    @property
+    def user_data(self):
+        """Adds a command sizing the Spark drivers' executors for the followers
+
+        Executors are sized for the smallest follower instance type. The
+        cloud-config is loaded, the command appended to its `runcmd` and
+        the result dumped again.
+        """
+        instance_types = parse_instance_types(
+            self.get_input('MesosFollowerInstanceTypes') or
+            self.get_input('MesosFollowerInstanceType'))
+        executor_type = min(instance_types, key=lambda (_, weight): weight)[0]
+        cloud_config = yaml.safe_load(super(MesosLeader, self).user_data) or {}
+        cloud_config.setdefault('runcmd', []).append(
+            ['/usr/local/bin/spark-profile', executor_type])
+        return '#cloud-config\n' + yaml.safe_dump(cloud_config, default_flow_style=None,
+                                                  width=1000)
 
     def set_up_stack(self):
         self.region = self.get_input('Region')
@@ -81,7 +115,7 @@ class MesosLeader(utils.GTStackNode):
 
         mesos_leader_subnet_param = self.add_parameter(Parameter(
             'MesosSubnet', Type='CommaDelimitedList',
-            Description='A list of subnets to associate with the Mesos leaders'
+            Description='Subnet of each follower zone, the first of which the leader is in'
         ), source='MesosSubnet')
 
         mesos_leader_security_group = self.add_resource(ec2.SecurityGroup(
@@ -119,8 +153,21 @@ class MesosLeader(utils.GTStackNode):
         ))
 
 
+        # With MesosPlacementGroup set to cluster the leader joins the
+        # followers' placement group, and as it runs off of EBS it is
+        # EBS-optimized where its type allows it
+        extra_instance_args = {}
+        if self.get_input('MesosPlacementGroup') == 'cluster':
+            self.check_ami_enhanced_networking()
+            if utils.is_ebs_optimizable(self.get_input('MesosLeaderInstanceType')):
+                extra_instance_args['EbsOptimized'] = True
+            placement_group_param = self.add_parameter(Parameter(
+                'PlacementGroup', Type='String',
+                Description='Cluster placement group of the Mesos leader and followers'
+            ), source='PlacementGroup')
+            extra_instance_args['PlacementGroupName'] = Ref(placement_group_param)
+
         ## EC2 Instance Resources
-        mesos_subnet = self.get_input('MesosSubnet')
         mesos_leader_instance = self.create_resource(ec2.Instance(
             'MesosLeader',
             BlockDeviceMappings=[
@@ -137,14 +184,16 @@ class MesosLeader(utils.GTStackNode):
                 ec2.NetworkInterfaceProperty(
                     Description='ENI for MesosLeader',
                     GroupSet=[Ref(mesos_leader_security_group)],
-                    SubnetId=mesos_subnet,
+                    # the first of the follower subnets, in the first zone
+                    SubnetId=Select(0, Ref(mesos_leader_subnet_param)),
                     AssociatePublicIpAddress=True,
                     DeviceIndex=0,
                     DeleteOnTermination=True,
                 )
             ],
-            UserData=Base64(utils.read_file('cloud-config/%s-leader.yml' % self.get_input('StackType'))),
-            Tags=Tags(Name='MesosLeader')
+            UserData=Base64(self.user_data),
+            Tags=Tags(Name='MesosLeader'),
+            **extra_instance_args
         ))
 
         ## Route 53 Resources
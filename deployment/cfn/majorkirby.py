@@ -1,16 +1,20 @@
 """TODO REPLACE WITH MAJOR KIRBY FROM GITHUB"""
 
 import sys
+import threading
+import Queue
 
-from time import sleep
+from time import sleep, time
 
 from collections import OrderedDict
+from contextlib import contextmanager
 
 import hashlib
+import inspect
 import json
 import logging
+import os
 
-from boto import cloudformation
 from boto.exception import BotoServerError
 
 from troposphere import (
@@ -20,6 +24,8 @@ from troposphere import (
     Tags
 )
 
+from connections import counting_calls, get_connection
+
 # global across stacks per run
 
 
@@ -31,6 +37,26 @@ stdout_handler.setLevel(logging.DEBUG)
 default_logger.addHandler(stdout_handler)
 default_logger.setLevel(logging.DEBUG)
 
+# resource statuses which doom the stack they belong to
+RESOURCE_FAILED_STATUSES = ('CREATE_FAILED', 'UPDATE_FAILED')
+# stack statuses which end a run
+COMPLETE_STATUSES = ('CREATE_COMPLETE', 'UPDATE_COMPLETE')
+# a stack whose last update rolled back is stable and can be updated again,
+# so it is only a failure when the update was started by this run
+ROLLED_BACK_STATUS = 'UPDATE_ROLLBACK_COMPLETE'
+FAILED_STATUSES = RESOURCE_FAILED_STATUSES + (
+    'ROLLBACK_IN_PROGRESS',
+    'ROLLBACK_FAILED',
+    'ROLLBACK_COMPLETE',
+    'DELETE_IN_PROGRESS',
+    'DELETE_FAILED',
+    'DELETE_COMPLETE',
+    'UPDATE_ROLLBACK_IN_PROGRESS',
+    'UPDATE_ROLLBACK_FAILED',
+    'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS',
+    ROLLED_BACK_STATUS
+)
+
 
 class MKInputError(Exception):
     """
@@ -68,6 +94,264 @@ class MKNoSuchInputError(MKInputError):
     pass
 
 
+class MKUpdateError(Exception):
+    """
+    An error indicating a change set for a stack update could not be
+    created.
+    """
+    pass
+
+
+class MKGraphError(Exception):
+    """
+    An error in the structure of a graph of nodes, found before any node
+    is run.
+    """
+    pass
+
+
+class MKCycleError(MKGraphError):
+    """
+    An error indicating the input connections of a graph form a cycle.
+    """
+    pass
+
+
+class MKDanglingInputError(MKGraphError):
+    """
+    An error indicating none of an input's addresses point at a connected
+    node which provides the output, and the input has no default.
+    """
+    pass
+
+
+class TemplateCache(object):
+    """
+    A local, content-addressed cache of rendered templates.
+    Template bodies are stored under the hash of the body and its resolved
+    parameters. An index maps each stack name to the fingerprint of the
+    inputs it was last rendered from and the resulting template hash, so a
+    node whose inputs have not changed can skip rendering entirely.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+          path (str): Directory to keep the cache in
+        """
+        self.path = path
+        self.index_path = os.path.join(path, 'index.json')
+        self.lock = threading.Lock()
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, stack_name, fingerprint):
+        """
+        Looks up the template last rendered for a stack.
+        Args:
+          stack_name (str): Name of the stack
+          fingerprint (str): Fingerprint of the stack's current inputs
+        Returns:
+          dict: The cached entry (template_hash, region, parameters) if it
+            was rendered from the same inputs and its body is still cached,
+            otherwise None
+        """
+        with self.lock:
+            entry = self._read_index().get(stack_name)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return None
+        if not os.path.exists(self.body_path(entry['template_hash'])):
+            return None
+        return entry
+
+    def body_path(self, template_hash):
+        return os.path.join(self.path, '{}.json'.format(template_hash))
+
+    def get_body(self, template_hash):
+        with open(self.body_path(template_hash), 'r') as f:
+            return f.read()
+
+    def put(self, stack_name, fingerprint, template_hash, template_body,
+            region, parameters):
+        """
+        Stores a rendered template and records it in the index.
+        """
+        with self.lock:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(self.body_path(template_hash), 'w') as f:
+                f.write(template_body)
+            index = self._read_index()
+            index[stack_name] = {'fingerprint': fingerprint,
+                                 'template_hash': template_hash,
+                                 'region': region,
+                                 'parameters': parameters}
+            with open(self.index_path, 'w') as f:
+                json.dump(index, f, indent=2, sort_keys=True)
+
+
+template_cache = TemplateCache(os.path.expanduser('~/.majorkirby/templates'))
+
+
+def hash_template(template_body, parameters):
+    """
+    Returns:
+      str: A digest of a template body and the parameters it is run with
+    """
+    h = hashlib.sha256(template_body)
+    h.update(json.dumps(sorted(parameters)))
+    return h.hexdigest()
+
+
+def stack_tags(stack):
+    """
+    Returns the tags of a described stack as a dict. boto leaves `tags`
+    as an empty list, rather than an empty Tag, when a stack has no tags.
+    Args:
+      stack (Stack): The described stack
+    Returns:
+      dict: Tag keys and values
+    """
+    return dict(stack.tags or {})
+
+
+def describe_change(change):
+    """
+    Describes a change of a change set, such as `Replace Instance
+    (AWS::EC2::Instance)`. Modifications which replace the resource, or
+    may, are called out.
+    Args:
+      change (dict): A change from the DescribeChangeSet result
+    Returns:
+      str: The action, logical ID and type of the changed resource
+    """
+    resource_change = change['ResourceChange']
+    action = resource_change['Action']
+    if action == 'Modify' and resource_change.get('Replacement') == 'True':
+        action = 'Replace'
+    elif action == 'Modify' and resource_change.get('Replacement') == 'Conditional':
+        action = 'Modify (may replace)'
+    return '{} {} ({})'.format(action, resource_change['LogicalResourceId'],
+                               resource_change['ResourceType'])
+
+
+class StackStatusTracker(object):
+    """
+    Tracks the status of a CloudFormation stack by tailing its event stream.
+    Each poll only fetches the events newer than the last one seen, and the
+    delay before the next poll backs off while the stack is quiet (an ASG
+    waiting on instances, for example) and resets as soon as events arrive.
+    The first resource failure is reported immediately rather than waiting
+    for the rollback to finish.
+    """
+
+    STACK_RESOURCE_TYPE = 'AWS::CloudFormation::Stack'
+
+    MIN_INTERVAL = 2
+    MAX_INTERVAL = 30
+    BACKOFF = 1.5
+
+    def __init__(self, boto_conn, stack_name, status=None, min_interval=None,
+                 max_interval=None, backoff=None):
+        """
+        Args:
+          boto_conn (CloudFormationConnection): Connection to poll with
+          stack_name (str): Name of the stack to track
+          status (str): Last known status of the stack, if any
+          min_interval (float): Seconds to wait after new events arrive.
+            Defaults to MIN_INTERVAL.
+          max_interval (float): Longest to wait between polls. Defaults to
+            MAX_INTERVAL.
+          backoff (float): Factor to grow the wait by after a quiet poll.
+            Defaults to BACKOFF.
+        """
+        self.boto_conn = boto_conn
+        self.stack_name = stack_name
+        self.status = status
+        self.failed_event = None
+        self.last_event_id = None
+        self.min_interval = min_interval or self.MIN_INTERVAL
+        self.max_interval = max_interval or self.MAX_INTERVAL
+        self.backoff = backoff or self.BACKOFF
+        self.interval = self.min_interval
+
+    @property
+    def finished(self):
+        return (self.failed_event is not None or
+                self.status in COMPLETE_STATUSES or
+                self.status in FAILED_STATUSES)
+
+    def _new_events(self):
+        """
+        Fetches the events since the last poll. On the first poll only the
+        most recent page is read, which is enough to learn the current
+        status without walking the stack's whole history.
+        Returns:
+          list: New StackEvents, oldest first
+        """
+        events = []
+        next_token = None
+        while True:
+            page = self.boto_conn.describe_stack_events(self.stack_name,
+                                                        next_token)
+            for event in page:
+                if event.event_id == self.last_event_id:
+                    return list(reversed(events))
+                events.append(event)
+            next_token = page.next_token
+            if self.last_event_id is None or not next_token:
+                return list(reversed(events))
+
+    def start(self, status):
+        """
+        Moves the cursor past every existing event and sets a new status,
+        so that a stack being updated isn't taken as finished by the events
+        of its previous operation.
+        Args:
+          status (str): The status of the operation which is starting
+        """
+        events = self._new_events()
+        if events:
+            self.last_event_id = events[-1].event_id
+        self.status = status
+        self.failed_event = None
+        self.interval = self.min_interval
+
+    def poll(self):
+        """
+        Reads new events and updates the status and polling interval.
+        Returns:
+          str: The stack status, or the status of the first failed resource
+        """
+        if self.finished:
+            return self.get_status()
+        events = self._new_events()
+        for event in events:
+            if (event.resource_type == self.STACK_RESOURCE_TYPE and
+                    event.logical_resource_id == self.stack_name):
+                self.status = event.resource_status
+            elif (event.resource_status in RESOURCE_FAILED_STATUSES and
+                    self.failed_event is None):
+                self.failed_event = event
+        if events:
+            self.last_event_id = events[-1].event_id
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff,
+                                self.max_interval)
+        return self.get_status()
+
+    def get_status(self):
+        if self.failed_event is not None:
+            return self.failed_event.resource_status
+        return self.status
+
+
 class StackNode(Template):
     """
     A node in an acyclic directed graph of cloudformation stacks which feed
@@ -85,11 +369,18 @@ class StackNode(Template):
     unless it is required elsewhere.
     DEFAULT can contain default values for the inputs should they not be
     able to be resolved.
+    OUTPUTS can list the names of the outputs a node provides, which lets
+    compile_graph reject addresses that could never resolve. If it is left
+    as None the node's outputs are not checked.
     """
 
     INPUTS = {}
     DEFAULTS = {}
     ATTRIBUTES = {}
+    OUTPUTS = None
+
+    # Seconds to wait for CloudFormation to work out a change set
+    CHANGE_SET_TIMEOUT = 600
 
     NAME = ''
 
@@ -121,10 +412,22 @@ class StackNode(Template):
         self.state = self.states.IDLE
         self.should_run = False
         self.input_wiring = {}
+        self.resolution_plan = None
+        self.resolved_inputs = {}
         self.last_heartbeat_id = None
         self.boto_conn = None
+        self.stack = None
+        self.status_tracker = None
+        self.template_hash = None
+        self.needs_update = False
+        self.update_started = False
+        self.apply_updates = True
+        self.confirm_update = None
         self.stack_outputs = {}
         self.extra_outputs = {}
+        self.wait_started = None
+        self.spans = []
+        self.api_calls = {}
         self.stack_name = self.get_stack_name()
         self.aws_profile = kwargs.get('aws_profile', 'default')
 
@@ -167,6 +470,92 @@ class StackNode(Template):
             raise MKNoSuchOutputError
         return self.input_connections[input_connection].stack_outputs[varname]
 
+    def connected_nodes(self):
+        """
+        Returns:
+          list: The distinct nodes connected to this node's inputs
+        """
+        nodes = []
+        for connection in self.input_connections.itervalues():
+            if isinstance(connection, StackNode) and connection not in nodes:
+                nodes.append(connection)
+        return nodes
+
+    def declared_outputs(self):
+        """
+        Returns:
+          set: The names of the outputs this node provides, or None if they
+            are not known before the node runs
+        """
+        if self.OUTPUTS is None:
+            return None
+        return set(self.OUTPUTS)
+
+    def compile_inputs(self):
+        """
+        Validates every input address against the connected nodes and
+        records, for each input, the (connection name, node, output name)
+        sources which can actually provide it. Addresses pointing at a
+        missing connection or an undeclared output are dropped with a
+        warning.
+        Raises:
+          MKDanglingInputError: if none of an input's addresses are valid
+            and it has no default
+        """
+        plan = {}
+        for input_name, input_addresses in self.inputs.iteritems():
+            sources = []
+            dangling = []
+            for input_address in input_addresses:
+                connection_name, varname = input_address.split(':', 1)
+                connection = self.input_connections.get(connection_name)
+                if not isinstance(connection, StackNode):
+                    dangling.append(input_address)
+                    continue
+                outputs = connection.declared_outputs()
+                if outputs is not None and varname not in outputs:
+                    dangling.append(input_address)
+                    continue
+                sources.append((connection_name, connection, varname))
+            if not sources and input_name not in self.defaults:
+                raise MKDanglingInputError(
+                    '{} input {} cannot be resolved from {}'.format(
+                        self.get_stack_name(False), input_name,
+                        ', '.join(input_addresses)))
+            if dangling:
+                self.logger.warning('%s input %s ignores unresolvable %s',
+                                    self.get_stack_name(False), input_name,
+                                    ', '.join(dangling))
+            plan[input_name] = sources
+        self.resolution_plan = plan
+        self.resolved_inputs = {}
+
+    def _get_planned_input(self, input_name):
+        """
+        Resolves an input from the compiled plan. Values provided by
+        finished nodes can no longer change, so they are remembered and
+        later lookups are a single dict hit.
+        Args:
+          input_name (str): The name of the input
+        Returns:
+          object: The resolved input
+        """
+        if input_name in self.resolved_inputs:
+            return self.resolved_inputs[input_name]
+        sources = self.resolution_plan[input_name]
+        for _, connection, varname in sources:
+            if varname in connection.stack_outputs:
+                value = connection.stack_outputs[varname]
+                if connection.state == self.states.FINISHED:
+                    self.resolved_inputs[input_name] = value
+                return value
+        if input_name not in self.defaults:
+            raise MKUnresolvableInputError
+        if all(connection.state == self.states.FINISHED
+               for _, connection, _ in sources):
+            self.resolved_inputs[input_name] = self.defaults[input_name]
+        return self.defaults[input_name]
+
     def get_input(self, input_name):
         """
         Resolve a named input by cycling through its list and returning
@@ -178,6 +567,8 @@ class StackNode(Template):
         """
         if input_name not in self.inputs:
             raise MKNoSuchInputError
+        if self.resolution_plan is not None:
+            return self._get_planned_input(input_name)
         for input_address in self.inputs[input_name]:
             try:
                 return self.get_from_input_address(input_address)
@@ -196,6 +587,8 @@ class StackNode(Template):
           logger: The logger from the 'logger' input if set, otherwise the
             default logger
         """
+        if 'logger' not in self.inputs:
+            return default_logger
         try:
             return self.get_input('logger')
         except MKInputError:
@@ -206,6 +599,9 @@ class StackNode(Template):
         Cycle through all the inputs to find which connected nodes need to
         be run
         """
+        if self.resolution_plan is not None:
+            self._calc_planned_dependencies()
+            return
         for input_name, input_addresses in self.INPUTS.iteritems():
             try:
                 self.get_input(input_name)
@@ -220,6 +616,25 @@ class StackNode(Template):
                             self.requires.append(dependency)
                             break
 
+    def _calc_planned_dependencies(self):
+        """
+        Finds the nodes which need to be run using the compiled plan. For
+        each input which can't be resolved yet, the first source which has
+        not finished is required.
+        """
+        for input_name, sources in self.resolution_plan.iteritems():
+            try:
+                self.get_input(input_name)
+                continue
+            except MKInputError:
+                pass
+            for connection_name, connection, _ in sources:
+                if connection.state >= self.states.FINISHED:
+                    continue
+                if connection_name not in self.requires:
+                    self.requires.append(connection_name)
+                break
+
     def set_up_stack(self):
         """
         This method should be overridden to set up the stack.
@@ -265,16 +680,55 @@ class StackNode(Template):
 
     def go(self):
         """
-        Run the stack and the stacks this stack depends on. Calls .heartbeat
-        down the graph every ten seconds until the state is FINISHED or
-        FAILED.
+        Run the stack and the stacks this stack depends on. Independent
+        stacks are launched concurrently by a GraphExecutor, which returns
+        once every node in the graph is FINISHED or FAILED.
+        Returns:
+          bool: True if every node in the graph finished
+        """
+        return GraphExecutor([self]).run()
+
+    def run(self, poll_interval=10):
+        """
+        Launch this stack and block until it is FINISHED or FAILED. The
+        stacks this node requires must already have finished.
+        The time spent waiting to run (since wait_started), launching and
+        polling is recorded in spans, and the API calls made in api_calls.
+        Args:
+          poll_interval (int): Seconds to sleep between status checks
+        Returns:
+          int: The final state of the node
+        """
+        if self.wait_started is not None:
+            self.spans.append(('wait', self.wait_started, time()))
+        with counting_calls() as counts:
+            try:
+                self._launch_cfn()
+                self.state = self.states.RUNNING
+                with self.span('poll'):
+                    while self._poll() < self.states.FINISHED:
+                        if self.status_tracker is not None:
+                            sleep(self.status_tracker.interval)
+                        else:
+                            sleep(poll_interval)
+            finally:
+                self.api_calls = {service: dict(actions)
+                                  for service, actions in counts.iteritems()}
+        return self.state
+
+    @contextmanager
+    def span(self, name):
         """
-        n = 1
-        self.heartbeat(0)
-        while self.state < self.states.FINISHED:
-            sleep(10)
-            self.heartbeat(n)
-            n += 1
+        Records the time spent in the block as a span of the node's
+        timeline.
+        Args:
+          name (str): Name of the phase (e.g. `render`)
+        """
+        start = time()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start, time()))
 
     @property
     def suffix(self):
@@ -305,39 +759,342 @@ class StackNode(Template):
         else:
             return name
 
-    def _launch_cfn(self):
+    def _fingerprint_extras(self):
         """
-        Sets up stack and launches it.
+        This method can be overridden to return a dict of anything besides
+        the inputs and source code that set_up_stack renders from, such as
+        looked-up IDs or the contents of files.
+        """
+        return {}
+
+    def input_fingerprint(self):
+        """
+        Returns a digest of everything the rendered template depends on:
+        the resolved inputs, the source of the node's class hierarchy and
+        any extras from _fingerprint_extras.
+        Returns:
+          str: Fingerprint of the node's inputs
+        """
+        values = {}
+        for input_name in self.inputs:
+            try:
+                values[input_name] = self.get_input(input_name)
+            except MKInputError:
+                values[input_name] = None
+        h = hashlib.sha256(json.dumps(values, sort_keys=True, default=repr))
+        h.update(json.dumps(self._fingerprint_extras(), sort_keys=True,
+                            default=repr))
+        for cls in inspect.getmro(self.__class__):
+            if issubclass(cls, StackNode):
+                with open(inspect.getsourcefile(cls), 'r') as f:
+                    h.update(f.read())
+        return h.hexdigest()
+
+    def _render(self):
+        """
+        Sets up the stack and renders the template and its parameters.
+        Returns:
+          tuple: template body and a list of (parameter, value) pairs
         """
         self.set_up_stack()
-        self.boto_conn = cloudformation.connect_to_region(region_name=self.region,
-                                                          profile_name=self.aws_profile)
         parameters = []
         for param, input_name in self.input_wiring.iteritems():
             try:
-                parameters.append((param, self.get_input(input_name)))
+                parameters.append((param, self.get_parameter_value(input_name)))
             except MKInputError:
                 pass
-        # check to see if stack exists
+        return self.to_json(), parameters
+
+    def get_parameter_value(self, input_name):
+        """
+        Returns the value passed to the template parameters wired to an
+        input. This can be overridden for inputs which are looked up when
+        left blank, so the parameter carries the value actually used.
+        Args:
+          input_name (str): The name of the input
+        Returns:
+          object: The parameter value
+        """
+        return self.get_input(input_name)
+
+    def _launch_cfn(self):
+        """
+        Sets up stack and launches it.
+        Templates are cached locally by the fingerprint of their inputs, so
+        an unchanged node is not rendered again. If the deployed stack was
+        created from the same template and parameters, it is left alone and
+        its outputs are collected without waiting on it. If it was created
+        from a different template it is flagged as needing an update. A
+        stack without a TemplateHash tag predates the tag, so its changes
+        are only previewed, whatever apply_updates says.
+        """
+        with self.span('render'):
+            fingerprint = self.input_fingerprint()
+            cached = template_cache.get(self.stack_name, fingerprint)
+            if cached is not None:
+                self.region = cached['region']
+                self.template_hash = cached['template_hash']
+                template_body = template_cache.get_body(self.template_hash)
+                parameters = [tuple(parameter) for parameter in cached['parameters']]
+            else:
+                template_body, parameters = self._render()
+                self.template_hash = hash_template(template_body, parameters)
+                template_cache.put(self.stack_name, fingerprint,
+                                   self.template_hash, template_body,
+                                   self.region, parameters)
+        self.boto_conn = get_connection('cloudformation', self.region,
+                                        self.aws_profile)
+        with self.span('create'):
+            # check to see if stack exists
+            try:
+                self.stack = self.boto_conn.describe_stacks(self.stack_name)[0]
+                status = self.stack.stack_status
+            except BotoServerError:
+                # it would be great if we could more granularly check the error
+                self.boto_conn.create_stack(self.stack_name,
+                                            tags=self.get_raw_tags(TemplateHash=self.template_hash),
+                                            template_body=template_body,
+                                            parameters=parameters)
+                self.logger.info('Stack %s created', self.stack_name)
+                status = 'CREATE_IN_PROGRESS'
+            else:
+                template_hash = stack_tags(self.stack).get('TemplateHash')
+                if template_hash == self.template_hash:
+                    self.logger.info('Stack %s is up to date', self.stack_name)
+                elif template_hash is None:
+                    self.needs_update = True
+                    self.logger.info('Stack %s has no TemplateHash tag, so its '
+                                     'changes will only be previewed',
+                                     self.stack_name)
+                else:
+                    self.needs_update = True
+                    self.logger.info('Stack %s was created from a different '
+                                     'template and needs an update',
+                                     self.stack_name)
+        self.status_tracker = StackStatusTracker(self.boto_conn,
+                                                 self.stack_name,
+                                                 status=status)
+        if self.needs_update:
+            if status in COMPLETE_STATUSES + (ROLLED_BACK_STATUS,):
+                with self.span('update'):
+                    tagged = 'TemplateHash' in stack_tags(self.stack)
+                    self._update_cfn(template_body, parameters,
+                                     self.apply_updates and tagged)
+            else:
+                self.logger.warning('Stack %s is %s, not updating it',
+                                    self.stack_name, status)
+
+    def placeholder_outputs(self):
+        """
+        Returns stand-ins for the outputs of a stack which doesn't exist
+        yet. Outputs whose value is rendered into the template as a literal
+        keep that value, the rest become `<Node:Output>`.
+        Returns:
+          dict: Output names and their placeholder values
+        """
+        outputs = {}
+        for name in self.declared_outputs() or ():
+            outputs[name] = '<{}:{}>'.format(self.get_stack_name(False), name)
+        for name, output in self.outputs.iteritems():
+            value = output.properties.get('Value')
+            if not isinstance(value, basestring):
+                value = '<{}:{}>'.format(self.get_stack_name(False), name)
+            outputs[name] = value
+        return outputs
+
+    def plan(self):
+        """
+        Works out what launching this stack would do without changing
+        anything. The template is rendered and compared with the deployed
+        stack by its TemplateHash tag. The node is then marked FINISHED with
+        the deployed stack's outputs, or placeholders for outputs which
+        don't exist yet, so that the nodes connected to it can be planned.
+        Returns:
+          dict: The node, its stack name, the action (`create`, `update` or
+            `none`), the template body, its size and resource count, and the
+            parameter wiring. Each parameter takes the value of the input
+            wired to it or, if that doesn't resolve, the template's default.
+        """
+        template_body, parameters = self._render()
+        self.template_hash = hash_template(template_body, parameters)
+        self.boto_conn = get_connection('cloudformation', self.region,
+                                        self.aws_profile)
+        outputs = self.placeholder_outputs()
         try:
             self.stack = self.boto_conn.describe_stacks(self.stack_name)[0]
         except BotoServerError:
-            # it would be great if we could more granularly check the error
-            self.boto_conn.create_stack(self.stack_name,
-                                        tags=self.get_raw_tags(),
-                                        template_body=self.to_json(),
-                                        parameters=parameters)
-            self.logger.info('Stack %s created', self.stack_name)
+            action = 'create'
+        else:
+            if stack_tags(self.stack).get('TemplateHash') == self.template_hash:
+                action = 'none'
+            else:
+                action = 'update'
+            outputs.update((output.key, output.value)
+                           for output in self.stack.outputs)
+        self.stack_outputs = outputs
+        self._custom_output_transform()
+        self.state = self.states.FINISHED
 
-    def _check_cfn(self):
+        values = dict(parameters)
+        wiring = []
+        for param, input_name in sorted(self.input_wiring.iteritems()):
+            wiring.append({
+                'parameter': param,
+                'input': input_name,
+                'value': values.get(param, self.parameters[param].properties.get('Default')),
+                'default': param not in values
+            })
+        return {'node': self.get_stack_name(False),
+                'stack_name': self.stack_name,
+                'action': action,
+                'detail': None,
+                'template_body': template_body,
+                'template_size': len(template_body),
+                'resources': len(self.resources),
+                'parameters': wiring}
+
+    def _cfn_request(self, action, params):
+        """
+        Makes a CloudFormation API call which boto has no method for.
+        Args:
+          action (str): Name of the API action (e.g. `CreateChangeSet`)
+          params (dict): Parameters of the call
+        Returns:
+          dict: The result element of the JSON response
+        """
+        params = dict(params, ContentType='JSON')
+        response = self.boto_conn._do_request(action, params, '/', 'POST')
+        result = response['{}Response'.format(action)]
+        return result.get('{}Result'.format(action)) or {}
+
+    def _create_change_set(self, change_set_name, template_body, parameters):
+        """
+        Creates a change set from the template and waits until CloudFormation
+        has worked out its changes.
+        Returns:
+          dict: The DescribeChangeSet result, with the changes of every page
+        """
+        params = {'StackName': self.stack_name,
+                  'ChangeSetName': change_set_name,
+                  'TemplateBody': template_body}
+        for i, (key, value) in enumerate(parameters):
+            params['Parameters.member.%d.ParameterKey' % (i + 1)] = key
+            params['Parameters.member.%d.ParameterValue' % (i + 1)] = value
+        tags = self.get_raw_tags(TemplateHash=self.template_hash)
+        for i, (key, value) in enumerate(tags.iteritems()):
+            params['Tags.member.%d.Key' % (i + 1)] = key
+            params['Tags.member.%d.Value' % (i + 1)] = value
+        try:
+            self._cfn_request('CreateChangeSet', params)
+        except BotoServerError as e:
+            if e.error_code != 'AlreadyExistsException':
+                raise
+            # left over from an earlier preview of the same template
+            self._cfn_request('DeleteChangeSet', {
+                'StackName': self.stack_name, 'ChangeSetName': change_set_name})
+            self._cfn_request('CreateChangeSet', params)
+
+        describe_params = {'StackName': self.stack_name,
+                           'ChangeSetName': change_set_name}
+        deadline = time() + self.CHANGE_SET_TIMEOUT
+        interval = StackStatusTracker.MIN_INTERVAL
+        while True:
+            change_set = self._cfn_request('DescribeChangeSet', describe_params)
+            if change_set['Status'] in ('CREATE_COMPLETE', 'FAILED'):
+                break
+            if time() >= deadline:
+                raise MKUpdateError('{}: change set {} is still {} after {}s'.format(
+                    self.stack_name, change_set_name, change_set['Status'],
+                    self.CHANGE_SET_TIMEOUT))
+            sleep(interval)
+            interval = min(interval * StackStatusTracker.BACKOFF,
+                           StackStatusTracker.MAX_INTERVAL)
+        changes = list(change_set.get('Changes') or [])
+        next_token = change_set.get('NextToken')
+        while next_token:
+            page = self._cfn_request('DescribeChangeSet', dict(
+                describe_params, NextToken=next_token))
+            changes.extend(page.get('Changes') or [])
+            next_token = page.get('NextToken')
+        change_set['Changes'] = changes
+        return change_set
+
+    def _update_cfn(self, template_body, parameters, apply_updates=True):
+        """
+        Updates the deployed stack in place through a change set. The
+        resources the change set adds, modifies, replaces and removes are
+        logged, and only that diff is applied. If apply_updates is False, or
+        confirm_update is set and doesn't approve it, the change set is left
+        for review rather than executed. A change set without changes only
+        records the new TemplateHash.
         """
-        Checks the status of the stack
+        change_set_name = 'majorkirby-{}'.format(self.template_hash[:16])
+        change_set = self._create_change_set(change_set_name, template_body,
+                                             parameters)
+        if change_set['Status'] == 'FAILED':
+            reason = change_set.get('StatusReason') or ''
+            self._cfn_request('DeleteChangeSet', {
+                'StackName': self.stack_name, 'ChangeSetName': change_set_name})
+            if "didn't contain changes" in reason or 'No updates' in reason:
+                self.logger.info('Stack %s has no changes to apply',
+                                 self.stack_name)
+                self._update_template_hash(parameters)
+                return
+            raise MKUpdateError('{}: {}'.format(self.stack_name, reason))
+
+        for change in change_set['Changes']:
+            self.logger.info('%s %s', self.stack_name, describe_change(change))
+
+        if not apply_updates or (
+                self.confirm_update is not None and
+                not self.confirm_update(self, change_set_name, change_set['Changes'])):
+            self.logger.info('Change set %s left on %s for review',
+                             change_set_name, self.stack_name)
+            return
+        self.status_tracker.start('UPDATE_IN_PROGRESS')
+        self.update_started = True
+        self._cfn_request('ExecuteChangeSet', {
+            'StackName': self.stack_name, 'ChangeSetName': change_set_name})
+        self.logger.info('Stack %s updating', self.stack_name)
+
+    def _update_template_hash(self, parameters):
+        """
+        Tags a stack whose template renders differently but deploys the
+        same with the new TemplateHash, through an update which keeps the
+        previous template, so later runs find it up to date.
         """
+        if not self.apply_updates:
+            return
+        try:
+            self.boto_conn.update_stack(
+                self.stack_name, use_previous_template=True,
+                parameters=parameters,
+                tags=self.get_raw_tags(TemplateHash=self.template_hash))
+        except BotoServerError as e:
+            if 'No updates' not in (e.message or ''):
+                raise
+            return
+        self.status_tracker.start('UPDATE_IN_PROGRESS')
+        self.update_started = True
+        self.logger.info('Stack %s TemplateHash updated', self.stack_name)
 
-        self.stack = self.boto_conn.describe_stacks(self.stack_name)[0]
-        self.logger.debug('%s %s', self.stack_name,
-                                self.stack.stack_status)
-        return self.stack.stack_status
+    def _check_cfn(self):
+        """
+        Checks the status of the stack by tailing its events. The stack is
+        only described again once it completes, to collect its outputs.
+        """
+        status = self.status_tracker.poll()
+        self.logger.debug('%s %s', self.stack_name, status)
+        if self.status_tracker.failed_event is not None:
+            event = self.status_tracker.failed_event
+            self.logger.error('%s %s %s: %s', self.stack_name,
+                              event.logical_resource_id,
+                              event.resource_status,
+                              event.resource_status_reason)
+        if status in COMPLETE_STATUSES and (
+                self.stack is None or self.stack.stack_status != status):
+            self.stack = self.boto_conn.describe_stacks(self.stack_name)[0]
+        return status
 
     def _assign_outputs(self):
         """
@@ -386,14 +1143,31 @@ class StackNode(Template):
                 self._launch_cfn()
                 self.state = self.states.RUNNING
         if self.state == self.states.RUNNING:
-            status = self._check_cfn()
-            if status == 'ROLLBACK_COMPLETE':
-                self.logger.error('%s failed', self.stack_name)
-                self.state = self.states.FAILED
-            elif status == 'CREATE_COMPLETE' or status == 'UPDATE_COMPLETE':
-                self._assign_outputs()
-                self.logger.info('%s finished', self.stack_name)
-                self.state = self.states.FINISHED
+            self._poll()
+        return self.state
+
+    def _poll(self):
+        """
+        Checks the status of a running stack once and moves the node to
+        FINISHED or FAILED if the stack has reached a terminal state. A
+        stack left rolled back by an earlier update, which this run didn't
+        touch, is taken as finished.
+        Returns:
+          int: The state of the node
+        """
+        status = self._check_cfn()
+        if status == ROLLED_BACK_STATUS and not self.update_started:
+            self._assign_outputs()
+            self.logger.warning('%s is %s from an earlier update',
+                                self.stack_name, status)
+            self.state = self.states.FINISHED
+        elif status in FAILED_STATUSES:
+            self.logger.error('%s failed', self.stack_name)
+            self.state = self.states.FAILED
+        elif status in COMPLETE_STATUSES:
+            self._assign_outputs()
+            self.logger.info('%s finished', self.stack_name)
+            self.state = self.states.FINISHED
         return self.state
 
     def get_raw_tags(self, **kwargs):
@@ -410,6 +1184,190 @@ class StackNode(Template):
         return Tags(self.get_raw_tags(**kwargs))
 
 
+def compile_graph(sinks):
+    """
+    Validates a graph before anything is run. Every node reachable from the
+    sinks has its inputs compiled into a resolution plan, and the input
+    connections are checked for cycles.
+    Args:
+      sinks (list): The StackNodes at the ends of the graph
+    Returns:
+      list: Every reachable node, each listed after the nodes it is
+        connected to
+    Raises:
+      MKCycleError: if the input connections form a cycle
+      MKDanglingInputError: if an input can never be resolved
+    """
+    ordered = []
+    visiting = []
+
+    def visit(node):
+        if node in ordered:
+            return
+        if node in visiting:
+            cycle = visiting[visiting.index(node):] + [node]
+            raise MKCycleError(' -> '.join(n.get_stack_name(False)
+                                           for n in cycle))
+        visiting.append(node)
+        for connection in node.connected_nodes():
+            visit(connection)
+        visiting.pop()
+        node.compile_inputs()
+        ordered.append(node)
+
+    for sink in sinks:
+        visit(sink)
+    return ordered
+
+
+def _collect_nodes(sinks):
+    """
+    Walks the graph from the sinks, calculating the requirements of each
+    node. Connected nodes which are not required, because their outputs are
+    supplied elsewhere, are left out.
+    Args:
+      sinks (list): The StackNodes at the ends of the graph
+    Returns:
+      list: Every node which needs to run, in discovery order
+    """
+    nodes = []
+    to_visit = list(sinks)
+    while to_visit:
+        node = to_visit.pop(0)
+        if node in nodes or node.state >= node.states.FINISHED:
+            continue
+        nodes.append(node)
+        if node.state == node.states.IDLE:
+            node._calc_dependencies()
+            node.state = node.states.WAITING
+        for required in node.requires:
+            to_visit.append(node.input_connections[required])
+    return nodes
+
+
+class GraphExecutor(object):
+    """
+    Runs one or more StackNode graphs as a single merged graph.
+    The graph is walked from the supplied sink nodes, and every node whose
+    requirements have finished is launched immediately on a pool of worker
+    threads. Wall-clock time for a run is therefore bounded by the critical
+    path through the graph rather than the sum of every stack.
+    A node shared by several sinks (a VPC, for example) is only run once.
+    """
+
+    def __init__(self, sinks, max_workers=None, poll_interval=10):
+        """
+        Args:
+          sinks (list): The StackNodes to run, along with everything they
+            depend on
+          max_workers (int): Maximum number of nodes in flight at once. If
+            left blank every ready node is launched at once.
+          poll_interval (int): Seconds between status checks of running nodes
+        """
+        self.sinks = list(sinks)
+        self.poll_interval = poll_interval
+        self.order = compile_graph(self.sinks)
+        self.nodes = _collect_nodes(self.sinks)
+        self.max_workers = max_workers or max(len(self.nodes), 1)
+
+    def _ready_nodes(self, waiting):
+        """
+        Removes and returns the nodes in waiting whose requirements have all
+        finished. Nodes with a failed requirement are marked FAILED and
+        removed as well, which in turn fails anything waiting on them.
+        Args:
+          waiting (list): Nodes which have not been launched yet
+        Returns:
+          list: Nodes which can be launched now
+        """
+        ready = []
+        changed = True
+        while changed:
+            changed = False
+            for node in list(waiting):
+                requirements = [node.input_connections[required]
+                                for required in node.requires]
+                states = [requirement.state for requirement in requirements]
+                if node.states.FAILED in states:
+                    node.logger.error('%s skipped, a stack it requires failed',
+                                      node.stack_name)
+                    node.state = node.states.FAILED
+                    waiting.remove(node)
+                    changed = True
+                elif all(state == node.states.FINISHED for state in states):
+                    waiting.remove(node)
+                    ready.append(node)
+        return ready
+
+    def _work(self, work_queue, done_queue):
+        """
+        Worker thread loop. Runs nodes off of the work queue until it
+        receives None.
+        """
+        while True:
+            node = work_queue.get()
+            if node is None:
+                return
+            try:
+                node.run(self.poll_interval)
+            except Exception:
+                node.logger.exception('%s raised an error', node.stack_name)
+                node.state = node.states.FAILED
+            done_queue.put(node)
+
+    def run(self):
+        """
+        Runs every node in the graph, returning once they are all FINISHED
+        or FAILED.
+        Returns:
+          bool: True if every node finished
+        """
+        work_queue = Queue.Queue()
+        done_queue = Queue.Queue()
+        workers = [threading.Thread(target=self._work,
+                                    args=(work_queue, done_queue))
+                   for _ in range(self.max_workers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        waiting = list(self.nodes)
+        started = time()
+        for node in waiting:
+            node.wait_started = started
+        in_flight = 0
+        try:
+            while True:
+                for node in self._ready_nodes(waiting):
+                    work_queue.put(node)
+                    in_flight += 1
+                if in_flight == 0:
+                    break
+                done_queue.get()
+                in_flight -= 1
+        finally:
+            for _ in workers:
+                work_queue.put(None)
+        return all(node.state == node.states.FINISHED for node in self.nodes)
+
+    def plan(self):
+        """
+        Plans every node in the graph instead of running it. Nodes are
+        planned one at a time in dependency order, so each sees the
+        (placeholder) outputs of the nodes it requires.
+        Returns:
+          list: The plan of each node which reports one
+        """
+        plans = []
+        for node in self.order:
+            if node not in self.nodes:
+                continue
+            plan = node.plan()
+            if plan is not None:
+                plans.append(plan)
+        return plans
+
+
 class GlobalConfigNode(StackNode):
     """
     Node to hold config options
@@ -441,7 +1399,16 @@ class NullNode(StackNode):
         return "CREATE_COMPLETE"
 
     def _calc_dependencies(self):
-        self.requires = self.input_connections.keys()
+        self.requires = [name for name, connection in
+                         self.input_connections.iteritems()
+                         if isinstance(connection, StackNode)]
+
+    def declared_outputs(self):
+        return set(self.input_connections)
+
+    def plan(self):
+        self._custom_output_transform()
+        self.state = self.states.FINISHED
 
     def _custom_output_transform(self):
         self.stack_outputs = {}
@@ -451,7 +1418,8 @@ class NullNode(StackNode):
 
 class CustomActionNode(StackNode):
     def _launch_cfn(self):
-        self.action()
+        with self.span('action'):
+            self.action()
 
     def action(self):
         """
@@ -462,6 +1430,30 @@ class CustomActionNode(StackNode):
         """
         pass
 
+    def plan_action(self):
+        """
+        Override this method to describe what action would do, without
+        doing it. It should set self.stack_outputs like action does, using
+        placeholders for anything which doesn't exist yet.
+        Returns:
+          tuple: The action (`create`, `update`, `none` or `run`) and a
+            description of it, or None
+        """
+        self.stack_outputs = self.placeholder_outputs()
+        return 'run', None
+
+    def plan(self):
+        action, detail = self.plan_action()
+        self.state = self.states.FINISHED
+        return {'node': self.get_stack_name(False),
+                'stack_name': self.stack_name,
+                'action': action,
+                'detail': detail,
+                'template_body': None,
+                'template_size': None,
+                'resources': None,
+                'parameters': []}
+
     def _check_cfn(self):
         """
         Indicate that the action has completed.
@@ -1,5 +1,4 @@
-from boto import route53
-
+from connections import get_connection
 from majorkirby import CustomActionNode
 
 import json
@@ -21,19 +20,27 @@ class R53PrivateHostedZone(CustomActionNode):
 
     ATTRIBUTES = {'NameSpace': 'NameSpace'}
 
-    def action(self):
-        self.region = self.get_input('Region')
-        conn = route53.connect_to_region(self.region,
-                                         profile_name=self.aws_profile)
-        comment = json.dumps(self.get_raw_tags())
+    OUTPUTS = ('PrivateHostedZoneId',)
 
+    def _find_hosted_zone(self, conn, comment):
+        """Returns the ID of the hosted zone created for this node, if any"""
         hosted_zones = conn.get_all_hosted_zones()
 
         for hosted_zone in hosted_zones['ListHostedZonesResponse']['HostedZones']:
             if ('Comment' in hosted_zone['Config'] and
                     hosted_zone['Config']['Comment'] == comment):
-                self.stack_outputs = {'PrivateHostedZoneId': hosted_zone['Id'].split('/')[-1]}
-                return
+                return hosted_zone['Id'].split('/')[-1]
+        return None
+
+    def action(self):
+        self.region = self.get_input('Region')
+        conn = get_connection('route53', self.region, self.aws_profile)
+        comment = json.dumps(self.get_raw_tags())
+
+        hosted_zone_id = self._find_hosted_zone(conn, comment)
+        if hosted_zone_id is not None:
+            self.stack_outputs = {'PrivateHostedZoneId': hosted_zone_id}
+            return
 
         hosted_zone = conn.create_hosted_zone(self.get_input('PrivateHostedZoneName'),
                                               comment=comment,
@@ -42,3 +49,17 @@ class R53PrivateHostedZone(CustomActionNode):
                                               vpc_region=self.region)
         hosted_zone_id = hosted_zone['CreateHostedZoneResponse']['HostedZone']['Id']
         self.stack_outputs = {'PrivateHostedZoneId': hosted_zone_id.split('/')[-1]}
+
+    def plan_action(self):
+        self.region = self.get_input('Region')
+        conn = get_connection('route53', self.region, self.aws_profile)
+        comment = json.dumps(self.get_raw_tags())
+
+        hosted_zone_id = self._find_hosted_zone(conn, comment)
+        if hosted_zone_id is not None:
+            self.stack_outputs = {'PrivateHostedZoneId': hosted_zone_id}
+            return 'none', 'hosted zone {} exists'.format(hosted_zone_id)
+
+        self.stack_outputs = self.placeholder_outputs()
+        return 'create', 'private hosted zone {} in {}'.format(
+            self.get_input('PrivateHostedZoneName'), self.get_input('VpcId'))
@@ -0,0 +1,22 @@
+"""CloudFormation resource types troposphere doesn't have yet"""
+
+from troposphere import AWSObject
+
+
+class PlacementGroup(AWSObject):
+    type = 'AWS::EC2::PlacementGroup'
+
+    props = {
+        'Strategy': (basestring, False),
+    }
+
+
+class VPCEndpoint(AWSObject):
+    type = 'AWS::EC2::VPCEndpoint'
+
+    props = {
+        'PolicyDocument': (dict, False),
+        'RouteTableIds': (list, False),
+        'ServiceName': (basestring, True),
+        'VpcId': (basestring, True),
+    }
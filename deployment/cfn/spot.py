@@ -0,0 +1,265 @@
+"""Chooses the spot pools the Mesos followers are spread over
+
+A spot pool is an instance type in an availability zone, and each pool is
+priced, and reclaimed, independently of the others. Followers can be given
+a set of equivalent instance types, each with a weight: the capacity one
+instance provides, in followers of the smallest type, which defaults to
+its share of vCPUs from the instance catalog. Every pool of those
+types in the follower zones is scored from its recent price history:
+
+  - price: median price per unit of capacity
+  - interruption risk: share of the history during which the price was
+    above the bid for the pool, the spot price per unit times the weight
+
+Pools that are too risky are left out, and the rest are picked cheapest
+first while spreading over as many zones and instance types as possible.
+The capacity is split evenly between the chosen pools, so when one pool
+dries up the cluster loses a fraction of its capacity rather than all of
+it.
+
+Each pool gets an auto scaling group of its own, so choosing different
+pools replaces groups, and the instance store data of their followers
+with them. The chosen pools are recorded on the follower stack (see
+format_pools) so later launches can keep them.
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from template_utils import GTCloudFormationException, get_instance_spec
+
+
+PRODUCT_DESCRIPTION = 'Linux/UNIX (Amazon VPC)'
+HISTORY_DAYS = 7
+MAX_INTERRUPTION_RISK = 0.1
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+SpotPool = namedtuple('SpotPool', ['instance_type', 'zone', 'weight', 'price',
+                                   'interruption_risk', 'instances'])
+
+
+def parse_instance_types(value):
+    """Parses a list of instance types and their weights
+
+    A weight left out is worked out from the catalog, as the instance
+    type's vCPUs over those of the smallest type in the list. A weight
+    given must be within a factor of two of that, so a typo can't put
+    several times the intended capacity into one pool.
+
+    Args:
+      value (str): comma separated `type:weight` pairs, e.g.
+        `r3.2xlarge:1,r3.4xlarge:2`
+
+    Returns:
+      list: (instance type, weight) tuples
+
+    Raises:
+      GTCloudFormationException: if a type isn't in the catalog or a weight
+        doesn't match it
+    """
+    items = []
+    for item in value.split(','):
+        item = item.strip()
+        if item:
+            instance_type, _, weight = item.partition(':')
+            items.append((instance_type, get_instance_spec(instance_type), weight, item))
+    if not items:
+        return []
+
+    smallest = min(spec['vcpus'] for _, spec, _, _ in items)
+    instance_types = []
+    for instance_type, spec, weight, item in items:
+        expected = spec['vcpus'] / float(smallest)
+        try:
+            weight = float(weight) if weight else expected
+        except ValueError:
+            weight = 0
+        if not expected / 2 <= weight <= expected * 2:
+            raise GTCloudFormationException(
+                'Weight of {} does not match the {} vCPUs of {} (expected about {:g})'.format(
+                    item, spec['vcpus'], instance_type, expected))
+        instance_types.append((instance_type, weight))
+    return instance_types
+
+
+def _parse_timestamp(timestamp):
+    return datetime.strptime(timestamp[:19], TIMESTAMP_FORMAT)
+
+
+def get_price_history(conn, instance_types, zones, days=HISTORY_DAYS):
+    """Fetches the recent spot prices of instance types in some zones
+
+    Args:
+      conn (EC2Connection): connection to the region of the zones
+      instance_types (list): instance types to fetch prices for
+      zones (list): names of the availability zones to keep prices for
+      days (int): days of history to fetch
+
+    Returns:
+      dict: (instance type, zone) to a list of (timestamp, price) tuples,
+        oldest first
+    """
+    end = datetime.utcnow()
+    start = end - timedelta(days=days)
+    history = {}
+    for instance_type in instance_types:
+        next_token = None
+        while True:
+            page = conn.get_spot_price_history(
+                start_time=start.strftime(TIMESTAMP_FORMAT),
+                end_time=end.strftime(TIMESTAMP_FORMAT),
+                instance_type=instance_type,
+                product_description=PRODUCT_DESCRIPTION,
+                next_token=next_token)
+            for point in page:
+                if point.availability_zone in zones:
+                    history.setdefault((instance_type, point.availability_zone), []).append(
+                        (_parse_timestamp(point.timestamp), point.price))
+            next_token = getattr(page, 'next_token', None)
+            if not next_token:
+                break
+    for points in history.itervalues():
+        points.sort()
+    return history
+
+
+def score_pool(points, bid, end):
+    """Works out the median price of a pool and how often it was outbid
+
+    Each price holds from its timestamp until the next one, and the last
+    until `end`.
+
+    Args:
+      points (list): (timestamp, price) tuples, oldest first
+      bid (float): bid for an instance in the pool
+      end (datetime): end of the history
+
+    Returns:
+      tuple: (median price, share of the time the price was above the bid)
+    """
+    prices = sorted(price for _, price in points)
+    median = prices[len(prices) // 2]
+    total = 0.0
+    above = 0.0
+    for (timestamp, price), (next_timestamp, _) in zip(points, points[1:] + [(end, None)]):
+        held = max((next_timestamp - timestamp).total_seconds(), 0)
+        total += held
+        if price > bid:
+            above += held
+    if not total:
+        return median, float(points[-1][1] > bid)
+    return median, above / total
+
+
+def choose_pools(instance_types, zones, history, bid_per_unit, capacity,
+                 max_pools=None, max_risk=MAX_INTERRUPTION_RISK):
+    """Chooses pools for the followers and splits their capacity between them
+
+    Pools without any price history are kept, but ranked after the pools
+    whose prices are known. Without a bid, for on-demand followers, pools
+    are only spread over zones and instance types.
+
+    Args:
+      instance_types (list): (instance type, weight) tuples
+      zones (list): names of the availability zones followers can run in
+      history (dict): price history from get_price_history
+      bid_per_unit (float): spot price bid for one unit of capacity, or None
+      capacity (float): units of capacity the followers should have
+      max_pools (int): most pools to spread the followers over
+      max_risk (float): highest interruption risk a pool may have
+
+    Returns:
+      list: the chosen SpotPools
+    """
+    end = max([points[-1][0] for points in history.itervalues() if points] or [None])
+    candidates = []
+    for instance_type, weight in instance_types:
+        for zone in zones:
+            points = history.get((instance_type, zone))
+            if not points or bid_per_unit is None:
+                candidates.append(SpotPool(instance_type, zone, weight, None, None, 0))
+                continue
+            median, risk = score_pool(points, bid_per_unit * weight, end)
+            if risk <= max_risk and points[-1][1] <= bid_per_unit * weight:
+                candidates.append(SpotPool(instance_type, zone, weight,
+                                           median / weight, risk, 0))
+    if not candidates:
+        raise GTCloudFormationException(
+            'No spot pool of {} in {} has stayed under a bid of {} per follower'.format(
+                ', '.join(instance_type for instance_type, _ in instance_types),
+                ', '.join(zones), bid_per_unit))
+
+    # every pool gets at least one unit of capacity
+    max_pools = min(max_pools or len(candidates), max(int(capacity), 1))
+
+    # cheapest first, spreading over zones and then instance types
+    candidates.sort(key=lambda pool: (pool.price is None, pool.price))
+    chosen = []
+    while candidates and len(chosen) < max_pools:
+        pool = min(candidates, key=lambda pool: (
+            len([other for other in chosen if other.zone == pool.zone]),
+            len([other for other in chosen if other.instance_type == pool.instance_type]),
+            candidates.index(pool)))
+        candidates.remove(pool)
+        chosen.append(pool)
+
+    return split_capacity(chosen, capacity)
+
+
+def split_capacity(pools, capacity):
+    """Splits capacity evenly between pools
+
+    Instances are added to whichever pool has the least capacity until
+    there is enough, so every pool carries about the same share.
+
+    Args:
+      pools (list): SpotPools to split the capacity between
+      capacity (float): units of capacity the followers should have
+
+    Returns:
+      list: the SpotPools given at least one instance
+    """
+    instances = [0] * len(pools)
+    while sum(count * pool.weight for count, pool in zip(instances, pools)) < capacity:
+        index = min(range(len(pools)), key=lambda i: (instances[i] * pools[i].weight, i))
+        instances[index] += 1
+    return [pool._replace(instances=count)
+            for pool, count in zip(pools, instances) if count]
+
+
+def format_pools(pools):
+    """Formats pools to be recorded on a stack, e.g. `r3.2xlarge:us-east-1a:3`
+
+    Args:
+      pools (list): SpotPools to format
+
+    Returns:
+      str: comma separated instance type, zone and instances of each pool
+    """
+    return ','.join('{}:{}:{}'.format(pool.instance_type, pool.zone, pool.instances)
+                    for pool in pools)
+
+
+def parse_pools(value, instance_types, zones):
+    """Parses pools recorded by format_pools which can still be used
+
+    Pools of an instance type or zone the followers are no longer given
+    are left out. The prices of the pools aren't recorded, so they are
+    None.
+
+    Args:
+      value (str): pools recorded by format_pools
+      instance_types (list): (instance type, weight) tuples
+      zones (list): names of the availability zones followers can run in
+
+    Returns:
+      list: the SpotPools
+    """
+    weights = dict(instance_types)
+    pools = []
+    for recorded in value.split(','):
+        instance_type, zone, instances = recorded.strip().split(':')
+        if instance_type in weights and zone in zones:
+            pools.append(SpotPool(instance_type, zone, weights[instance_type], None, None,
+                                  int(instances)))
+    return pools
@@ -1,10 +1,63 @@
 
-from majorkirby import GlobalConfigNode
+import sys
+import threading
+
+from cloud_config import check_disk_settings
+from connections import get_connection
+from majorkirby import GlobalConfigNode, GraphExecutor, describe_change
 
 from vpc import VPC
 from leader import MesosLeader
 from follower import MesosFollower
 from privatehostedzone import R53PrivateHostedZone
+from spot import parse_instance_types
+from template_utils import GTCloudFormationException, check_placement_group, get_instance_spec
+from tracing import push_to_graphite, write_chrome_trace
+
+
+def validate_config(gt_config):
+    """Checks the instance types and follower counts of a config
+
+    Instance types must be in the instance catalog and able to run the
+    HVM AMIs, follower weights must match the catalog, the follower
+    bounds must contain NumFollowers and may only be set for a single
+    follower group, the follower disk layout and
+    filesystem must be known, and instances in a placement group must be
+    in one zone with enhanced networking.
+
+    Args:
+      gt_config (dict): dictionary representation of `geotrellis-cluster.config`
+
+    Raises:
+      GTCloudFormationException: if the config can't be launched
+    """
+    get_instance_spec(gt_config['MesosLeaderInstanceType'])
+    instance_types = parse_instance_types(gt_config.get('MesosFollowerInstanceTypes') or
+                                          gt_config['MesosFollowerInstanceType'])
+
+    num_followers = int(gt_config.get('NumFollowers', 2))
+    min_size = int(gt_config.get('MesosFollowerMinSize') or num_followers)
+    max_size = int(gt_config.get('MesosFollowerMaxSize') or num_followers)
+    if not min_size <= num_followers <= max_size:
+        raise GTCloudFormationException(
+            'NumFollowers ({}) must be between MesosFollowerMinSize ({}) and '
+            'MesosFollowerMaxSize ({})'.format(num_followers, min_size, max_size))
+    # followers spread over several types or zones get a fixed size group
+    # for each spot pool, which the autoscale command can't move
+    if ((len(instance_types) > 1 or int(gt_config.get('MesosFollowerZones', 1)) > 1) and
+            not min_size == num_followers == max_size):
+        raise GTCloudFormationException(
+            'MesosFollowerMinSize and MesosFollowerMaxSize need a single follower group, '
+            'but followers spread over several instance types or zones get a fixed size '
+            'group for each spot pool. Leave them unset, or use one instance type in one zone')
+
+    check_disk_settings(gt_config.get('MesosFollowerDiskLayout', 'jbod'),
+                        gt_config.get('MesosFollowerFilesystem', 'ext4'))
+
+    check_placement_group(gt_config.get('MesosPlacementGroup', 'none'),
+                          [instance_type for instance_type, _ in instance_types],
+                          gt_config['MesosLeaderInstanceType'],
+                          int(gt_config.get('MesosFollowerZones', 1)))
 
 
 def build_graph(aws_profile, gt_config):
@@ -18,6 +71,7 @@ def build_graph(aws_profile, gt_config):
     Returns:
       cloudformation stack graphs (mesos-leader, mesos-follower)
     """
+    validate_config(gt_config)
     global_config = GlobalConfigNode(**gt_config)
     vpc = VPC(globalconfig=global_config, aws_profile=aws_profile)
     private_hosted_zone = R53PrivateHostedZone(globalconfig=global_config, VPC=vpc, aws_profile=aws_profile)
@@ -30,8 +84,108 @@ def build_graph(aws_profile, gt_config):
     return mesos_follower, mesos_leader
 
 
-def build_stacks(aws_profile, gt_config):
-    """Trigger actual building of graphs"""
+# one change set is put to the user at a time, whichever thread asks
+_prompt_lock = threading.Lock()
+
+
+def confirm_change_set(node, change_set_name, changes):
+    """Shows a change set and asks whether to execute it
+
+    Without a terminal to ask on the change set is left for review.
+
+    Args:
+      node (StackNode): node whose stack the change set belongs to
+      change_set_name (str): name of the change set
+      changes (list): changes from the DescribeChangeSet result
+
+    Returns:
+      bool: True if the change set should be executed
+    """
+    with _prompt_lock:
+        if not sys.stdin.isatty():
+            node.logger.warning('Not executing change set %s on %s without a terminal to '
+                                'confirm it on, use --yes to execute it',
+                                change_set_name, node.stack_name)
+            return False
+        print 'Change set {} on {}:'.format(change_set_name, node.stack_name)
+        for change in changes:
+            print '  {}'.format(describe_change(change))
+        answer = raw_input('Execute it? [y/N] ')
+        return answer.strip().lower() in ('y', 'yes')
+
+
+def build_stacks(aws_profile, gt_config, apply_updates=True, confirm_updates=False,
+                 rechoose_spot_pools=False, trace_file=None, graphite_host=None,
+                 graphite_port=2003):
+    """Trigger actual building of graphs
+
+    Both graphs are run as one merged graph so that independent stacks are
+    launched concurrently and shared stacks are only run once.
+
+    Args:
+      aws_profile (str): name of AWS profile to use for authentication
+      gt_config (dict): dictionary representation of `geotrellis-cluster.config`
+      apply_updates (bool): whether to execute the change sets of stacks
+        that have changed, or only create them for review
+      confirm_updates (bool): whether to show each change set and ask before
+        executing it
+      rechoose_spot_pools (bool): whether to choose the follower spot pools
+        from the current prices rather than keep those of the deployed stack
+      trace_file (str): path to write a Chrome trace of the launch to
+      graphite_host (str): Graphite host to send the launch timings to
+      graphite_port (int): Graphite plaintext protocol port
+
+    Returns:
+      bool: True if every stack finished
+    """
     follower_graph, leader_graph = build_graph(aws_profile, gt_config)
-    leader_graph.go()
-    follower_graph.go()
+    follower_graph.rechoose_spot_pools = rechoose_spot_pools
+    executor = GraphExecutor([leader_graph, follower_graph])
+    for node in executor.nodes:
+        node.apply_updates = apply_updates
+        if confirm_updates:
+            node.confirm_update = confirm_change_set
+    succeeded = executor.run()
+    if trace_file:
+        write_chrome_trace(executor.nodes, trace_file)
+    if graphite_host:
+        push_to_graphite(executor.nodes, graphite_host, graphite_port)
+    return succeeded
+
+
+def plan_stacks(aws_profile, gt_config, rechoose_spot_pools=False):
+    """Works out what launching the stacks would do without launching them
+
+    Every template is rendered and compared with the deployed stacks, but
+    nothing is created or changed. Install an offline backend with
+    `connections.set_backend` to plan without touching AWS at all.
+
+    Args:
+      aws_profile (str): name of AWS profile to use for authentication
+      gt_config (dict): dictionary representation of `geotrellis-cluster.config`
+      rechoose_spot_pools (bool): whether to choose the follower spot pools
+        from the current prices rather than keep those of the deployed stack
+
+    Returns:
+      list: plan of each node, in the order they would run
+    """
+    follower_graph, leader_graph = build_graph(aws_profile, gt_config)
+    follower_graph.rechoose_spot_pools = rechoose_spot_pools
+    return GraphExecutor([leader_graph, follower_graph]).plan()
+
+
+def get_follower_group(aws_profile, gt_config):
+    """Looks up the name of the deployed Mesos follower auto scaling group
+
+    Args:
+      aws_profile (str): name of AWS profile to use for authentication
+      gt_config (dict): dictionary representation of `geotrellis-cluster.config`
+
+    Returns:
+      str: name of the auto scaling group
+    """
+    follower_graph, _ = build_graph(aws_profile, gt_config)
+    stack_name = follower_graph.get_stack_name()
+    conn = get_connection('cloudformation', gt_config['Region'], aws_profile)
+    stack = conn.describe_stacks(stack_name)[0]
+    return {output.key: output.value for output in stack.outputs}['MesosFollowerGroup']
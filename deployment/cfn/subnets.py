@@ -0,0 +1,104 @@
+"""Carves the VPC's address space into a subnet for each follower zone
+
+Every zone the followers are spread over gets a subnet of the size set by
+`MesosSubnetPrefix`, /24 unless it is set, so clusters keep the
+`10.0.1.0/24`, `10.0.2.0/24`, ... layout, and larger subnets are laid out
+after the first /24 on boundaries of their size. Subnets can't be resized
+without replacing them, so their size is never worked out from the number
+of followers. Instead the followers, with headroom for instances being
+replaced, plus the leader and the addresses AWS reserves in each subnet,
+are checked to fit.
+"""
+
+import math
+import socket
+import struct
+
+from template_utils import GTCloudFormationException
+
+
+# the first /24 of the VPC is left unused, as it always has been
+FIRST_SUBNET_OFFSET = 256
+
+# addresses AWS reserves in every subnet, and for the leader and the other
+# instances sharing the first one
+AWS_RESERVED_ADDRESSES = 5
+LEADER_ADDRESSES = 8
+
+# a /16 subnet would cover the whole /16 VPC, including the unused first /24
+LARGEST_PREFIX = 24
+SMALLEST_PREFIX = 17
+
+
+def _parse_cidr(cidr):
+    address, _, prefix = cidr.partition('/')
+    return struct.unpack('!I', socket.inet_aton(address))[0], int(prefix)
+
+
+def _format_cidr(address, prefix):
+    return '{}/{}'.format(socket.inet_ntoa(struct.pack('!I', address)), prefix)
+
+
+def subnet_prefix(instances, zones, headroom=1.0):
+    """Works out the smallest subnets with room for the followers
+
+    Args:
+      instances (int): most followers the cluster may run
+      zones (int): number of zones they are spread over
+      headroom (float): extra share of addresses to leave free, e.g. 1.0
+        for twice as many as the followers need
+
+    Returns:
+      int: largest prefix length whose subnets are big enough
+    """
+    per_zone = int(math.ceil(instances * (1 + headroom) / float(zones)))
+    addresses = per_zone + LEADER_ADDRESSES + AWS_RESERVED_ADDRESSES
+    return 32 - int(math.ceil(math.log(addresses, 2)))
+
+
+def plan_subnets(vpc_cidr, prefix, zones, instances, headroom=1.0):
+    """Lays out a subnet for each follower zone in a VPC
+
+    The layout only depends on the prefix and the number of zones, so the
+    subnets of a running cluster stay where they are as it grows. The
+    followers are only checked against it.
+
+    Args:
+      vpc_cidr (str): address range of the VPC, e.g. `10.0.0.0/16`
+      prefix (int): prefix length of each subnet
+      zones (int): number of zones the followers are spread over
+      instances (int): most followers the cluster may run
+      headroom (float): extra share of addresses to leave free
+
+    Returns:
+      list: CIDR block of the subnet in each zone
+
+    Raises:
+      GTCloudFormationException: if the subnets are too small for the
+        followers or don't fit in the VPC
+    """
+    vpc_address, vpc_prefix = _parse_cidr(vpc_cidr)
+    if not SMALLEST_PREFIX <= prefix <= LARGEST_PREFIX:
+        raise GTCloudFormationException(
+            'MesosSubnetPrefix must be between {} and {}'.format(
+                SMALLEST_PREFIX, LARGEST_PREFIX))
+    needed = subnet_prefix(instances, zones, headroom)
+    if needed < SMALLEST_PREFIX:
+        raise GTCloudFormationException(
+            '{} followers over {} zones do not fit in /{} subnets, spread them '
+            'over more zones'.format(instances, zones, SMALLEST_PREFIX))
+    if prefix > needed:
+        raise GTCloudFormationException(
+            '/{} subnets are too small for {} followers over {} zones, which '
+            'need a MesosSubnetPrefix of {} or less. Changing it replaces the '
+            'subnets and every instance in them'.format(
+                prefix, instances, zones, needed))
+    size = 2 ** (32 - prefix)
+    # the first subnet starts at the first boundary of its size past the
+    # unused /24
+    offset = (FIRST_SUBNET_OFFSET + size - 1) // size * size
+    if offset + size * zones > 2 ** (32 - vpc_prefix):
+        raise GTCloudFormationException(
+            '{} /{} subnets do not fit in {}'.format(zones, prefix, vpc_cidr))
+    return [_format_cidr(vpc_address + offset + size * index, prefix)
+            for index in range(zones)]
@@ -1,26 +1,55 @@
 import ConfigParser
-import boto.ec2
+import json
+import os
+import threading
+import time
+
 import majorkirby as mj
 
+from connections import get_connection
+
+AMI_CACHE_PATH = os.path.expanduser('~/.geotrellis-ec2-cluster/ami-cache.json')
+
 VPC_CIDR = '10.0.0.0/16'
 ALLOW_ALL_CIDR = '0.0.0.0/0'
 
-EC2_INSTANCE_TYPES = [
-    'c4.8xlarge',
-    'c3.2xlarge',
-    'c3.4xlarge',
-    'cc1.4xlarge',
-    'i2.xlarge',
-    'i2.2xlarge',
-    'i2.4xlarge',
-    'i2.8xlarge',
-    'm2.4xlarge',
-    'm3.large',
-    'm3.2xlarge',
-    'r3.large',
-    'r3.2xlarge',
-    'r3.4xlarge'
-]
+# Which instances share a cluster placement group: none, the followers, or
+# the followers and the leader
+PLACEMENT_GROUP_MODES = ('none', 'followers', 'cluster')
+
+INSTANCE_CATALOG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                     '..', 'ansible', 'vars', 'instance_types.json')
+
+
+def load_instance_catalog(catalog_path=INSTANCE_CATALOG_PATH):
+    """Loads the catalog of EC2 instance types
+
+    The catalog is shared with Ansible, which reads it through the
+    `instance_spec` filter. Each instance type has:
+
+      - vcpus, memory_mib
+      - instance_store_count, instance_store_size_gb (GB per volume) and
+        instance_store_type (`ssd`, `hdd` or null)
+      - network: `moderate`, `high` or `10gigabit`
+      - ebs_optimized: `default`, `supported` or `unsupported`
+      - sriov: whether enhanced networking through the Intel 82599 VF
+        interface (SR-IOV) is available. ENA is not in the catalog
+      - hvm: whether HVM AMIs can be launched on it
+
+    Args:
+      catalog_path (str): path of the catalog
+
+    Returns:
+      dict: instance type name to its specification
+    """
+    with open(catalog_path, 'r') as f:
+        return json.load(f)
+
+
+INSTANCE_CATALOG = load_instance_catalog()
+
+# Every AMI built by create-ami is HVM
+EC2_INSTANCE_TYPES = sorted(name for name, spec in INSTANCE_CATALOG.iteritems() if spec['hvm'])
 
 
 def read_file(file_name):
@@ -52,29 +81,181 @@ def get_config(gt_config_path, profile):
 class GTCloudFormationException(Exception):
     pass
 
-def get_recent_ami(profile_name, machine_type, stack_type, region):
+
+def get_instance_spec(instance_type):
+    """Returns the catalog entry of an instance type AMIs can run on
+
+    Args:
+      instance_type (str): name of the instance type (e.g. `r3.2xlarge`)
+
+    Returns:
+      dict: specification of the instance type
+
+    Raises:
+      GTCloudFormationException: if the type isn't in the catalog or can't
+        run HVM AMIs
+    """
+    spec = INSTANCE_CATALOG.get(instance_type)
+    if spec is None:
+        raise GTCloudFormationException(
+            'Unknown instance type {}, add it to {}'.format(
+                instance_type, os.path.relpath(INSTANCE_CATALOG_PATH)))
+    if not spec['hvm']:
+        raise GTCloudFormationException(
+            '{} only runs paravirtual AMIs, but the AMIs are HVM'.format(instance_type))
+    return spec
+
+
+def get_block_device_mappings(instance_type):
+    """Maps each instance store volume of an instance type to a device
+
+    The volumes are attached from `/dev/sdb` onwards, in order.
+
+    Args:
+      instance_type (str): name of the instance type
+
+    Returns:
+      list: block device mappings for a launch configuration or instance
+    """
+    return [{'DeviceName': '/dev/sd{}'.format(chr(ord('b') + index)),
+             'VirtualName': 'ephemeral{}'.format(index)}
+            for index in range(get_instance_spec(instance_type)['instance_store_count'])]
+
+
+def is_ebs_optimizable(instance_type):
+    """Whether an instance type can be launched EBS-optimized"""
+    return get_instance_spec(instance_type)['ebs_optimized'] != 'unsupported'
+
+
+def check_enhanced_networking(instance_type):
+    """Checks an instance type has enhanced networking through SR-IOV
+
+    Only SR-IOV types are supported for a high throughput network, as that
+    is what check_ami_enhanced_networking checks the AMI for. Types which
+    need ENA are rejected.
+
+    Raises:
+      GTCloudFormationException: if it doesn't
+    """
+    if not get_instance_spec(instance_type)['sriov']:
+        raise GTCloudFormationException(
+            '{} has no SR-IOV enhanced networking, so it cannot be used for a high '
+            'throughput network'.format(instance_type))
+
+
+def check_placement_group(mode, instance_types, leader_instance_type, num_zones):
+    """Checks a cluster can be put in a placement group
+
+    Args:
+      mode (str): one of PLACEMENT_GROUP_MODES
+      instance_types (list): follower instance types
+      leader_instance_type (str): instance type of the leader
+      num_zones (int): number of zones the followers are spread over
+
+    Raises:
+      GTCloudFormationException: if the mode is unknown, the followers are
+        spread over several zones or an instance type in the group has no
+        SR-IOV enhanced networking
+    """
+    if mode not in PLACEMENT_GROUP_MODES:
+        raise GTCloudFormationException('Placement group must be one of {}, not {}'.format(
+            ', '.join(PLACEMENT_GROUP_MODES), mode))
+    if mode == 'none':
+        return
+    if num_zones != 1:
+        raise GTCloudFormationException(
+            'A placement group is in a single zone, but MesosFollowerZones is {}'.format(
+                num_zones))
+    for instance_type in instance_types:
+        check_enhanced_networking(instance_type)
+    if mode == 'cluster':
+        check_enhanced_networking(leader_instance_type)
+
+
+_recent_amis = {}
+_recent_amis_lock = threading.Lock()
+
+
+def _read_ami_cache(cache_key, cache_ttl):
+    """Returns an AMI ID from the on-disk cache if it is younger than cache_ttl
+
+    Args:
+      cache_key (str): key of the AMI in the cache file
+      cache_ttl (int): maximum age of the cached entry in seconds
+    """
+    try:
+        with open(AMI_CACHE_PATH, 'r') as f:
+            entry = json.load(f).get(cache_key)
+    except (IOError, ValueError):
+        return None
+    if entry and time.time() - entry['timestamp'] < cache_ttl:
+        return entry['ami_id']
+    return None
+
+
+def _write_ami_cache(cache_key, ami_id):
+    """Records an AMI ID in the on-disk cache
+
+    Args:
+      cache_key (str): key of the AMI in the cache file
+      ami_id (str): ID of the AMI to record
+    """
+    try:
+        with open(AMI_CACHE_PATH, 'r') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+    cache[cache_key] = {'ami_id': ami_id, 'timestamp': time.time()}
+    cache_dir = os.path.dirname(AMI_CACHE_PATH)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    with open(AMI_CACHE_PATH, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+
+def get_recent_ami(profile_name, machine_type, stack_type, region, cache_ttl=0):
     """Helper function to get latest AMI for a given stack and machine in region
 
+    Images are filtered on their tags by the EC2 API rather than listing
+    every image in the account. Results are memoized for the life of the
+    process, and optionally cached on disk for `cache_ttl` seconds so that
+    repeat launches skip the lookup entirely.
+
     Args:
       profile_name (str): AWS profile to use to authenticate with boto
       machine_type (str): Type of machine to get AMI for (e.g. `mesos-leader`)
       stack_type (str): Type of stack AMI built for (e.g. `accumulo`)
+      region (str): AWS region to look for the AMI in
+      cache_ttl (int): seconds to trust the on-disk cache (0 disables it)
+
+    Returns:
+      str: ID of the most recently created AMI
     """
+    key = (profile_name, region, stack_type, machine_type)
+    cache_key = '|'.join(str(part) for part in key)
+    with _recent_amis_lock:
+        if key in _recent_amis:
+            return _recent_amis[key]
 
-    def filter_image(image):
-        image_machine_type = image.tags.get('Name')
-        image_stack_type = image.tags.get('StackType')
-        return all([image_machine_type == machine_type,
-                    image_stack_type == stack_type,
-                    image.tags.get('Created')])
+    ami_id = _read_ami_cache(cache_key, cache_ttl) if cache_ttl else None
+    if ami_id is None:
+        conn = get_connection('ec2', region, profile_name)
+        images = conn.get_all_images(owners='self', filters={
+            'tag:Name': machine_type,
+            'tag:StackType': stack_type,
+            'tag-key': 'Created'
+        })
+        if len(images) == 0:
+            exc = 'Unable to find AMI satisfying machine_type: {} and stack_type: {}'.format(
+                machine_type, stack_type)
+            raise GTCloudFormationException(exc)
+        ami_id = sorted(images, key=lambda x: x.tags['Created'], reverse=True)[0].id
+        if cache_ttl:
+            _write_ami_cache(cache_key, ami_id)
 
-    conn = boto.ec2.connect_to_region(region, profile_name=profile_name)
-    images = [image for image in conn.get_all_images(owners='self') if filter_image(image)]
-    if len(images) == 0:
-        exc = 'Unable to find AMI satisfying machine_type: {} and stack_type: {}'.format(
-            machine_type, stack_type)
-        raise GTCloudFormationException(exc)
-    return sorted(images, key=lambda x: x.tags['Created'], reverse=True)[0]
+    with _recent_amis_lock:
+        _recent_amis[key] = ami_id
+    return ami_id
 
 
 class GTStackNode(mj.StackNode):
@@ -94,8 +275,46 @@ class GTStackNode(mj.StackNode):
         if ami_id:
             return ami_id
         else:
-            ami = get_recent_ami(self.aws_profile,
-                                 machine_type,
-                                 stack_type,
-                                 self.region)
-            return ami.id
+            with self.span('ami_lookup'):
+                return get_recent_ami(self.aws_profile,
+                                      machine_type,
+                                      stack_type,
+                                      self.region,
+                                      cache_ttl=int(self.get_input('AMICacheTTL')))
+
+    @property
+    def user_data(self):
+        return read_file(self.USER_DATA % self.get_input('StackType'))
+
+    def get_parameter_value(self, input_name):
+        """The AMI parameter carries the looked up AMI when none is configured"""
+        if input_name == self.AMI_INPUT:
+            return self.ami
+        return super(GTStackNode, self).get_parameter_value(input_name)
+
+    def check_ami_enhanced_networking(self):
+        """Checks the node's AMI has SR-IOV enhanced networking enabled
+
+        ENA support isn't checked, as placement groups are restricted to
+        SR-IOV instance types by check_placement_group.
+
+        Raises:
+          GTCloudFormationException: if it doesn't, or can't be found
+        """
+        ami_id = self.ami
+        conn = get_connection('ec2', self.region, self.aws_profile)
+        images = conn.get_all_images(image_ids=[ami_id])
+        if not images or images[0].sriov_net_support != 'simple':
+            raise GTCloudFormationException(
+                'AMI {} does not have SR-IOV enhanced networking enabled, so it cannot be '
+                'used for a high throughput network'.format(ami_id))
+
+    def _fingerprint_extras(self):
+        """The AMI and user data are rendered into the template too"""
+        self.region = self.get_input('Region')
+        return {'ami': self.ami, 'user_data': self.user_data}
+
+    def plan(self):
+        plan = super(GTStackNode, self).plan()
+        plan['detail'] = 'AMI {}'.format(self.ami)
+        return plan
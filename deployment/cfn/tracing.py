@@ -0,0 +1,137 @@
+"""Exports the timelines of a stack graph run
+
+Each StackNode run by a GraphExecutor records spans for the phases of its
+launch (waiting on the nodes it requires, rendering its template, the
+create or update call and polling until it completes) along with the API
+calls it made. These can be written out as a Chrome trace, which opens in
+chrome://tracing or https://ui.perfetto.dev, or pushed to Graphite.
+"""
+
+import json
+import logging
+import re
+import socket
+import time
+
+
+logger = logging.getLogger('cfntool')
+
+
+def chrome_trace(nodes):
+    """Builds a Chrome trace of the nodes in a run
+
+    Each node gets its own track, with a span covering its whole run and
+    the span of each phase below it.
+
+    Args:
+      nodes (list): StackNodes which have been run
+
+    Returns:
+      dict: trace in the Chrome trace event format
+    """
+    events = []
+    for tid, node in enumerate(nodes, 1):
+        name = node.get_stack_name(False)
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                       'args': {'name': name}})
+        if not node.spans:
+            continue
+        start = min(span_start for _, span_start, _ in node.spans)
+        end = max(span_end for _, _, span_end in node.spans)
+        events.append({
+            'name': name, 'cat': 'stack', 'ph': 'X', 'pid': 1, 'tid': tid,
+            'ts': int(start * 1e6), 'dur': int((end - start) * 1e6),
+            'args': {'stack_name': node.stack_name,
+                     'state': node.state,
+                     'api_calls': node.api_calls}
+        })
+        for phase, span_start, span_end in node.spans:
+            events.append({
+                'name': phase, 'cat': 'phase', 'ph': 'X', 'pid': 1, 'tid': tid,
+                'ts': int(span_start * 1e6),
+                'dur': int((span_end - span_start) * 1e6)
+            })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_chrome_trace(nodes, trace_path):
+    """Writes a Chrome trace of the nodes in a run to a file
+
+    Args:
+      nodes (list): StackNodes which have been run
+      trace_path (str): path of the trace file
+    """
+    with open(trace_path, 'w') as f:
+        json.dump(chrome_trace(nodes), f)
+
+
+def _metric_name(name):
+    """Makes a string safe to use as part of a Graphite metric path"""
+    return re.sub(r'[^A-Za-z0-9_-]', '_', name)
+
+
+def graphite_metrics(nodes, prefix, timestamp=None):
+    """Returns the timings and API calls of a run as Graphite metrics
+
+    Args:
+      nodes (list): StackNodes which have been run
+      prefix (str): path every metric is put under
+      timestamp (int): time of the metrics, defaults to now
+
+    Returns:
+      list: (path, value, timestamp) tuples
+    """
+    timestamp = int(timestamp or time.time())
+    metrics = []
+    starts = []
+    ends = []
+    for node in nodes:
+        if not node.spans:
+            continue
+        node_prefix = '{}.{}'.format(prefix, _metric_name(node.get_stack_name(False)))
+        phases = {}
+        for phase, start, end in node.spans:
+            phases[phase] = phases.get(phase, 0) + end - start
+            starts.append(start)
+            ends.append(end)
+        for phase, seconds in sorted(phases.iteritems()):
+            metrics.append(('{}.{}.seconds'.format(node_prefix, phase), seconds,
+                            timestamp))
+        for service, actions in sorted(node.api_calls.iteritems()):
+            for action, count in sorted(actions.iteritems()):
+                metrics.append(('{}.api_calls.{}.{}'.format(
+                    node_prefix, _metric_name(service), _metric_name(action)),
+                    count, timestamp))
+    if starts:
+        metrics.append(('{}.total.seconds'.format(prefix), max(ends) - min(starts),
+                        timestamp))
+    return metrics
+
+
+def push_to_graphite(nodes, host, port=2003, prefix='geotrellis.launch',
+                     timeout=5):
+    """Sends the timings and API calls of a run to Graphite
+
+    Metrics are sent with the plaintext protocol. A failure to reach
+    Graphite is logged rather than raised, so that it can't fail a launch.
+
+    Args:
+      nodes (list): StackNodes which have been run
+      host (str): Graphite (carbon) host
+      port (int): plaintext protocol port
+      prefix (str): path every metric is put under
+      timeout (float): seconds to wait for the connection
+    """
+    lines = ['{} {} {}\n'.format(path, value, timestamp)
+             for path, value, timestamp in graphite_metrics(nodes, prefix)]
+    try:
+        sock = socket.create_connection((host, port), timeout=timeout)
+        try:
+            sock.sendall(''.join(lines))
+        finally:
+            sock.close()
+    except (socket.error, socket.timeout) as e:
+        logger.warning('Unable to send metrics to Graphite at %s:%s: %s',
+                       host, port, e)
+        return
+    logger.info('Sent %d metrics to Graphite at %s:%s', len(lines), host, port)
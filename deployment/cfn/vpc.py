@@ -1,15 +1,20 @@
+import math
+
 from troposphere import (
     Template,
     Parameter,
     Output,
     Ref,
+    Join,
     Tags,
     ec2)
 
 import template_utils as utils
+from connections import get_connection
 from majorkirby import StackNode
-import boto
-import boto.ec2
+from resources import PlacementGroup, VPCEndpoint
+from spot import parse_instance_types
+from subnets import plan_subnets
 
 
 class VPC(StackNode):
@@ -17,14 +22,49 @@ class VPC(StackNode):
               'Region': ['global:Region'],
               'StackType': ['global:StackType'],
               'NameSpace': ['global:NameSpace'],
-              'IPAccess': ['global:IPAccess']}
+              'IPAccess': ['global:IPAccess'],
+              'MesosFollowerZones': ['global:MesosFollowerZones'],
+              'MesosSubnetPrefix': ['global:MesosSubnetPrefix'],
+              'MesosSubnetHeadroom': ['global:MesosSubnetHeadroom'],
+              'MesosPlacementGroup': ['global:MesosPlacementGroup'],
+              'S3Endpoint': ['global:S3Endpoint'],
+              'NumFollowers': ['global:NumFollowers'],
+              'MesosFollowerMaxSize': ['global:MesosFollowerMaxSize'],
+              'MesosFollowerInstanceType': ['global:MesosFollowerInstanceType'],
+              'MesosFollowerInstanceTypes': ['global:MesosFollowerInstanceTypes']}
 
     DEFAULTS = {
         'Tags': {},
+        'MesosFollowerZones': '1',
+        'MesosSubnetPrefix': '24',
+        'MesosSubnetHeadroom': '1.0',
+        'MesosPlacementGroup': 'none',
+        'S3Endpoint': 'false',
+        'NumFollowers': '2',
+        'MesosFollowerMaxSize': None,
+        'MesosFollowerInstanceTypes': None
     }
 
     ATTRIBUTES = {'NameSpace': 'NameSpace'}
 
+    OUTPUTS = ('VpcId', 'AvailabilityZone', 'MesosSubnet', 'FollowerZones',
+               'PlacementGroup', 'S3EndpointId')
+
+    @property
+    def max_followers(self):
+        """Most follower instances the subnets must have room for
+
+        `NumFollowers` and `MesosFollowerMaxSize` count units of capacity,
+        so the count is divided by the smallest follower weight.
+        """
+        num_followers = self.get_input('NumFollowers')
+        capacity = max(float(num_followers),
+                       float(self.get_input('MesosFollowerMaxSize') or num_followers))
+        weights = [weight for _, weight in parse_instance_types(
+            self.get_input('MesosFollowerInstanceTypes') or
+            self.get_input('MesosFollowerInstanceType'))]
+        return int(math.ceil(capacity / min(weights)))
+
     def set_up_stack(self):
         super(VPC, self).set_up_stack()
         tags = self.get_input('Tags').copy()
@@ -63,21 +103,60 @@ class VPC(StackNode):
             DependsOn=gateway_attachment.title, GatewayId=Ref(gateway)
         ))
 
+        # S3 traffic from the subnets, which all use the public route table,
+        # goes through a gateway endpoint rather than the internet gateway.
+        # It is still HTTPS to S3's public addresses, which the security
+        # groups already allow out.
+        if self.get_input('S3Endpoint').lower() == 'true':
+            self.create_resource(VPCEndpoint(
+                'S3Endpoint', VpcId=Ref(vpc),
+                ServiceName='com.amazonaws.{}.s3'.format(self.region),
+                RouteTableIds=[Ref(public_route_table)]
+            ), output='S3EndpointId')
+
         region = self.get_input('Region')
-        conn = boto.ec2.connect_to_region(region, profile_name=self.aws_profile)
-        zone = conn.get_all_zones()[0]
+        conn = get_connection('ec2', region, self.aws_profile)
+        zones = conn.get_all_zones()
+        num_follower_zones = int(self.get_input('MesosFollowerZones'))
+        if not 1 <= num_follower_zones <= len(zones):
+            raise utils.GTCloudFormationException(
+                'MesosFollowerZones must be between 1 and {}, the number of zones in {}'.format(
+                    len(zones), region))
+        zone = zones[0]
 
         self.add_output(Output('AvailabilityZone', Value=zone.name))
 
-        public_subnet = self.create_resource(ec2.Subnet(
-            '{zone}PublicSubnet'.format(zone=zone.name.title().replace('-', '')),
-            VpcId=Ref(vpc), CidrBlock='10.0.1.0/24',
-            AvailabilityZone='{}'.format(zone.name),
-            Tags=Tags(Name='{}PublicSubnet'.format(zone.name.title().replace('-', '')))
-        ), output='MesosSubnet')
-
-        self.create_resource(ec2.SubnetRouteTableAssociation(
-            '%sPublicRouteTableAssociation' % public_subnet.title,
-            SubnetId=Ref(public_subnet),
-            RouteTableId=Ref(public_route_table)
-        ))
+        # The leader and the first followers share a subnet in the first
+        # zone, and followers spread over more zones get a subnet in each
+        cidr_blocks = plan_subnets(utils.VPC_CIDR, int(self.get_input('MesosSubnetPrefix')),
+                                   num_follower_zones, self.max_followers,
+                                   float(self.get_input('MesosSubnetHeadroom')))
+        subnets = []
+        for follower_zone, cidr_block in zip(zones, cidr_blocks):
+            subnet_name = '{zone}PublicSubnet'.format(
+                zone=follower_zone.name.title().replace('-', ''))
+            subnet = self.create_resource(ec2.Subnet(
+                subnet_name,
+                VpcId=Ref(vpc), CidrBlock=cidr_block,
+                AvailabilityZone='{}'.format(follower_zone.name),
+                Tags=Tags(Name=subnet_name)
+            ))
+
+            self.create_resource(ec2.SubnetRouteTableAssociation(
+                '%sPublicRouteTableAssociation' % subnet.title,
+                SubnetId=Ref(subnet),
+                RouteTableId=Ref(public_route_table)
+            ))
+            subnets.append(subnet)
+
+        self.add_output(Output(
+            'FollowerZones',
+            Value=','.join(follower_zone.name for follower_zone in zones[:num_follower_zones])))
+        self.add_output(Output(
+            'MesosSubnet', Value=Join(',', [Ref(subnet) for subnet in subnets])))
+
+        # The leader and followers which share it are placed in the first zone
+        if self.get_input('MesosPlacementGroup') != 'none':
+            self.create_resource(PlacementGroup(
+                'MesosPlacementGroup', Strategy='cluster'
+            ), output='PlacementGroup')
@@ -0,0 +1,110 @@
+# Sets up the instance store disks of a follower and points HDFS at them.
+# cfn/cloud_config.py prepends the settings for the instance type:
+#
+#   INSTANCE_TYPE  instance type the disks are set up for
+#   DEVICES        suffixes of the devices the disks are attached as (`b c`)
+#   LAYOUT         `jbod` for a filesystem on each disk, `raid0` to stripe them
+#   FILESYSTEM     `ext4` or `xfs`
+#
+# Only disks which exist are used. They are formatted in parallel, without
+# discarding blocks or initializing inode tables up front, and mounted on
+# /media/ephemeral0 onwards without access times. HDFS keeps its blocks in
+# `hdfs` and Spark its shuffle files in `spark` on each of them, and both
+# are created here so they exist before either starts. The
+# hdfs-site.xml the HDFS role rendered for the instance type is put in place
+# before the data directories are pointed at the disks.
+
+set -x
+
+HDFS_CONF_DIR=/etc/hadoop/conf
+HDFS_SITE=${HDFS_CONF_DIR}/hdfs-site.xml
+FALLBACK_DATA_DIR=/var/lib/hadoop-hdfs/data
+
+disks=()
+for suffix in ${DEVICES}; do
+  for device in /dev/xvd${suffix} /dev/sd${suffix}; do
+    if [ -b "${device}" ]; then
+      # cloud-init may have mounted the first disk on /mnt
+      umount "${device}" 2>/dev/null
+      disks+=("${device}")
+      break
+    fi
+  done
+done
+
+if [ "${LAYOUT}" = "raid0" ] && [ ${#disks[@]} -gt 1 ]; then
+  mdadm --create /dev/md0 --run --level=0 --raid-devices=${#disks[@]} "${disks[@]}"
+  mdadm --detail --scan >> /etc/mdadm/mdadm.conf
+  volumes=(/dev/md0)
+else
+  volumes=("${disks[@]}")
+fi
+
+format() {
+  case "${FILESYSTEM}" in
+    xfs)
+      mkfs.xfs -f -K "$1"
+      ;;
+    *)
+      mkfs.ext4 -F -m 0 -E lazy_itable_init=1,lazy_journal_init=1,nodiscard "$1"
+      ;;
+  esac
+}
+
+pids=()
+for volume in "${volumes[@]}"; do
+  format "${volume}" &
+  pids+=($!)
+done
+
+data_dirs=()
+mounted=0
+for index in "${!volumes[@]}"; do
+  if ! wait "${pids[${index}]}"; then
+    continue
+  fi
+  mount_point=/media/ephemeral${mounted}
+  uuid=$(blkid -s UUID -o value "${volumes[${index}]}")
+  mkdir -p "${mount_point}"
+  if mount -t "${FILESYSTEM}" -o noatime "UUID=${uuid}" "${mount_point}"; then
+    echo "UUID=${uuid} ${mount_point} ${FILESYSTEM} defaults,noatime,nobootwait 0 2" >> /etc/fstab
+    mounted=$((mounted + 1))
+    mkdir -p "${mount_point}/hdfs"
+    chown hdfs:hadoop "${mount_point}/hdfs"
+    chmod 770 "${mount_point}/hdfs"
+    data_dirs+=("${mount_point}/hdfs")
+    # executors of any framework user write here, as spark-profile sets up
+    mkdir -p "${mount_point}/spark"
+    chmod 1777 "${mount_point}/spark"
+  fi
+done
+
+if [ ${#data_dirs[@]} -eq 0 ]; then
+  mkdir -p "${FALLBACK_DATA_DIR}"
+  chown hdfs:hadoop "${FALLBACK_DATA_DIR}"
+  chmod 770 "${FALLBACK_DATA_DIR}"
+  data_dirs=("${FALLBACK_DATA_DIR}")
+fi
+
+if [ -f "${HDFS_CONF_DIR}/profiles/${INSTANCE_TYPE}/hdfs-site.xml" ]; then
+  cp "${HDFS_CONF_DIR}/profiles/${INSTANCE_TYPE}/hdfs-site.xml" "${HDFS_SITE}"
+fi
+
+python - "${HDFS_SITE}" "$(IFS=,; echo "${data_dirs[*]}")" <<'EOF'
+import sys
+import xml.etree.ElementTree as ET
+
+path, data_dirs = sys.argv[1:]
+tree = ET.parse(path)
+for prop in tree.getroot().findall('property'):
+    if prop.findtext('name') == 'dfs.datanode.data.dir':
+        break
+else:
+    prop = ET.SubElement(tree.getroot(), 'property')
+    ET.SubElement(prop, 'name').text = 'dfs.datanode.data.dir'
+    ET.SubElement(prop, 'value')
+prop.find('value').text = data_dirs
+tree.write(path, encoding="UTF-8", xml_declaration=True)
+EOF
+
+service hadoop-hdfs-datanode restart
@@ -2,25 +2,161 @@
 """Commands for setting up a GeoTrellis Spark stack on AWS"""
 
 import argparse
+import json
+import logging
 import os
+import sys
+import time
 
-from cfn.stacks import build_stacks
+from autoscaling.controller import ScalingController, ScalingPolicy
+from autoscaling.groups import AutoScalingGroup
+from autoscaling.metrics import ClusterMetricsReader
+from cfn.benchmark import DEFAULT_SIZES, run_benchmarks
+from cfn.connections import set_backend
+from cfn.fakeaws import FakeAWS, record_fixtures
+from cfn.spot import parse_instance_types
+from cfn.stacks import build_stacks, get_follower_group, plan_stacks
 from cfn.template_utils import get_config
 from packer.gt_packer import run_packer
+from packer.preview import ROLE_PREVIEWS, render_role_config
 
 
 current_file_dir = os.path.dirname(os.path.realpath(__file__))
 
 
-def launch_stacks(gt_config, aws_profile, **kwargs):
-    build_stacks(aws_profile, gt_config)
+def launch_stacks(gt_config, aws_profile, preview_updates, yes, rechoose_spot_pools, trace_file,
+                  graphite_host, graphite_port, **kwargs):
+    if not build_stacks(aws_profile, gt_config, apply_updates=not preview_updates,
+                        confirm_updates=not yes, rechoose_spot_pools=rechoose_spot_pools,
+                        trace_file=trace_file, graphite_host=graphite_host,
+                        graphite_port=graphite_port):
+        sys.exit(1)
 
 
-def create_ami(machine_type, aws_profile, gt_config, **kwargs):
-    run_packer(machine_type,
+def plan_launch(gt_config, aws_profile, fixtures, record, template_dir,
+                json_output, rechoose_spot_pools, **kwargs):
+    start = time.time()
+    if record:
+        with open(record, 'w') as f:
+            instance_types = parse_instance_types(gt_config.get('MesosFollowerInstanceTypes') or
+                                                  gt_config['MesosFollowerInstanceType'])
+            json.dump(record_fixtures(gt_config['Region'], aws_profile,
+                                      [instance_type for instance_type, _ in instance_types]),
+                      f, indent=2, sort_keys=True, default=str)
+        fixtures = record
+    if fixtures:
+        set_backend(FakeAWS.from_file(fixtures, placeholder_images=True))
+    else:
+        set_backend(FakeAWS(placeholder_images=True))
+    # don't let placeholder AMIs into the on-disk AMI cache
+    gt_config = dict(gt_config, AMICacheTTL='0')
+    plans = plan_stacks(aws_profile, gt_config, rechoose_spot_pools=rechoose_spot_pools)
+
+    if template_dir:
+        if not os.path.isdir(template_dir):
+            os.makedirs(template_dir)
+        for plan in plans:
+            if plan['template_body'] is not None:
+                path = os.path.join(template_dir, '{}.json'.format(plan['node']))
+                with open(path, 'w') as f:
+                    f.write(plan['template_body'])
+
+    if json_output:
+        print json.dumps([{k: v for k, v in plan.iteritems() if k != 'template_body'}
+                          for plan in plans], indent=2, sort_keys=True)
+        return
+
+    for plan in plans:
+        if plan['template_size'] is not None:
+            summary = '{:.1f} KB, {} resources'.format(plan['template_size'] / 1024.0,
+                                                       plan['resources'])
+            if plan['detail']:
+                summary += ', ' + plan['detail']
+        else:
+            summary = plan['detail'] or ''
+        print '{:<24} {:<8} {:<34} {}'.format(plan['node'], plan['action'],
+                                              plan['stack_name'], summary)
+        for wiring in plan['parameters']:
+            print '    {} <- {} = {}{}'.format(wiring['parameter'], wiring['input'], wiring['value'],
+                                            ' (template default)' if wiring['default'] else '')
+    print 'Planned {} stacks in {:.2f}s'.format(len(plans), time.time() - start)
+
+
+def benchmark(gt_config, aws_profile, sizes, latency, api_latency, failure_rate,
+              poll_interval, seed, output, **kwargs):
+    latencies = {}
+    for setting in latency:
+        resource_type, seconds = setting.rsplit('=', 1)
+        latencies[resource_type] = float(seconds)
+    report = run_benchmarks(aws_profile, gt_config,
+                            sizes=[int(size) for size in sizes.split(',') if size],
+                            latencies=latencies,
+                            api_latency=api_latency,
+                            failure_rate=failure_rate,
+                            poll_interval=poll_interval,
+                            seed=seed)
+
+    print '{:<16} {:>6} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'graph', 'nodes', 'wall', 'critical', 'overhead', 'cpu', 'calls')
+    for result in report['results']:
+        print '{:<16} {:>6} {:>8.2f}s {:>8.2f}s {:>8.2f}s {:>8.2f}s {:>9}{}'.format(
+            result['graph'], result['nodes'], result['wall_time'], result['critical_path'],
+            result['scheduler_overhead'], result['cpu_time'], result['api_calls_total'],
+            '' if result['succeeded'] else ' ({} failed)'.format(result['failed_nodes']))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+def autoscale(gt_config, aws_profile, group_name, mesos_url, namenode_url, interval,
+              iterations, dry_run, target_utilization, scale_out_threshold,
+              scale_in_threshold, scale_out_cooldown, scale_in_cooldown, **kwargs):
+    logger = logging.getLogger('autoscaling')
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    group_name = group_name or get_follower_group(aws_profile, gt_config)
+    if ',' in group_name:
+        sys.exit('The followers are spread over the fixed size spot pool groups {}, which '
+                 'can\'t be autoscaled'.format(group_name))
+    policy = ScalingPolicy(target_utilization=target_utilization,
+                           scale_out_threshold=scale_out_threshold,
+                           scale_in_threshold=scale_in_threshold,
+                           scale_out_cooldown=scale_out_cooldown,
+                           scale_in_cooldown=scale_in_cooldown)
+    controller = ScalingController(ClusterMetricsReader(mesos_url, namenode_url or None),
+                                   AutoScalingGroup(group_name, gt_config['Region'], aws_profile),
+                                   policy=policy, dry_run=dry_run)
+    logger.info('Scaling %s every %ds', group_name, interval)
+    controller.run(interval, iterations)
+
+
+def preview_config(gt_config, component, instance_type, extra_vars, output_dir, **kwargs):
+    overrides = dict(setting.split('=', 1) for setting in extra_vars)
+    instance_type = instance_type or gt_config['MesosFollowerInstanceType']
+    for file_name, contents in render_role_config(component, instance_type, overrides):
+        if output_dir:
+            if not os.path.isdir(output_dir):
+                os.makedirs(output_dir)
+            with open(os.path.join(output_dir, file_name), 'w') as f:
+                f.write(contents)
+        else:
+            print '# {} for {}'.format(file_name, instance_type)
+            print contents
+
+
+def create_ami(machine_types, aws_profile, gt_config, offline, ubuntu_index, force, update_lock,
+               **kwargs):
+    run_packer(machine_types,
                aws_profile=aws_profile,
                region=gt_config['Region'],
-               stack_type=gt_config['StackType'])
+               stack_type=gt_config['StackType'],
+               offline=offline,
+               ubuntu_index=ubuntu_index,
+               force=force,
+               update_lock=update_lock)
 
 
 def main():
@@ -38,12 +174,106 @@ def main():
     # Launch GeoTrellis Stack
     gt_stacks = subparsers.add_parser('launch-stacks', help='Launch GeoTrellis Spark Stack',
                                 parents=[common_parser,])
+    gt_stacks.add_argument('--preview-updates', action='store_true',
+                           help='Create change sets for stacks that have changed without executing them')
+    gt_stacks.add_argument('--yes', action='store_true',
+                           help='Execute change sets without asking for confirmation')
+    gt_stacks.add_argument('--rechoose-spot-pools', action='store_true',
+                           help='Choose the follower spot pools from the current prices, '
+                           'which can replace follower groups, instead of keeping the deployed ones')
+    gt_stacks.add_argument('--trace-file',
+                           help='Write a Chrome trace of the launch to this file')
+    gt_stacks.add_argument('--graphite-host',
+                           help='Send the timings of the launch to this Graphite host')
+    gt_stacks.add_argument('--graphite-port', type=int, default=2003,
+                           help='Graphite plaintext protocol port')
     gt_stacks.set_defaults(func=launch_stacks)
 
+    # Plan GeoTrellis Stack
+    gt_plan = subparsers.add_parser('plan', help='Show what launch-stacks would do, without AWS',
+                                    parents=[common_parser,])
+    gt_plan.add_argument('--fixtures', help='Answer AWS lookups from a recorded fixtures file')
+    gt_plan.add_argument('--record', metavar='FIXTURES',
+                         help='Record fixtures from AWS to this file, then plan against them')
+    gt_plan.add_argument('--template-dir', help='Write the rendered templates to this directory')
+    gt_plan.add_argument('--json', dest='json_output', action='store_true',
+                         help='Print the plan as JSON')
+    gt_plan.add_argument('--rechoose-spot-pools', action='store_true',
+                         help='Choose the follower spot pools from the current prices')
+    gt_plan.set_defaults(func=plan_launch)
+
+    # Benchmark the stack graph scheduler
+    gt_bench = subparsers.add_parser('benchmark', help='Benchmark launching graphs against a simulated AWS',
+                                     parents=[common_parser,])
+    gt_bench.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                          help='Comma separated node counts of the synthetic graphs')
+    gt_bench.add_argument('--latency', action='append', default=[], metavar='TYPE=SECONDS',
+                          help='Seconds a resource type takes to create (`default` for all others)')
+    gt_bench.add_argument('--api-latency', type=float, default=0,
+                          help='Seconds each API call takes')
+    gt_bench.add_argument('--failure-rate', type=float, default=0,
+                          help='Chance of each resource failing')
+    gt_bench.add_argument('--poll-interval', type=float, default=0.05,
+                          help='Seconds between stack status checks')
+    gt_bench.add_argument('--seed', type=int, default=0,
+                          help='Seed for the synthetic graphs and failures')
+    gt_bench.add_argument('--output', help='Save the results as JSON to this file')
+    gt_bench.set_defaults(func=benchmark)
+
+    # Autoscale the Mesos followers
+    gt_scale = subparsers.add_parser('autoscale', help='Scale the Mesos followers to the load on the cluster',
+                                     parents=[common_parser,])
+    gt_scale.add_argument('--group-name',
+                          help='Follower auto scaling group (looked up from the follower stack by default)')
+    gt_scale.add_argument('--mesos-url', default='http://mesos-leader.service.geotrellis-spark.internal:5050',
+                          help='URL of the Mesos master')
+    gt_scale.add_argument('--namenode-url', default='http://namenode.service.geotrellis-spark.internal:50070',
+                          help='URL of the HDFS namenode (empty to not protect followers holding blocks)')
+    gt_scale.add_argument('--interval', type=int, default=60,
+                          help='Seconds between scaling decisions')
+    gt_scale.add_argument('--iterations', type=int,
+                          help='Number of scaling decisions to make before exiting (forever by default)')
+    gt_scale.add_argument('--dry-run', action='store_true',
+                          help='Log scaling decisions without changing the group')
+    gt_scale.add_argument('--target-utilization', type=float, default=0.7,
+                          help='Share of CPU and memory the followers should be using after scaling')
+    gt_scale.add_argument('--scale-out-threshold', type=float, default=0.85,
+                          help='Utilization above which to add followers')
+    gt_scale.add_argument('--scale-in-threshold', type=float, default=0.4,
+                          help='Utilization below which to remove followers')
+    gt_scale.add_argument('--scale-out-cooldown', type=int, default=300,
+                          help='Seconds after adding followers before adding more')
+    gt_scale.add_argument('--scale-in-cooldown', type=int, default=900,
+                          help='Seconds after any scaling before removing followers')
+    gt_scale.set_defaults(func=autoscale)
+
+    # Preview configuration rendered by the Ansible roles
+    gt_preview = subparsers.add_parser('preview-config',
+                                       help='Render the configuration a role writes for an instance type',
+                                       parents=[common_parser,])
+    gt_preview.add_argument('component', choices=sorted(ROLE_PREVIEWS),
+                            help='Component to render the configuration of')
+    gt_preview.add_argument('--instance-type',
+                            help='Instance type to size the configuration for '
+                                 '(defaults to MesosFollowerInstanceType)')
+    gt_preview.add_argument('-e', '--extra-var', dest='extra_vars', action='append', default=[],
+                            metavar='NAME=VALUE', help='Set an Ansible variable')
+    gt_preview.add_argument('--output-dir', help='Write the files to this directory')
+    gt_preview.set_defaults(func=preview_config)
+
     # AMI Management
     gt_ami = subparsers.add_parser('create-ami', help='Create AMI for GeoTrellis-Spark Stack',
                                    parents=[common_parser,])
-    gt_ami.add_argument('machine_type', help='Type of AMI to build for GeoTrellis-Spark')
+    gt_ami.add_argument('machine_types', nargs='+', metavar='machine_type',
+                        help='Types of AMI to build for GeoTrellis-Spark, or `all`')
+    gt_ami.add_argument('--offline', action='store_true',
+                        help='Use the cached Ubuntu AMI index and ansible roles instead of downloading them')
+    gt_ami.add_argument('--ubuntu-index', metavar='FILE',
+                        help='Copy of Ubuntu\'s released.current.txt to find the base AMI in')
+    gt_ami.add_argument('--force', action='store_true',
+                        help='Build the AMIs even if they are up to date')
+    gt_ami.add_argument('--update-lock', action='store_true',
+                        help='Lock the ansible roles in roles.txt at their current contents in roles.lock')
     gt_ami.set_defaults(func=create_ami)
 
     # Parse and Run
@@ -1,61 +1,474 @@
 """Helper functions to handle AMI creation with packer"""
 
 import boto
+import boto.ec2
+import hashlib
+import json
 import os
+import shutil
+import socket
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 import logging
 import urllib2
 import csv
+import re
+
+from multiprocessing.pool import ThreadPool
 
 LOGGER = logging.getLogger('geotrellis_spark')
 
+PACKER_TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'template.js')
+
+DEPLOYMENT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+ANSIBLE_DIR = os.path.join(DEPLOYMENT_DIR, 'ansible')
+ANSIBLE_ROLES_PATH = os.path.join(ANSIBLE_DIR, 'roles')
+ANSIBLE_ROLES_FILE = os.path.join(ANSIBLE_DIR, 'roles.txt')
+ANSIBLE_ROLES_LOCK = os.path.join(ANSIBLE_DIR, 'roles.lock')
+ROLE_CACHE_PATH = os.path.expanduser('~/.geotrellis-ec2-cluster/roles')
+# written by ansible-galaxy with the install date, so left out of role hashes
+GALAXY_INSTALL_INFO = os.path.join('meta', '.galaxy_install_info')
+
+# AMIs are built in layers: machine types are built on top of the AMI of
+# their parent layer rather than a bare Ubuntu AMI
+LAYER_PARENTS = {
+    'mesos-leader': 'mesos-base',
+    'mesos-follower': 'mesos-base'
+}
+# ansible inputs shared by every layer
+ANSIBLE_SHARED_INPUTS = ['group_vars/all', 'group_vars/packer', 'filter_plugins', 'vars']
+ROLE_REFERENCE = re.compile(r'role:\s*["\']?([\w.-]+)')
+
+UBUNTU_RELEASES_URL = 'http://cloud-images.ubuntu.com/query/trusty/server/released.current.txt'
+UBUNTU_INDEX_CACHE_PATH = os.path.expanduser('~/.geotrellis-ec2-cluster/ubuntu-amis.json')
+UBUNTU_RELEASES_FIELDNAMES = ['version', 'version_type', 'release_status', 'date',
+                              'storage', 'arch', 'region', 'id', 'kernel',
+                              'unknown_col', 'virtualization_type']
+
 
 class GTAMIException(Exception):
     pass
 
 
-def get_ubuntu_ami(region):
-    """Gets AMI ID for current release in region"""
-    response = urllib2.urlopen('http://cloud-images.ubuntu.com/query/trusty/server/released.current.txt').readlines()
-    fieldnames = ['version', 'version_type', 'release_status', 'date',
-                  'storage', 'arch', 'region', 'id', 'kernel',
-                  'unknown_col', 'virtualization_type']
-    reader = csv.DictReader(response, fieldnames=fieldnames, delimiter='\t')
+def ubuntu_index_key(region, arch, storage, virtualization_type):
+    return '|'.join([region, arch, storage, virtualization_type])
+
+
+def parse_ubuntu_index(lines):
+    """Indexes the AMIs in Ubuntu's release listing
+
+    The listing is read a line at a time, so it can be parsed straight off
+    of the network. Rows which don't look like the listing's format are
+    skipped.
+
+    Args:
+      lines (iterable): lines of `released.current.txt`
+
+    Returns:
+      dict: AMI IDs keyed by ubuntu_index_key
+    """
+    amis = {}
+    for row in csv.reader(lines, delimiter='\t'):
+        if len(row) < len(UBUNTU_RELEASES_FIELDNAMES):
+            continue
+        ami = dict(zip(UBUNTU_RELEASES_FIELDNAMES, row))
+        if not ami['id'].startswith('ami-'):
+            continue
+        key = ubuntu_index_key(ami['region'], ami['arch'], ami['storage'],
+                               ami['virtualization_type'])
+        amis.setdefault(key, []).append(ami['id'])
+    if not amis:
+        raise GTAMIException('Did not find any AMIs in the Ubuntu release listing, '
+                             'has its format changed?')
+    return amis
+
+
+def _read_ubuntu_index_cache():
+    """Returns the cached Ubuntu AMI index, or None if there isn't one"""
+    try:
+        with open(UBUNTU_INDEX_CACHE_PATH, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_ubuntu_index_cache(cached):
+    cache_dir = os.path.dirname(UBUNTU_INDEX_CACHE_PATH)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    with open(UBUNTU_INDEX_CACHE_PATH, 'w') as f:
+        json.dump(cached, f, indent=2, sort_keys=True)
+
+
+def _fetch_ubuntu_index(cached):
+    """Downloads and indexes Ubuntu's release listing
+
+    If there is a cached index the download is conditional on its ETag and
+    Last-Modified date.
+
+    Args:
+      cached (dict): the cached index, if any
+
+    Returns:
+      dict: a new index to cache, or None if the cached one is current
+    """
+    request = urllib2.Request(UBUNTU_RELEASES_URL)
+    if cached is not None:
+        if cached.get('etag'):
+            request.add_header('If-None-Match', cached['etag'])
+        if cached.get('last_modified'):
+            request.add_header('If-Modified-Since', cached['last_modified'])
+    try:
+        response = urllib2.urlopen(request, timeout=30)
+    except urllib2.HTTPError as e:
+        if e.code == 304:
+            return None
+        raise
+    try:
+        amis = parse_ubuntu_index(response)
+        headers = response.info()
+    finally:
+        response.close()
+    return {'etag': headers.getheader('ETag'),
+            'last_modified': headers.getheader('Last-Modified'),
+            'amis': amis}
+
+
+def load_ubuntu_index(offline=False, index_file=None, max_age=3600):
+    """Returns the index of Ubuntu's released AMIs
+
+    The index is cached on disk. A cache younger than `max_age` seconds is
+    used as is, an older one is revalidated with the server, and if the
+    server can't be reached the cache is used regardless of its age.
+
+    Args:
+      offline (bool): only use the cache, never the network
+      index_file (str): path of a copy of `released.current.txt` to use
+        instead of downloading it
+      max_age (int): seconds to use the cache before revalidating it
+
+    Returns:
+      dict: AMI IDs keyed by ubuntu_index_key
+    """
+    if index_file:
+        with open(index_file, 'r') as f:
+            return parse_ubuntu_index(f)
+
+    cached = _read_ubuntu_index_cache()
+    if offline:
+        if cached is None:
+            raise GTAMIException('No cached Ubuntu AMI index at {}, run once without offline '
+                                 'or provide an index file'.format(UBUNTU_INDEX_CACHE_PATH))
+        return cached['amis']
+    if cached is not None and time.time() - cached.get('fetched', 0) < max_age:
+        return cached['amis']
+
+    try:
+        fetched = _fetch_ubuntu_index(cached)
+    except (urllib2.URLError, socket.error, GTAMIException) as e:
+        if cached is None:
+            raise GTAMIException('Unable to get Ubuntu AMI index from {}: {}'.format(
+                UBUNTU_RELEASES_URL, e))
+        LOGGER.warning('Unable to refresh Ubuntu AMI index (%s), using cached copy', e)
+        return cached['amis']
+    if fetched is None:
+        fetched = cached
+    fetched['fetched'] = time.time()
+    _write_ubuntu_index_cache(fetched)
+    return fetched['amis']
 
-    def ami_filter(ami):
-        """Helper function to filter AMIs"""
-        return (ami['region'] == region and
-                ami['arch'] == 'amd64' and
-                ami['storage'] == 'ebs-ssd' and
-                ami['virtualization_type'] == 'hvm')
 
-    amis = [row for row in reader if ami_filter(row)]
+def get_ubuntu_ami(region, offline=False, index_file=None):
+    """Gets AMI ID for current release in region
+
+    Args:
+      region (str): AWS region of the AMI
+      offline (bool): only use the cached index, never the network
+      index_file (str): path of a copy of `released.current.txt` to use
+    """
+    amis = load_ubuntu_index(offline=offline, index_file=index_file).get(
+        ubuntu_index_key(region, 'amd64', 'ebs-ssd', 'hvm'), [])
     if len(amis) == 0:
         raise GTAMIException('Did not find any ubuntu AMIs to use')
     elif len(amis) > 1:
         raise GTAMIException('Found multiple ubuntu AMIs to use, should only be one')
-    return amis[0]['id']
+    return amis[0]
 
 
-def update_ansible_roles():
-    """Function that runs command to update ansible roles to verify they are up-to-date before running packer"""
-    ansible_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'ansible')
-    ansible_roles_path = os.path.join(ansible_dir, 'roles')
-    ansible_command = ['ansible-galaxy', 'install', '-f', '-r', 'roles.txt', '-p', ansible_roles_path]
-    subprocess.check_call(ansible_command, cwd=ansible_dir)
+def read_roles_file(roles_file):
+    """Returns the (name, version) of each role in a roles.txt file"""
+    roles = []
+    with open(roles_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                name, version = [part.strip() for part in line.split(',', 1)]
+                roles.append((name, version))
+    return roles
 
 
-def run_packer(machine_type, aws_profile, region, stack_type):
-    """Function to run packer
+def hash_role(role_path):
+    """Returns a digest of the contents of an installed role
 
     Args:
-      machine_type (str): type of machine to build (e.g. mesos-leader, mesos-follower)
-      aws_profile (str): aws profile name to use for authentication
-      stack_type (str): type of stack this machine is for (e.g. accumulo geotrellis cluster)
+      role_path (str): directory of the role
+    """
+    h = hashlib.sha256()
+    for dir_path, dir_names, file_names in os.walk(role_path):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            path = os.path.join(dir_path, file_name)
+            relative_path = os.path.relpath(path, role_path)
+            if relative_path == GALAXY_INSTALL_INFO:
+                continue
+            h.update(relative_path)
+            with open(path, 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+    return h.hexdigest()
+
+
+def _read_roles_lock():
+    try:
+        with open(ANSIBLE_ROLES_LOCK, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_roles_lock(lock):
+    with open(ANSIBLE_ROLES_LOCK, 'w') as f:
+        json.dump(lock, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def _fetch_role(role):
+    """Downloads a role with ansible-galaxy into the role cache
+
+    Args:
+      role (tuple): name and version of the role
+
+    Returns:
+      str: directory of the role in the cache
     """
+    name, version = role
+    download_dir = tempfile.mkdtemp()
+    try:
+        ansible_command = ['ansible-galaxy', 'install', '--no-deps',
+                           '{},{}'.format(name, version), '-p', download_dir]
+        subprocess.check_call(ansible_command, cwd=ANSIBLE_DIR)
+        cache_path = os.path.join(ROLE_CACHE_PATH, '{}-{}'.format(name, version))
+        if os.path.isdir(cache_path):
+            shutil.rmtree(cache_path)
+        shutil.move(os.path.join(download_dir, name), cache_path)
+    finally:
+        shutil.rmtree(download_dir)
+    return cache_path
+
+
+def update_ansible_roles(offline=False, update_lock=False, max_downloads=8):
+    """Installs the ansible roles locked in roles.lock which have changed
+
+    roles.lock is committed, and records the version and a content hash of
+    each role in roles.txt. Installed roles which still match the lock are
+    left alone. The rest are copied from the local role cache or, if they
+    aren't cached, downloaded with ansible-galaxy concurrently, and a role
+    whose content doesn't match its locked hash is an error, so every bake
+    uses the same roles. A role without a locked version and hash is an
+    error too. The lock is only written with `update_lock`, which locks the
+    roles in roles.txt at their current contents.
+
+    Args:
+      offline (bool): only install roles from the local role cache
+      update_lock (bool): lock the roles in roles.txt, accepting new
+        versions and contents
+      max_downloads (int): most roles to download at once
+
+    Raises:
+      GTAMIException: if a role in roles.txt isn't locked at its version
+        with a hash, or doesn't match its locked hash, without `update_lock`
+    """
+    lock = _read_roles_lock()
+    roles = read_roles_file(ANSIBLE_ROLES_FILE)
+    if not update_lock:
+        unlocked = ['{},{}'.format(name, version) for name, version in roles
+                    if lock.get(name, {}).get('version') != version or
+                    not lock[name].get('sha256')]
+        if unlocked:
+            raise GTAMIException(
+                'Roles {} are not locked in roles.lock, run create-ami with --update-lock '
+                'and commit roles.lock'.format(', '.join(unlocked)))
+    if not os.path.isdir(ROLE_CACHE_PATH):
+        os.makedirs(ROLE_CACHE_PATH)
+
+    changed = []
+    for name, version in roles:
+        locked = lock.get(name, {})
+        role_path = os.path.join(ANSIBLE_ROLES_PATH, name)
+        if (locked.get('version') == version and locked.get('sha256') and
+                os.path.isdir(role_path) and hash_role(role_path) == locked['sha256']):
+            continue
+        changed.append((name, version))
+
+    cache_paths = {}
+    to_fetch = []
+    for name, version in changed:
+        cache_path = os.path.join(ROLE_CACHE_PATH, '{}-{}'.format(name, version))
+        if os.path.isdir(cache_path):
+            cache_paths[name] = cache_path
+        else:
+            to_fetch.append((name, version))
+    if to_fetch and offline:
+        raise GTAMIException('Roles {} are not in the role cache at {}'.format(
+            ', '.join('{},{}'.format(*role) for role in to_fetch), ROLE_CACHE_PATH))
+    if to_fetch:
+        pool = ThreadPool(min(max_downloads, len(to_fetch)))
+        try:
+            fetched = pool.map(_fetch_role, to_fetch)
+        finally:
+            pool.close()
+        cache_paths.update(zip([name for name, _ in to_fetch], fetched))
+
+    new_lock = dict((name, lock.get(name)) for name, _ in roles)
+    for name, version in changed:
+        role_hash = hash_role(cache_paths[name])
+        if not update_lock and lock[name]['sha256'] != role_hash:
+            raise GTAMIException(
+                'Role {},{} does not match roles.lock, run create-ami with --update-lock '
+                'to accept its new contents'.format(name, version))
+        role_path = os.path.join(ANSIBLE_ROLES_PATH, name)
+        if os.path.isdir(role_path):
+            shutil.rmtree(role_path)
+        shutil.copytree(cache_paths[name], role_path)
+        new_lock[name] = {'version': version, 'sha256': role_hash}
+        LOGGER.info('Installed ansible role %s,%s', name, version)
+    if not changed:
+        LOGGER.info('Ansible roles match roles.lock')
+    if update_lock and new_lock != lock:
+        _write_roles_lock(new_lock)
+        LOGGER.info('Updated roles.lock, commit it to use these roles for every bake')
+
+
+def get_packer_template():
+    with open(PACKER_TEMPLATE_PATH, 'r') as f:
+        return json.load(f)
 
-    # credentials
+
+def get_packer_builders():
+    """Returns the names of the builders in the packer template"""
+    return [builder['name'] for builder in get_packer_template()['builders']]
+
+
+def get_role_closure(playbook_path):
+    """Returns the roles a playbook uses, including the roles they depend on
+
+    Args:
+      playbook_path (str): path of the playbook
+    """
+    with open(playbook_path, 'r') as f:
+        to_visit = ROLE_REFERENCE.findall(f.read())
+    roles = set()
+    while to_visit:
+        role = to_visit.pop()
+        if role in roles:
+            continue
+        roles.add(role)
+        meta_path = os.path.join(ANSIBLE_ROLES_PATH, role, 'meta', 'main.yml')
+        if os.path.isfile(meta_path):
+            with open(meta_path, 'r') as f:
+                to_visit.extend(ROLE_REFERENCE.findall(f.read()))
+    return sorted(roles)
+
+
+def _hash_path(h, path):
+    """Adds a file, or every file under a directory, to a hash"""
+    if os.path.isdir(path):
+        for dir_path, dir_names, file_names in os.walk(path):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                if not file_name.endswith('.pyc'):
+                    _hash_path(h, os.path.join(dir_path, file_name))
+    elif os.path.isfile(path):
+        h.update(os.path.relpath(path, DEPLOYMENT_DIR))
+        with open(path, 'rb') as f:
+            h.update(hashlib.sha256(f.read()).digest())
+
+
+def fingerprint_layer(machine_type, stack_type, source):
+    """Returns a fingerprint of everything that goes into an AMI
+
+    The fingerprint covers the machine type's builder and provisioners in
+    the packer template, the playbooks, inventories and cloud-config they
+    use, the group_vars, the contents of every role the playbooks use and
+    the AMI the layer is built on.
+
+    Args:
+      machine_type (str): name of the builder
+      stack_type (str): type of stack the AMI is for
+      source (str): the AMI ID or fingerprint of the layer it is built on
+    """
+    template = get_packer_template()
+    builder = [builder for builder in template['builders']
+               if builder['name'] == machine_type][0]
+    provisioners = [provisioner for provisioner in template['provisioners']
+                    if machine_type in provisioner.get('only', [machine_type])]
+
+    def render(value):
+        return value.replace('{{user `stack_type`}}', stack_type)
+
+    h = hashlib.sha256()
+    h.update(json.dumps({'builder': builder,
+                         'provisioners': provisioners,
+                         'stack_type': stack_type,
+                         'source': source}, sort_keys=True))
+    paths = [render(builder['user_data_file'])] if 'user_data_file' in builder else []
+    roles = set()
+    for provisioner in provisioners:
+        for key in ('playbook_file', 'inventory_file'):
+            if key in provisioner:
+                paths.append(render(provisioner[key]))
+        if 'playbook_file' in provisioner:
+            roles.update(get_role_closure(
+                os.path.join(DEPLOYMENT_DIR, render(provisioner['playbook_file']))))
+    paths.extend(os.path.join('ansible', path) for path in ANSIBLE_SHARED_INPUTS)
+    for path in paths:
+        _hash_path(h, os.path.join(DEPLOYMENT_DIR, path))
+    for role in sorted(roles):
+        role_path = os.path.join(ANSIBLE_ROLES_PATH, role)
+        h.update(role)
+        if os.path.isdir(role_path):
+            h.update(hash_role(role_path))
+    return h.hexdigest()
+
+
+def find_layer_ami(conn, machine_type, stack_type, fingerprint):
+    """Returns the ID of an AMI built with a fingerprint, or None
+
+    Args:
+      conn (EC2Connection): connection to the region of the AMI
+      machine_type (str): name of the builder
+      stack_type (str): type of stack the AMI is for
+      fingerprint (str): fingerprint of the layer
+    """
+    images = conn.get_all_images(owners='self', filters={
+        'tag:Name': machine_type,
+        'tag:StackType': stack_type,
+        'tag:Fingerprint': fingerprint
+    })
+    if not images:
+        return None
+    return sorted(images, key=lambda image: image.tags.get('Created'), reverse=True)[0].id
+
+
+def get_packer_env(aws_profile):
+    """Returns an environment for running packer with an AWS profile's credentials
+
+    Args:
+      aws_profile (str): aws profile name to use for authentication
+    """
     aws_dir = os.path.expanduser('~/.aws')
     boto_config_path = os.path.join(aws_dir, 'config')
     aws_creds_path = os.path.join(aws_dir, 'credentials')
@@ -63,22 +476,160 @@ def run_packer(machine_type, aws_profile, region, stack_type):
     aws_access_key_id = boto.config.get(aws_profile, 'aws_access_key_id')
     aws_secret_access_key = boto.config.get(aws_profile, 'aws_secret_access_key')
 
-    aws_ubuntu_ami = get_ubuntu_ami(region)
-
-    update_ansible_roles()
-
     # use environment variables when running packer because you cannot specify an
     # AWS profile in ~/.aws/credentials to use with packer
     env = os.environ.copy()
     env['AWS_ACCESS_KEY'] = aws_access_key_id
     env['AWS_SECRET_ACCESS_KEY'] = aws_secret_access_key
-    packer_template_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'template.js')
-    LOGGER.info('Creating %s AMI in %s region', machine_type, region)
-    packer_command = ['packer', 'build',
-                      '-var', 'aws_region={}'.format(region),
-                      '-var', 'aws_ubuntu_ami={}'.format(aws_ubuntu_ami),
-                      '-var', 'stack_type={}'.format(stack_type),
-                      '-only', machine_type,
-                      packer_template_path]
-    LOGGER.debug('Running Packer Command: %s', ' '.join(packer_command))
-    subprocess.check_call(packer_command, env=env)
+    return env
+
+
+def stream_output(prefix, stream, lock):
+    """Copies a process's output to stdout a line at a time, with a prefix
+
+    Args:
+      prefix (str): text to put in front of each line
+      stream (file): output of the process
+      lock (Lock): lock shared by every stream written to stdout
+    """
+    for line in iter(stream.readline, ''):
+        write_prefixed(prefix, line, lock)
+
+
+def write_prefixed(prefix, line, lock):
+    with lock:
+        sys.stdout.write('[{}] {}'.format(prefix, line))
+        sys.stdout.flush()
+
+
+def run_builds(builds, env):
+    """Runs packer builds at the same time, streaming their output
+
+    Args:
+      builds (list): (machine type, packer variables) of each build
+      env (dict): environment to run packer in
+
+    Returns:
+      list: machine types whose builds failed
+    """
+    lock = threading.Lock()
+    processes = []
+    try:
+        for machine_type, variables in builds:
+            packer_command = ['packer', 'build', '-color=false']
+            for name, value in sorted(variables.iteritems()):
+                packer_command.extend(['-var', '{}={}'.format(name, value)])
+            packer_command.extend(['-only', machine_type, PACKER_TEMPLATE_PATH])
+            LOGGER.debug('Running Packer Command: %s', ' '.join(packer_command))
+            process = subprocess.Popen(packer_command, env=env,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            output_thread = threading.Thread(target=stream_output,
+                                             args=(machine_type, process.stdout, lock))
+            output_thread.start()
+            processes.append((machine_type, process, output_thread))
+
+        failed_types = []
+        for machine_type, process, output_thread in processes:
+            process.wait()
+            output_thread.join()
+            if process.returncode != 0:
+                failed_types.append(machine_type)
+    except KeyboardInterrupt:
+        for _, process, _ in processes:
+            if process.poll() is None:
+                process.terminate()
+        raise
+    return failed_types
+
+
+def run_packer(machine_types, aws_profile, region, stack_type, offline=False,
+               ubuntu_index=None, force=False, update_lock=False):
+    """Function to run packer
+
+    AMIs are built in layers. A base layer with the roles every machine
+    shares is built on Ubuntu, and the other machine types are built on top
+    of it. Each AMI is tagged with a fingerprint of its inputs, and a layer
+    whose fingerprint already exists is not built again.
+
+    Credentials, the Ubuntu AMI and the ansible roles are prepared once.
+    The base layer is built first if it has changed, then every other
+    machine type at the same time. The output of each build is streamed
+    with the machine type as a prefix.
+
+    Args:
+      machine_types (list): types of machine to build (e.g. mesos-leader,
+        mesos-follower), or `all` for every builder in the template
+      aws_profile (str): aws profile name to use for authentication
+      region (str): AWS region to build the AMIs in
+      stack_type (str): type of stack this machine is for (e.g. accumulo geotrellis cluster)
+      offline (bool): use the cached Ubuntu AMI index and role cache rather
+        than the network
+      ubuntu_index (str): path of a copy of Ubuntu's release listing to use
+      force (bool): build the requested machine types even if an AMI with
+        the same fingerprint exists
+      update_lock (bool): lock the ansible roles in roles.txt at their
+        current contents rather than checking them against roles.lock
+    """
+    if isinstance(machine_types, basestring):
+        machine_types = [machine_types]
+    builders = get_packer_builders()
+    if 'all' in machine_types:
+        machine_types = builders
+    unknown_types = [machine_type for machine_type in machine_types
+                     if machine_type not in builders]
+    if unknown_types:
+        raise GTAMIException('Unknown machine types {}, expected one of {}'.format(
+            ', '.join(unknown_types), ', '.join(builders)))
+
+    env = get_packer_env(aws_profile)
+
+    aws_ubuntu_ami = get_ubuntu_ami(region, offline=offline, index_file=ubuntu_index)
+
+    update_ansible_roles(offline=offline, update_lock=update_lock)
+
+    conn = boto.ec2.connect_to_region(region, profile_name=aws_profile)
+    variables = {'aws_region': region,
+                 'aws_ubuntu_ami': aws_ubuntu_ami,
+                 'stack_type': stack_type}
+    lock = threading.Lock()
+
+    # base layers first, then the layers built on them
+    layers = [[machine_type for machine_type in builders
+               if machine_type not in LAYER_PARENTS],
+              [machine_type for machine_type in builders
+               if machine_type in LAYER_PARENTS]]
+    needed = set(machine_types) | set(LAYER_PARENTS[machine_type]
+                                      for machine_type in machine_types
+                                      if machine_type in LAYER_PARENTS)
+    layer_amis = {}
+    fingerprints = {}
+    for layer in layers:
+        builds = []
+        for machine_type in layer:
+            if machine_type not in needed:
+                continue
+            parent = LAYER_PARENTS.get(machine_type)
+            source = fingerprints[parent] if parent else aws_ubuntu_ami
+            fingerprints[machine_type] = fingerprint_layer(machine_type, stack_type, source)
+            ami_id = find_layer_ami(conn, machine_type, stack_type,
+                                    fingerprints[machine_type])
+            if ami_id and not (force and machine_type in machine_types):
+                write_prefixed(machine_type, '{} is up to date, skipping build\n'.format(ami_id),
+                               lock)
+                layer_amis[machine_type] = ami_id
+                continue
+            LOGGER.info('Creating %s AMI in %s region', machine_type, region)
+            build_variables = dict(variables, fingerprint=fingerprints[machine_type])
+            if parent:
+                build_variables['base_ami'] = layer_amis[parent]
+            builds.append((machine_type, build_variables))
+
+        failed_types = run_builds(builds, env)
+        if failed_types:
+            raise GTAMIException('Packer failed to build {}'.format(', '.join(failed_types)))
+        for machine_type, _ in builds:
+            layer_amis[machine_type] = find_layer_ami(conn, machine_type, stack_type,
+                                                      fingerprints[machine_type])
+            if layer_amis[machine_type] is None:
+                raise GTAMIException('Unable to find the {} AMI packer built'.format(machine_type))
@@ -0,0 +1,113 @@
+"""Renders the configuration files the Ansible roles write, without a machine
+
+The role templates are rendered with Jinja2 the way Ansible renders them
+while baking an AMI: with the filters in `ansible/filter_plugins`, the
+variables of the role's defaults and the `all` and `packer` group_vars, and
+`item` set to `[instance type, file name]` for templates rendered once per
+instance type. Variables that only exist on a real machine, or in roles
+installed from Ansible Galaxy, are left in the output as `{{ name }}`.
+"""
+
+import imp
+import os
+
+import jinja2
+import yaml
+
+from gt_packer import ANSIBLE_DIR, ANSIBLE_ROLES_PATH
+
+
+# component to (role, templates rendered for an instance type)
+ROLE_PREVIEWS = {
+    'accumulo': ('geotrellis-spark-cluster.accumulo', ['accumulo-env.sh', 'accumulo-site.xml']),
+    'spark': ('geotrellis-spark-cluster.spark', ['spark-defaults.conf', 'spark-env.sh']),
+    'hdfs': ('geotrellis-spark-cluster.hdfs', ['hdfs-site.xml', 'core-site.xml'])
+}
+
+# passes over variables that refer to other variables
+MAX_VARIABLE_DEPTH = 5
+
+
+def load_filters():
+    """Loads the filters of every filter plugin
+
+    Returns:
+      dict: filter name to function
+    """
+    filters = {}
+    plugins_dir = os.path.join(ANSIBLE_DIR, 'filter_plugins')
+    for file_name in sorted(os.listdir(plugins_dir)):
+        name, ext = os.path.splitext(file_name)
+        if ext == '.py':
+            module = imp.load_source('filter_plugins_{}'.format(name),
+                                     os.path.join(plugins_dir, file_name))
+            filters.update(module.FilterModule().filters())
+    return filters
+
+
+def _load_yaml(path):
+    with open(path, 'r') as f:
+        return yaml.safe_load(f) or {}
+
+
+def load_variables(role):
+    """Loads the variables a role sees when an AMI is baked
+
+    Args:
+      role (str): name of the role
+
+    Returns:
+      dict: variables, with group_vars taking precedence over role defaults
+    """
+    variables = {}
+    defaults = os.path.join(ANSIBLE_ROLES_PATH, role, 'defaults', 'main.yml')
+    if os.path.isfile(defaults):
+        variables.update(_load_yaml(defaults))
+    variables.update(_load_yaml(os.path.join(ANSIBLE_DIR, 'group_vars', 'all')))
+    packer_vars = os.path.join(ANSIBLE_DIR, 'group_vars', 'packer')
+    for file_name in sorted(os.listdir(packer_vars)):
+        variables.update(_load_yaml(os.path.join(packer_vars, file_name)))
+    return variables
+
+
+def _resolve(env, value, variables):
+    if isinstance(value, basestring):
+        return env.from_string(value).render(variables) if '{' in value else value
+    if isinstance(value, list):
+        return [_resolve(env, item, variables) for item in value]
+    if isinstance(value, dict):
+        return {key: _resolve(env, item, variables) for key, item in value.iteritems()}
+    return value
+
+
+def render_role_config(component, instance_type, overrides=None):
+    """Renders the per-instance-type configuration files of a component
+
+    Args:
+      component (str): key of ROLE_PREVIEWS, e.g. `accumulo`
+      instance_type (str): instance type to render the files for
+      overrides (dict): variables to set over the role's and group_vars'
+
+    Returns:
+      list: (file name, rendered contents) tuples
+    """
+    role, templates = ROLE_PREVIEWS[component]
+    env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(os.path.join(ANSIBLE_ROLES_PATH, role, 'templates')),
+        undefined=jinja2.DebugUndefined,
+        trim_blocks=True,
+        keep_trailing_newline=True)
+    env.filters.update(load_filters())
+
+    variables = load_variables(role)
+    variables.update(overrides or {})
+    for _ in range(MAX_VARIABLE_DEPTH):
+        variables = {key: _resolve(env, value, variables)
+                     for key, value in variables.iteritems()}
+
+    rendered = []
+    for template in templates:
+        context = dict(variables, item=[instance_type, template],
+                       ansible_ec2_instance_type=instance_type)
+        rendered.append((template, env.get_template('{}.j2'.format(template)).render(context)))
+    return rendered
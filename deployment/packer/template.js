@@ -3,16 +3,37 @@
     "aws_region": "",
     "aws_ssh_username": "ubuntu",
     "aws_ubuntu_ami": "",
+    "base_ami": "",
+    "fingerprint": "",
     "stack_type": ""
   },
   "builders": [
     {
-      "name": "mesos-leader",
+      "name": "mesos-base",
       "type": "amazon-ebs",
       "region": "{{user `aws_region`}}",
       "source_ami": "{{user `aws_ubuntu_ami`}}",
       "instance_type": "m3.large",
       "ssh_username": "{{user `aws_ssh_username`}}",
+      "ami_name": "mesos-base-{{timestamp}}",
+      "run_tags": {
+        "PackerBuilder": "amazon-ebs"
+      },
+      "tags": {
+        "Name": "mesos-base",
+        "Created": "{{ isotime }}",
+        "StackType": "{{ user `stack_type` }}",
+        "Fingerprint": "{{ user `fingerprint` }}"
+      },
+      "associate_public_ip_address": true
+    },
+    {
+      "name": "mesos-leader",
+      "type": "amazon-ebs",
+      "region": "{{user `aws_region`}}",
+      "source_ami": "{{user `base_ami`}}",
+      "instance_type": "m3.large",
+      "ssh_username": "{{user `aws_ssh_username`}}",
       "ami_name": "mesos-leader-{{timestamp}}",
       "user_data_file": "cloud-config/packer-{{user `stack_type`}}-leader.yml",
       "run_tags": {
@@ -21,7 +42,8 @@
       "tags": {
         "Name": "mesos-leader",
         "Created": "{{ isotime }}",
-        "StackType": "{{ user `stack_type` }}"
+        "StackType": "{{ user `stack_type` }}",
+        "Fingerprint": "{{ user `fingerprint` }}"
       },
       "associate_public_ip_address": true
     },
@@ -29,7 +51,7 @@
       "name": "mesos-follower",
       "type": "amazon-ebs",
       "region": "{{user `aws_region`}}",
-      "source_ami": "{{user `aws_ubuntu_ami`}}",
+      "source_ami": "{{user `base_ami`}}",
       "instance_type": "m3.large",
       "ssh_username": "{{user `aws_ssh_username`}}",
       "ami_name": "mesos-follower-{{timestamp}}",
@@ -46,7 +68,8 @@
       "tags": {
         "Name": "mesos-follower",
         "Created": "{{ isotime }}",
-        "StackType": "{{ user `stack_type` }}"
+        "StackType": "{{ user `stack_type` }}",
+        "Fingerprint": "{{ user `fingerprint` }}"
       },
       "associate_public_ip_address": true
     }
@@ -59,6 +82,18 @@
         "sudo apt-get update -qq",
         "sudo apt-get install python-pip python-dev -y",
         "sudo pip install ansible==1.9.0.1"
+      ],
+      "only": [
+        "mesos-base"
+      ]
+    },
+    {
+      "type": "ansible-local",
+      "playbook_file": "ansible/{{user `stack_type`}}-base.yml",
+      "playbook_dir": "ansible",
+      "inventory_file": "ansible/inventory/packer-{{user `stack_type`}}-base",
+      "only": [
+        "mesos-base"
       ]
     },
     {
@@ -66,6 +101,9 @@
       "playbook_file": "ansible/{{user `stack_type`}}-leader.yml",
       "playbook_dir": "ansible",
       "inventory_file": "ansible/inventory/packer-{{user `stack_type`}}-leader",
+      "extra_arguments": [
+        "--extra-vars", "base_layer_installed=True"
+      ],
       "only": [
         "mesos-leader"
       ]
@@ -75,6 +113,9 @@
       "playbook_file": "ansible/{{user `stack_type`}}-follower.yml",
       "playbook_dir": "ansible",
       "inventory_file": "ansible/inventory/packer-{{user `stack_type`}}-follower",
+      "extra_arguments": [
+        "--extra-vars", "base_layer_installed=True"
+      ],
       "only": [
         "mesos-follower"
       ]
@@ -0,0 +1,221 @@
+import unittest
+
+from autoscaling.controller import ScalingController, ScalingPolicy
+from autoscaling.fakes import FakeAutoScalingGroup, FakeCluster
+from autoscaling.metrics import ClusterMetrics, ClusterMetricsReader
+
+
+def cluster_metrics(agents=2, cpus_per_agent=8, mem_per_agent=61440, cpus_used=0,
+                    mem_used=0, tasks_staging=0, spark_pending_tasks=0, hdfs_blocks=None):
+    return ClusterMetrics(
+        agents=agents, cpus_total=cpus_per_agent * agents, cpus_used=cpus_used,
+        cpus_offered=0, mem_total=mem_per_agent * agents, mem_used=mem_used,
+        mem_offered=0, tasks_staging=tasks_staging, spark_pending_stages=0,
+        spark_pending_tasks=spark_pending_tasks, hdfs_blocks=hdfs_blocks)
+
+
+class FakeReader(object):
+    """Reports the metrics it is given rather than reading a cluster"""
+
+    def __init__(self, metrics, namenode_url=None):
+        self.metrics = metrics
+        self.namenode_url = namenode_url
+
+    def read(self):
+        return self.metrics
+
+
+class FakeClock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class DesiredCapacityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = ScalingPolicy(target_utilization=0.7, scale_out_threshold=0.85,
+                                    scale_in_threshold=0.4)
+
+    def test_no_agents(self):
+        desired, reason = self.policy.desired_capacity(cluster_metrics(agents=0), 3)
+        self.assertEqual((desired, reason), (3, 'no Mesos agents have registered'))
+
+    def test_pending_work_beyond_idle_cpus(self):
+        # 8 CPUs in use and 20 pending at 5.6 CPUs a follower
+        metrics = cluster_metrics(cpus_used=8, tasks_staging=12, spark_pending_tasks=8)
+        self.assertEqual(self.policy.desired_capacity(metrics, 2)[0], 5)
+
+    def test_cpu_utilization_above_threshold(self):
+        # needs 3 followers, which is one more than it has
+        metrics = cluster_metrics(cpus_used=15)
+        self.assertEqual(self.policy.desired_capacity(metrics, 2)[0], 3)
+
+    def test_scales_out_to_what_the_load_needs(self):
+        # 72 CPUs in use need 13 followers at the target utilization
+        metrics = cluster_metrics(agents=10, cpus_used=72)
+        self.assertEqual(self.policy.desired_capacity(metrics, 10)[0], 13)
+
+    def test_scales_out_by_at_least_one(self):
+        # 4 followers are enough at the target, but above the threshold
+        policy = ScalingPolicy(target_utilization=0.9, scale_out_threshold=0.85)
+        metrics = cluster_metrics(agents=4, cpus_used=28)
+        self.assertEqual(policy.desired_capacity(metrics, 4)[0], 5)
+
+    def test_memory_utilization(self):
+        # CPUs are idle, but 0.9 of the memory is in use
+        metrics = cluster_metrics(agents=4, cpus_used=4, mem_used=0.9 * 4 * 61440)
+        self.assertEqual(self.policy.desired_capacity(metrics, 4)[0], 6)
+
+    def test_scales_in_one_step_at_a_time(self):
+        metrics = cluster_metrics(agents=4, cpus_used=2)
+        self.assertEqual(self.policy.desired_capacity(metrics, 4)[0], 3)
+        policy = ScalingPolicy(max_scale_in_step=2)
+        self.assertEqual(policy.desired_capacity(metrics, 4)[0], 2)
+
+    def test_scale_in_keeps_enough_for_the_load(self):
+        # 10 CPUs in use need 2 followers at the target utilization
+        metrics = cluster_metrics(agents=8, cpus_used=10)
+        policy = ScalingPolicy(max_scale_in_step=10)
+        self.assertEqual(policy.desired_capacity(metrics, 8)[0], 2)
+
+    def test_pending_tasks_hold_scale_in(self):
+        metrics = cluster_metrics(agents=4, cpus_used=2, spark_pending_tasks=1)
+        self.assertEqual(self.policy.desired_capacity(metrics, 4)[0], 4)
+
+    def test_holds_between_thresholds(self):
+        metrics = cluster_metrics(agents=4, cpus_used=20)
+        self.assertEqual(self.policy.desired_capacity(metrics, 4)[0], 4)
+
+
+class ScalingControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.group = FakeAutoScalingGroup(desired=4, min_size=2, max_size=6)
+        self.clock = FakeClock()
+        self.reader = FakeReader(cluster_metrics(agents=4))
+        self.controller = ScalingController(
+            self.reader, self.group, ScalingPolicy(scale_out_cooldown=300,
+                                                   scale_in_cooldown=900),
+            clock=self.clock)
+
+    def busy(self):
+        self.reader.metrics = cluster_metrics(agents=4, cpus_used=32, tasks_staging=40)
+
+    def idle(self):
+        self.reader.metrics = cluster_metrics(agents=4, cpus_used=0)
+
+    def test_scales_within_bounds(self):
+        self.busy()
+        decision = self.controller.step()
+        self.assertEqual((decision.current, decision.desired, decision.applied), (4, 6, True))
+        self.assertEqual(self.group.desired, 6)
+
+    def test_scale_out_cooldown(self):
+        self.group.max_size = 20
+        self.reader.metrics = cluster_metrics(agents=4, cpus_used=30)
+        self.assertEqual(self.controller.step().desired, 6)
+
+        self.clock.now += 299
+        decision = self.controller.step()
+        self.assertEqual((decision.desired, decision.reason),
+                         (6, 'cooling down after scaling out'))
+
+        self.clock.now += 1
+        self.assertEqual(self.controller.step().desired, 7)
+
+    def test_scale_in_cooldown(self):
+        self.busy()
+        self.controller.step()
+        self.idle()
+
+        self.clock.now += 899
+        decision = self.controller.step()
+        self.assertEqual((decision.desired, decision.reason),
+                         (6, 'cooling down after scaling'))
+
+        self.clock.now += 1
+        self.assertEqual(self.controller.step().desired, 5)
+
+        # scaling in starts the cooldown again
+        self.clock.now += 1
+        self.assertEqual(self.controller.step().desired, 5)
+
+    def test_scale_in_does_not_hold_scale_out(self):
+        self.idle()
+        self.assertEqual(self.controller.step().desired, 3)
+        self.busy()
+        self.clock.now += 1
+        self.assertEqual(self.controller.step().desired, 6)
+
+    def test_protects_followers_holding_blocks(self):
+        ips = [instance.private_ip for instance in self.group.instances]
+        self.reader.metrics = cluster_metrics(agents=4, cpus_used=20,
+                                              hdfs_blocks={ips[0]: 10, ips[1]: 0})
+        self.controller.step()
+        self.assertEqual([instance.protected for instance in self.group.instances],
+                         [True, False, False, False])
+
+        # and lose protection once their blocks are gone
+        self.reader.metrics = cluster_metrics(agents=4, cpus_used=20, hdfs_blocks={})
+        self.clock.now += 1000
+        self.controller.step()
+        self.assertFalse(any(instance.protected for instance in self.group.instances))
+
+    def test_never_shrinks_below_followers_holding_blocks(self):
+        self.reader.metrics = cluster_metrics(agents=4, hdfs_blocks={
+            instance.private_ip: 1 for instance in self.group.instances})
+        decision = self.controller.step()
+        self.assertEqual((decision.desired, decision.reason),
+                         (4, '4 followers hold HDFS blocks'))
+        self.assertEqual(self.group.desired, 4)
+
+    def test_holds_without_block_counts(self):
+        self.reader.namenode_url = 'http://namenode:50070'
+        self.idle()
+        decision = self.controller.step()
+        self.assertEqual((decision.desired, decision.reason),
+                         (4, 'HDFS block counts are unavailable'))
+
+    def test_scales_in_without_hdfs(self):
+        self.idle()
+        self.assertEqual(self.controller.step().desired, 3)
+
+    def test_dry_run(self):
+        self.controller.dry_run = True
+        self.busy()
+        decision = self.controller.step()
+        self.assertEqual((decision.desired, decision.applied), (6, False))
+        self.assertEqual(self.group.desired, 4)
+        self.assertEqual(self.group.actions, [])
+
+
+class FakeClusterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.group = FakeAutoScalingGroup(desired=2, min_size=1, max_size=6)
+        self.cluster = FakeCluster(self.group)
+        self.cluster.start()
+
+    def tearDown(self):
+        self.cluster.stop()
+
+    def test_step(self):
+        ips = self.cluster.agent_ips()
+        self.cluster.cpus_used = {ip: 8 for ip in ips}
+        self.cluster.tasks_staging = 20
+        self.cluster.hdfs_blocks = {ips[0]: 5}
+        controller = ScalingController(
+            ClusterMetricsReader(self.cluster.url, namenode_url=self.cluster.url),
+            self.group, clock=FakeClock())
+        decision = controller.step()
+        self.assertEqual((decision.current, decision.desired), (2, 6))
+        self.assertEqual(len(self.cluster.agent_ips()), 6)
+        self.assertTrue(self.group.instances[0].protected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+
+from collections import namedtuple
+
+from cfn.benchmark import SyntheticNode, build_synthetic_graph, critical_path
+from cfn.majorkirby import GlobalConfigNode, GraphExecutor
+
+
+FakeStack = namedtuple('FakeStack', ['duration'])
+
+
+class FakeRun(object):
+    """Stand-in for a FakeAWS which has run every stack of a graph"""
+
+    def __init__(self, executor, durations):
+        self.stacks = {'us-east-1': {}}
+        for node in executor.nodes:
+            node.region = 'us-east-1'
+            self.stacks['us-east-1'][node.stack_name] = FakeStack(durations[node.NAME])
+
+
+class BuildSyntheticGraphTest(unittest.TestCase):
+
+    def graph(self, size, **kwargs):
+        return GraphExecutor(build_synthetic_graph(size, **kwargs)).nodes
+
+    def test_size(self):
+        self.assertEqual(len(self.graph(25)), 25)
+
+    def test_fan_in(self):
+        for node in self.graph(25, fan_in=3, window=5):
+            self.assertLessEqual(len(node.requires), 3)
+
+    def test_window(self):
+        for node in self.graph(25, fan_in=2, window=4):
+            index = int(node.NAME[len('Synthetic'):])
+            for required in node.requires:
+                self.assertGreaterEqual(int(required[len('Synthetic'):]), index - 4)
+                self.assertLess(int(required[len('Synthetic'):]), index)
+
+    def test_seed(self):
+        def edges(seed):
+            return sorted((node.NAME, sorted(node.requires))
+                          for node in self.graph(25, seed=seed))
+        self.assertEqual(edges(1), edges(1))
+        self.assertNotEqual(edges(1), edges(2))
+
+
+class CriticalPathTest(unittest.TestCase):
+
+    def test_slowest_chain(self):
+        global_config = GlobalConfigNode(Region='us-east-1')
+        a = SyntheticNode('A', globalconfig=global_config)
+        b = SyntheticNode('B', [a], globalconfig=global_config)
+        c = SyntheticNode('C', [a], globalconfig=global_config)
+        d = SyntheticNode('D', [b, c], globalconfig=global_config)
+        executor = GraphExecutor([d])
+        run = FakeRun(executor, {'A': 1, 'B': 5, 'C': 2, 'D': 1})
+        self.assertEqual(critical_path(executor, run), 7)
+
+    def test_stacks_which_were_not_run(self):
+        global_config = GlobalConfigNode(Region='us-east-1')
+        a = SyntheticNode('A', globalconfig=global_config)
+        b = SyntheticNode('B', [a], globalconfig=global_config)
+        executor = GraphExecutor([b])
+        run = FakeRun(executor, {'A': 3, 'B': 1})
+        del run.stacks['us-east-1'][b.stack_name]
+        self.assertEqual(critical_path(executor, run), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
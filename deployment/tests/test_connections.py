@@ -0,0 +1,75 @@
+import threading
+import unittest
+
+from cfn import connections
+from cfn.connections import BotoBackend
+
+
+class FakeConnection(object):
+
+    def make_request(self, action, *args, **kwargs):
+        pass
+
+
+class CountingBackend(object):
+    """Backend which counts the connections it opens"""
+
+    def __init__(self):
+        self.opened = []
+
+    def connect(self, service, region, profile_name):
+        self.opened.append((service, region, profile_name))
+        return FakeConnection()
+
+
+class ConnectionRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = CountingBackend()
+        connections.reset()
+        connections.set_backend(self.backend)
+
+    def tearDown(self):
+        connections.set_backend(BotoBackend())
+        connections.reset()
+
+    def test_connections_are_reused(self):
+        conn = connections.get_connection('ec2', 'us-east-1', 'default')
+        self.assertIs(connections.get_connection('ec2', 'us-east-1', 'default'), conn)
+        self.assertEqual(len(self.backend.opened), 1)
+
+    def test_connections_are_shared_between_threads(self):
+        conns = []
+
+        def connect():
+            conns.append(connections.get_connection('cloudformation', 'us-east-1', 'default'))
+
+        threads = [threading.Thread(target=connect) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(conns), 8)
+        self.assertTrue(all(conn is conns[0] for conn in conns))
+        self.assertEqual(self.backend.opened, [('cloudformation', 'us-east-1', 'default')])
+
+    def test_connections_are_kept_per_service_region_and_profile(self):
+        for key in [('ec2', 'us-east-1', 'default'), ('ec2', 'us-west-2', 'default'),
+                    ('ec2', 'us-east-1', 'other'), ('route53', 'us-east-1', 'default')]:
+            connections.get_connection(*key)
+        self.assertEqual(len(self.backend.opened), 4)
+
+    def test_new_backend_drops_connections(self):
+        conn = connections.get_connection('ec2', 'us-east-1', 'default')
+        connections.set_backend(self.backend)
+        self.assertIsNot(connections.get_connection('ec2', 'us-east-1', 'default'), conn)
+
+    def test_calls_are_counted(self):
+        conn = connections.get_connection('ec2', 'us-east-1', 'default')
+        with connections.counting_calls() as counts:
+            conn.make_request('DescribeImages')
+            conn.make_request('DescribeImages')
+        conn.make_request('DescribeSubnets')
+        self.assertEqual(counts['ec2'], {'DescribeImages': 2})
+        self.assertEqual(connections.get_call_counts(),
+                         {'ec2': {'DescribeImages': 2, 'DescribeSubnets': 1}})
@@ -0,0 +1,596 @@
+import imp
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+from StringIO import StringIO
+
+from cfn import connections
+from cfn import majorkirby as mk
+from cfn.benchmark import SyntheticNode
+from cfn.connections import BotoBackend
+from cfn.fakeaws import FakeAWS, Record, ResultSet
+from cfn.majorkirby import (GlobalConfigNode, GraphExecutor, MKCycleError,
+                            MKDanglingInputError, MKUpdateError, StackStatusTracker,
+                            compile_graph, describe_change)
+from cfn.stacks import confirm_change_set
+
+
+class FakeAWSTestCase(unittest.TestCase):
+    """Runs each test against a fresh FakeAWS and template cache"""
+
+    def setUp(self):
+        self.aws = FakeAWS(placeholder_images=True, latencies={'default': 0.01})
+        connections.reset()
+        connections.set_backend(self.aws)
+        self.cache_dir = tempfile.mkdtemp()
+        self.template_cache = mk.template_cache
+        mk.template_cache = mk.TemplateCache(self.cache_dir)
+        self.intervals = (mk.StackStatusTracker.MIN_INTERVAL,
+                          mk.StackStatusTracker.MAX_INTERVAL)
+        mk.StackStatusTracker.MIN_INTERVAL = 0.01
+        mk.StackStatusTracker.MAX_INTERVAL = 0.05
+        self.log_level = mk.default_logger.level
+        mk.default_logger.setLevel(logging.CRITICAL)
+        self.global_config = GlobalConfigNode(Region='us-east-1')
+
+    def tearDown(self):
+        mk.default_logger.setLevel(self.log_level)
+        (mk.StackStatusTracker.MIN_INTERVAL,
+         mk.StackStatusTracker.MAX_INTERVAL) = self.intervals
+        mk.template_cache = self.template_cache
+        shutil.rmtree(self.cache_dir)
+        connections.set_backend(BotoBackend())
+        connections.reset()
+
+
+class RecordingNode(SyntheticNode):
+    """SyntheticNode which records when it starts and finishes running"""
+
+    def __init__(self, name, upstream=(), events=None, fail=False, **kwargs):
+        self.events = events
+        self.fail = fail
+        super(RecordingNode, self).__init__(name, upstream, **kwargs)
+
+    def _launch_cfn(self):
+        if self.fail:
+            raise RuntimeError('{} failed to launch'.format(self.NAME))
+        super(RecordingNode, self)._launch_cfn()
+
+    def run(self, poll_interval=10):
+        self.events.record('start', self.NAME)
+        try:
+            return super(RecordingNode, self).run(poll_interval)
+        finally:
+            self.events.record('finish', self.NAME)
+
+
+class Events(object):
+    """Thread-safe log of node starts and finishes"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.log = []
+        self.running = 0
+        self.most_running = 0
+
+    def record(self, event, name):
+        with self.lock:
+            self.log.append((event, name))
+            self.running += 1 if event == 'start' else -1
+            self.most_running = max(self.most_running, self.running)
+
+    def index(self, event, name):
+        return self.log.index((event, name))
+
+
+class GraphExecutorTest(FakeAWSTestCase):
+
+    def diamond(self, fail=()):
+        """Builds A -> (B, C) -> D, plus an independent E"""
+        events = Events()
+
+        def node(name, upstream=()):
+            return RecordingNode(name, upstream, events=events, fail=name in fail,
+                                 globalconfig=self.global_config)
+
+        a = node('A')
+        b = node('B', [a])
+        c = node('C', [a])
+        d = node('D', [b, c])
+        e = node('E')
+        return [d, e], events
+
+    def test_requirements_finish_first(self):
+        sinks, events = self.diamond()
+        executor = GraphExecutor(sinks, poll_interval=0.01)
+        self.assertTrue(executor.run())
+        for node in executor.nodes:
+            for required in node.requires:
+                self.assertLess(events.index('finish', required),
+                                events.index('start', node.NAME))
+
+    def test_every_node_runs_once(self):
+        sinks, events = self.diamond()
+        executor = GraphExecutor(sinks, poll_interval=0.01)
+        executor.run()
+        self.assertEqual(sorted(name for event, name in events.log if event == 'start'),
+                         ['A', 'B', 'C', 'D', 'E'])
+        self.assertEqual(sorted(self.aws.stacks['us-east-1']),
+                         sorted(node.stack_name for node in executor.nodes))
+
+    def test_failed_requirement_fails_dependents(self):
+        sinks, events = self.diamond(fail=('B',))
+        executor = GraphExecutor(sinks, poll_interval=0.01)
+        self.assertFalse(executor.run())
+        states = {node.NAME: node.state for node in executor.nodes}
+        self.assertEqual(states['B'], mk.StackNode.states.FAILED)
+        self.assertEqual(states['D'], mk.StackNode.states.FAILED)
+        # D never ran, while stacks which don't need B still did
+        self.assertNotIn(('start', 'D'), events.log)
+        for name in ('A', 'C', 'E'):
+            self.assertEqual(states[name], mk.StackNode.states.FINISHED)
+
+    def test_max_workers_limits_nodes_in_flight(self):
+        sinks, events = self.diamond()
+        executor = GraphExecutor(sinks, max_workers=1, poll_interval=0.01)
+        self.assertTrue(executor.run())
+        self.assertEqual(events.most_running, 1)
+
+    def test_independent_nodes_run_concurrently(self):
+        # slow enough stacks that A and E overlap however threads are scheduled
+        self.aws.latencies = {'default': 0.2}
+        sinks, events = self.diamond()
+        executor = GraphExecutor(sinks, poll_interval=0.01)
+        self.assertEqual(executor.max_workers, len(executor.nodes))
+        self.assertTrue(executor.run())
+        self.assertGreater(events.most_running, 1)
+
+
+class CannedEventsConnection(object):
+    """Serves a stack's events newest first, a page at a time, like AWS"""
+
+    def __init__(self, page_size=2):
+        self.events = []
+        self.page_size = page_size
+
+    def add(self, logical_resource_id, status, resource_type='AWS::EC2::Instance'):
+        if logical_resource_id == 'stack':
+            resource_type = StackStatusTracker.STACK_RESOURCE_TYPE
+        self.events.append(Record(
+            event_id='event-{}'.format(len(self.events)),
+            logical_resource_id=logical_resource_id,
+            resource_type=resource_type,
+            resource_status=status,
+            resource_status_reason=None))
+
+    def describe_stack_events(self, stack_name, next_token=None):
+        newest_first = list(reversed(self.events))
+        start = int(next_token or 0)
+        page = ResultSet(newest_first[start:start + self.page_size])
+        if start + self.page_size < len(newest_first):
+            page.next_token = str(start + self.page_size)
+        return page
+
+
+class StackStatusTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = CannedEventsConnection()
+        self.tracker = StackStatusTracker(self.conn, 'stack', status='CREATE_IN_PROGRESS',
+                                          min_interval=1, max_interval=4, backoff=2)
+
+    def test_stack_events_set_the_status(self):
+        self.conn.add('stack', 'CREATE_IN_PROGRESS')
+        self.conn.add('Instance', 'CREATE_COMPLETE')
+        self.assertEqual(self.tracker.poll(), 'CREATE_IN_PROGRESS')
+        self.assertFalse(self.tracker.finished)
+        self.conn.add('stack', 'CREATE_COMPLETE')
+        self.assertEqual(self.tracker.poll(), 'CREATE_COMPLETE')
+        self.assertTrue(self.tracker.finished)
+
+    def test_resource_failure_fails_fast(self):
+        self.conn.add('stack', 'CREATE_IN_PROGRESS')
+        self.conn.add('Instance', 'CREATE_IN_PROGRESS')
+        self.assertEqual(self.tracker.poll(), 'CREATE_IN_PROGRESS')
+        self.conn.add('Instance', 'CREATE_FAILED')
+        self.conn.add('Volume', 'CREATE_FAILED')
+        # the stack is still rolling back, but the first failure ends the run
+        self.assertEqual(self.tracker.poll(), 'CREATE_FAILED')
+        self.assertTrue(self.tracker.finished)
+        self.assertEqual(self.tracker.failed_event.logical_resource_id, 'Instance')
+
+    def test_events_past_the_first_page_are_read(self):
+        self.conn.add('stack', 'CREATE_IN_PROGRESS')
+        self.tracker.poll()
+        for i in range(5):
+            self.conn.add('Instance{}'.format(i), 'CREATE_COMPLETE')
+        self.conn.add('Instance5', 'CREATE_FAILED')
+        self.assertEqual(self.tracker.poll(), 'CREATE_FAILED')
+        self.assertEqual(self.tracker.failed_event.logical_resource_id, 'Instance5')
+
+    def test_quiet_polls_back_off(self):
+        self.conn.add('stack', 'CREATE_IN_PROGRESS')
+        self.tracker.poll()
+        self.assertEqual(self.tracker.interval, 1)
+        intervals = []
+        for _ in range(4):
+            self.tracker.poll()
+            intervals.append(self.tracker.interval)
+        self.assertEqual(intervals, [2, 4, 4, 4])
+        self.conn.add('Instance', 'CREATE_COMPLETE')
+        self.tracker.poll()
+        self.assertEqual(self.tracker.interval, 1)
+
+    def test_start_skips_earlier_events(self):
+        self.conn.add('Instance', 'UPDATE_FAILED')
+        self.conn.add('stack', 'UPDATE_ROLLBACK_COMPLETE')
+        self.tracker.start('UPDATE_IN_PROGRESS')
+        self.assertEqual(self.tracker.poll(), 'UPDATE_IN_PROGRESS')
+        self.assertIsNone(self.tracker.failed_event)
+        self.conn.add('stack', 'UPDATE_COMPLETE')
+        self.assertEqual(self.tracker.poll(), 'UPDATE_COMPLETE')
+
+
+class WiderNode(SyntheticNode):
+    """SyntheticNode with a different template, to force an update"""
+    NAME = 'Rollback'
+    RESOURCES = 4
+
+
+class RolledBackStackTest(FakeAWSTestCase):
+
+    def run_node(self, cls=SyntheticNode):
+        node = cls('Rollback', globalconfig=self.global_config)
+        GraphExecutor([node], poll_interval=0.01).run()
+        return node
+
+    def test_earlier_rollback_is_not_a_failure(self):
+        node = self.run_node()
+        self.aws.stacks['us-east-1'][node.stack_name].stack_status = 'UPDATE_ROLLBACK_COMPLETE'
+        node = self.run_node()
+        self.assertEqual(node.state, node.states.FINISHED)
+        self.assertIn('Out', node.stack_outputs)
+
+    def test_rollback_of_this_runs_update_fails(self):
+        node = self.run_node()
+        self.aws.stacks['us-east-1'][node.stack_name].stack_status = 'UPDATE_ROLLBACK_COMPLETE'
+        self.aws.failure_rate = 1
+        node = self.run_node(WiderNode)
+        self.assertTrue(node.update_started)
+        self.assertEqual(node.state, node.states.FAILED)
+
+
+class CompileGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log_level = mk.default_logger.level
+        mk.default_logger.setLevel(logging.CRITICAL)
+        self.global_config = GlobalConfigNode(Region='us-east-1')
+
+    def tearDown(self):
+        mk.default_logger.setLevel(self.log_level)
+
+    def node(self, name, upstream=()):
+        return SyntheticNode(name, upstream, globalconfig=self.global_config)
+
+    def test_connections_come_first(self):
+        a = self.node('A')
+        b = self.node('B', [a])
+        c = self.node('C', [a])
+        d = self.node('D', [c, b])
+        order = compile_graph([d])
+        self.assertEqual(len(order), 5)
+        for node in order:
+            for connection in node.connected_nodes():
+                self.assertLess(order.index(connection), order.index(node))
+        self.assertIs(order[0], self.global_config)
+        self.assertIs(order[-1], d)
+
+    def test_shared_nodes_are_listed_once(self):
+        a = self.node('A')
+        b = self.node('B', [a])
+        c = self.node('C', [a])
+        order = compile_graph([b, c])
+        self.assertEqual(order.count(a), 1)
+        self.assertEqual(len(GraphExecutor([b, c]).nodes), 3)
+
+    def test_cycle(self):
+        a = self.node('A')
+        b = self.node('B', [a])
+        a.connect_from(b, 'B')
+        a.inputs['BOut'] = ['B:Out']
+        with self.assertRaises(MKCycleError) as raised:
+            compile_graph([b])
+        self.assertEqual(str(raised.exception), 'B -> A -> B')
+
+    def test_undeclared_output(self):
+        a = self.node('A')
+        b = self.node('B', [a])
+        b.inputs['AOut'] = ['A:Missing']
+        with self.assertRaises(MKDanglingInputError) as raised:
+            compile_graph([b])
+        self.assertIn('AOut', str(raised.exception))
+
+    def test_missing_connection(self):
+        a = self.node('A')
+        a.inputs['Other'] = ['Nowhere:Out']
+        with self.assertRaises(MKDanglingInputError):
+            compile_graph([a])
+
+    def test_default_covers_a_dangling_input(self):
+        a = self.node('A')
+        a.inputs['Other'] = ['Nowhere:Out']
+        a.defaults['Other'] = 'fallback'
+        compile_graph([a])
+        self.assertEqual(a.resolution_plan['Other'], [])
+        self.assertEqual(a.get_input('Other'), 'fallback')
+
+    def test_unresolvable_addresses_are_dropped(self):
+        a = self.node('A')
+        b = self.node('B', [a])
+        b.inputs['AOut'] = ['A:Missing', 'A:Out']
+        compile_graph([b])
+        self.assertEqual(b.resolution_plan['AOut'], [('A', a, 'Out')])
+
+
+class TemplateCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = mk.TemplateCache(os.path.join(self.path, 'templates'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def put(self):
+        self.cache.put('Stack', 'fingerprint', 'hash', '{"Resources": {}}',
+                       'us-east-1', [['Param', 'value']])
+
+    def test_miss_when_empty(self):
+        self.assertIsNone(self.cache.get('Stack', 'fingerprint'))
+
+    def test_hit(self):
+        self.put()
+        entry = self.cache.get('Stack', 'fingerprint')
+        self.assertEqual(entry['template_hash'], 'hash')
+        self.assertEqual(entry['region'], 'us-east-1')
+        self.assertEqual(entry['parameters'], [['Param', 'value']])
+        self.assertEqual(self.cache.get_body('hash'), '{"Resources": {}}')
+
+    def test_miss_on_other_fingerprint(self):
+        self.put()
+        self.assertIsNone(self.cache.get('Stack', 'other'))
+        self.assertIsNone(self.cache.get('Other', 'fingerprint'))
+
+    def test_miss_without_body(self):
+        self.put()
+        os.remove(self.cache.body_path('hash'))
+        self.assertIsNone(self.cache.get('Stack', 'fingerprint'))
+
+
+class InputFingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def fingerprint(self, cls=SyntheticNode, region='us-east-1', **kwargs):
+        node = cls('A', globalconfig=GlobalConfigNode(Region=region), **kwargs)
+        return node.input_fingerprint()
+
+    def test_same_inputs(self):
+        self.assertEqual(self.fingerprint(), self.fingerprint())
+
+    def test_inputs_change_it(self):
+        self.assertNotEqual(self.fingerprint(), self.fingerprint(region='us-west-2'))
+
+    def test_extras_change_it(self):
+        class ExtrasNode(SyntheticNode):
+            extras = {}
+
+            def _fingerprint_extras(self):
+                return self.extras
+
+        before = self.fingerprint(ExtrasNode)
+        ExtrasNode.extras = {'AMI': 'ami-12345678'}
+        self.assertNotEqual(self.fingerprint(ExtrasNode), before)
+
+    def test_class_source_changes_it(self):
+        module_path = os.path.join(self.path, 'edited_node.py')
+        with open(module_path, 'w') as f:
+            f.write('from cfn.benchmark import SyntheticNode\n\n\n'
+                    'class EditedNode(SyntheticNode):\n'
+                    '    RESOURCES = 3\n')
+        cls = imp.load_source('edited_node', module_path).EditedNode
+        before = self.fingerprint(cls)
+        with open(module_path, 'a') as f:
+            f.write('    # edited\n')
+        self.assertNotEqual(self.fingerprint(cls), before)
+
+
+class TemplateHashTest(FakeAWSTestCase):
+
+    def node(self):
+        return SyntheticNode('Hashed', globalconfig=self.global_config)
+
+    def launch(self):
+        node = self.node()
+        GraphExecutor([node], poll_interval=0.01).run()
+        return node
+
+    def deployed(self, node):
+        return self.aws.stacks['us-east-1'][node.stack_name]
+
+    def test_new_stack_is_tagged(self):
+        node = self.launch()
+        self.assertEqual(self.deployed(node).tags['TemplateHash'], node.template_hash)
+
+    def test_unchanged_stack_is_left_alone(self):
+        self.launch()
+        node = self.launch()
+        self.assertFalse(node.needs_update)
+        calls = node.api_calls['cloudformation']
+        self.assertNotIn('CreateChangeSet', calls)
+        self.assertNotIn('UpdateStack', calls)
+
+    def test_cached_template_is_not_rendered_again(self):
+        first = self.launch()
+        node = self.node()
+        node._render = None
+        GraphExecutor([node], poll_interval=0.01).run()
+        self.assertEqual(node.state, node.states.FINISHED)
+        self.assertEqual(node.template_hash, first.template_hash)
+
+    def test_other_hash_needs_update(self):
+        node = self.launch()
+        self.deployed(node).tags['TemplateHash'] = 'other'
+        node = self.launch()
+        self.assertTrue(node.needs_update)
+        self.assertEqual(self.deployed(node).tags['TemplateHash'], node.template_hash)
+
+    def test_plan_compares_the_hash(self):
+        self.assertEqual(self.node().plan()['action'], 'create')
+        node = self.launch()
+        self.assertEqual(self.node().plan()['action'], 'none')
+        self.deployed(node).tags['TemplateHash'] = 'other'
+        self.assertEqual(self.node().plan()['action'], 'update')
+
+
+class ChangedNode(SyntheticNode):
+    """SyntheticNode with an extra resource, so its stack has changes"""
+    RESOURCES = 4
+
+
+class ChangeSetTest(FakeAWSTestCase):
+
+    def launch(self, cls=SyntheticNode, apply_updates=True, confirm_update=None):
+        node = cls('Changing', globalconfig=self.global_config)
+        node.apply_updates = apply_updates
+        node.confirm_update = confirm_update
+        GraphExecutor([node], poll_interval=0.01).run()
+        return node
+
+    def deployed(self, node):
+        return self.aws.stacks['us-east-1'][node.stack_name]
+
+    def test_no_changes_only_update_the_hash(self):
+        node = self.launch()
+        self.deployed(node).tags['TemplateHash'] = 'other'
+        node = self.launch()
+        self.assertNotIn('ExecuteChangeSet', node.api_calls['cloudformation'])
+        self.assertEqual(self.deployed(node).change_sets, {})
+        self.assertEqual(self.deployed(node).tags['TemplateHash'], node.template_hash)
+
+    def test_changes_are_executed(self):
+        self.launch()
+        node = self.launch(ChangedNode)
+        self.assertEqual(node.state, node.states.FINISHED)
+        self.assertTrue(node.update_started)
+        self.assertIn('Handle3', self.deployed(node).resources)
+
+    def test_preview_leaves_the_change_set(self):
+        self.launch()
+        node = self.launch(ChangedNode, apply_updates=False)
+        self.assertEqual(node.state, node.states.FINISHED)
+        self.assertFalse(node.update_started)
+        self.assertNotIn('Handle3', self.deployed(node).resources)
+        self.assertEqual(len(self.deployed(node).change_sets), 1)
+
+    def test_untagged_stack_is_only_previewed(self):
+        node = self.launch()
+        del self.deployed(node).tags['TemplateHash']
+        node = self.launch(ChangedNode)
+        self.assertFalse(node.update_started)
+        self.assertEqual(len(self.deployed(node).change_sets), 1)
+
+    def test_declined_change_set_is_left_for_review(self):
+        self.launch()
+        asked = []
+
+        def decline(node, change_set_name, changes):
+            asked.append([describe_change(change) for change in changes])
+            return False
+
+        node = self.launch(ChangedNode, confirm_update=decline)
+        self.assertEqual(asked, [['Add Handle3 (AWS::CloudFormation::WaitConditionHandle)']])
+        self.assertFalse(node.update_started)
+        self.assertEqual(len(self.deployed(node).change_sets), 1)
+
+    def test_confirmed_change_set_is_executed(self):
+        self.launch()
+        node = self.launch(ChangedNode, confirm_update=lambda *args: True)
+        self.assertTrue(node.update_started)
+        self.assertIn('Handle3', self.deployed(node).resources)
+
+    def test_no_terminal_declines(self):
+        stdin = sys.stdin
+        sys.stdin = StringIO()
+        try:
+            node = SyntheticNode('Changing', globalconfig=self.global_config)
+            self.assertFalse(confirm_change_set(node, 'majorkirby-1234', []))
+        finally:
+            sys.stdin = stdin
+
+
+class CannedChangeSetNode(SyntheticNode):
+    """Node which answers its change set calls from canned results"""
+
+    def __init__(self, name, describe_results, **kwargs):
+        self.describe_results = list(describe_results)
+        self.requests = []
+        super(CannedChangeSetNode, self).__init__(name, **kwargs)
+
+    def _cfn_request(self, action, params):
+        self.requests.append(action)
+        if action == 'DescribeChangeSet':
+            return self.describe_results.pop(0)
+        return {}
+
+
+class ChangeSetWaitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log_level = mk.default_logger.level
+        mk.default_logger.setLevel(logging.CRITICAL)
+        self.min_interval = StackStatusTracker.MIN_INTERVAL
+        StackStatusTracker.MIN_INTERVAL = 0.01
+
+    def tearDown(self):
+        StackStatusTracker.MIN_INTERVAL = self.min_interval
+        mk.default_logger.setLevel(self.log_level)
+
+    def node(self, *describe_results):
+        node = CannedChangeSetNode('Canned', describe_results,
+                                   globalconfig=GlobalConfigNode(Region='us-east-1'))
+        node.template_hash = '0' * 64
+        return node
+
+    def test_waits_until_complete(self):
+        node = self.node({'Status': 'CREATE_PENDING'}, {'Status': 'CREATE_IN_PROGRESS'},
+                         {'Status': 'CREATE_COMPLETE', 'Changes': [1], 'NextToken': 'next'},
+                         {'Changes': [2]})
+        change_set = node._create_change_set('majorkirby-0', '{}', [])
+        self.assertEqual(change_set['Changes'], [1, 2])
+        self.assertEqual(node.requests.count('DescribeChangeSet'), 4)
+
+    def test_timeout(self):
+        node = self.node(*[{'Status': 'CREATE_PENDING'}] * 10)
+        node.CHANGE_SET_TIMEOUT = 0.02
+        with self.assertRaises(MKUpdateError) as raised:
+            node._create_change_set('majorkirby-0', '{}', [])
+        self.assertIn('still CREATE_PENDING', str(raised.exception))
+
+    def test_failed_change_set_raises(self):
+        node = self.node({'Status': 'FAILED', 'StatusReason': 'Template format error'})
+        with self.assertRaises(MKUpdateError) as raised:
+            node._update_cfn('{}', [])
+        self.assertIn('Template format error', str(raised.exception))
+        self.assertEqual(node.requests[-1], 'DeleteChangeSet')
+        self.assertNotIn('ExecuteChangeSet', node.requests)
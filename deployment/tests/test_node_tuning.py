@@ -0,0 +1,201 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'ansible', 'filter_plugins'))
+
+from instance_types import FilterModule as InstanceTypeFilters  # noqa: E402
+from node_tuning import (MIN_EXECUTOR_HEAP_MIB, MIN_EXECUTOR_OVERHEAD_MIB,  # noqa: E402
+                         SHUFFLE_SERVICE_HEAP_MIB, FilterModule, node_memory)
+
+
+def spec(memory_mib, vcpus, instance_store_count=0):
+    return {'memory_mib': memory_mib, 'vcpus': vcpus,
+            'instance_store_count': instance_store_count}
+
+
+class NodeMemoryTest(unittest.TestCase):
+
+    def test_reserves_a_share_for_the_os(self):
+        # 5% for the OS and 1G for the datanode
+        self.assertEqual(node_memory(spec(40960, 8)), 40960 - 2048 - 1024)
+
+    def test_reserves_at_least_1g_for_the_os(self):
+        self.assertEqual(node_memory(spec(7680, 2)), 7680 - 1024 - 1024)
+
+
+class AccumuloTuningTest(unittest.TestCase):
+
+    def setUp(self):
+        self.accumulo_tuning = FilterModule().filters()['accumulo_tuning']
+
+    def test_splits_its_share_between_heap_and_native_map(self):
+        # 0.3 of the 37888M left is 11366M: two fifths to the native map and
+        # the rest to the heap, in multiples of 64M
+        tuning = self.accumulo_tuning(spec(40960, 8), 0.3, 0.25)
+        self.assertEqual(tuning['native_map_mib'], 4544)
+        self.assertEqual(tuning['tserver_heap_mib'], 6784)
+        self.assertEqual(tuning['memory_mib'], 4544 + 6784)
+        self.assertEqual(tuning['cores'], 2)
+
+    def test_heap_is_split_between_caches(self):
+        tuning = self.accumulo_tuning(spec(40960, 8), 0.3, 0.25)
+        self.assertEqual(tuning['tserver_new_mib'], 1664)
+        self.assertEqual(tuning['data_cache_mib'], 1984)
+        self.assertEqual(tuning['index_cache_mib'], 640)
+        self.assertEqual(tuning['sort_buffer_mib'], 640)
+        self.assertLess(tuning['data_cache_mib'] + tuning['index_cache_mib'] +
+                        tuning['sort_buffer_mib'], tuning['tserver_heap_mib'])
+
+    def test_walogs_roll_over_at_the_native_map(self):
+        self.assertEqual(self.accumulo_tuning(spec(40960, 8))['walog_max_mib'], 4096)
+        self.assertEqual(self.accumulo_tuning(spec(15360, 4))['walog_max_mib'], 1536)
+        self.assertEqual(self.accumulo_tuning(spec(7680, 2))['walog_max_mib'], 1024)
+
+    def test_large_nodes_are_capped(self):
+        tuning = self.accumulo_tuning(spec(249856, 32), 0.3, 0.25)
+        self.assertEqual(tuning['tserver_heap_mib'], 16384)
+        self.assertEqual(tuning['native_map_mib'], 16384)
+        self.assertEqual(tuning['minor_compactions'], 8)
+        self.assertEqual(tuning['master_heap_mib'], 4096)
+        self.assertEqual(tuning['gc_heap_mib'], 1024)
+
+    def test_small_nodes_get_the_least_accumulo_runs_with(self):
+        tuning = self.accumulo_tuning(spec(3840, 1), 0.3, 0.25)
+        self.assertEqual(tuning['tserver_heap_mib'], 1024)
+        self.assertEqual(tuning['native_map_mib'], 512)
+        self.assertEqual(tuning['cores'], 1)
+        self.assertEqual(tuning['minor_compactions'], 2)
+        self.assertEqual(tuning['master_heap_mib'], 1024)
+        self.assertEqual(tuning['gc_heap_mib'], 256)
+
+    def test_fractions_may_be_strings(self):
+        self.assertEqual(self.accumulo_tuning(spec(40960, 8), '0.3', '0.25'),
+                         self.accumulo_tuning(spec(40960, 8), 0.3, 0.25))
+
+
+class SparkTuningTest(unittest.TestCase):
+
+    def setUp(self):
+        filters = FilterModule().filters()
+        self.accumulo_tuning = filters['accumulo_tuning']
+        self.spark_tuning = filters['spark_tuning']
+
+    def tuning(self, node, executor_cores=0):
+        return self.spark_tuning(node, self.accumulo_tuning(node, 0.3, 0.25), executor_cores)
+
+    def test_gets_what_accumulo_leaves(self):
+        # 37888M less Accumulo's 11328M and the shuffle service's 512M
+        tuning = self.tuning(spec(40960, 8))
+        self.assertEqual(tuning['memory_mib'], 26048)
+        self.assertEqual(tuning['cores'], 6)
+        self.assertEqual(tuning['parallelism'], 12)
+
+    def test_single_executor(self):
+        tuning = self.tuning(spec(40960, 8))
+        self.assertEqual((tuning['executors'], tuning['executor_cores']), (1, 6))
+        # a tenth of the executor's memory is overhead outside its heap
+        self.assertEqual(tuning['memory_overhead_mib'], 2368)
+        self.assertEqual(tuning['executor_memory_mib'], 23680)
+
+    def test_executors_split_the_node(self):
+        tuning = self.tuning(spec(40960, 8), executor_cores=2)
+        self.assertEqual((tuning['executors'], tuning['executor_cores']), (3, 2))
+        self.assertEqual(tuning['memory_overhead_mib'], 768)
+        self.assertEqual(tuning['executor_memory_mib'], 7872)
+
+    def test_executor_cores_are_rounded_to_the_node(self):
+        tuning = self.tuning(spec(40960, 8), executor_cores=4)
+        self.assertEqual((tuning['executors'], tuning['executor_cores']), (2, 3))
+
+    def test_least_overhead(self):
+        tuning = self.tuning(spec(15360, 4), executor_cores=1)
+        self.assertEqual(tuning['executors'], 3)
+        self.assertEqual(tuning['memory_overhead_mib'], 384)
+        self.assertEqual(tuning['executor_memory_mib'], 2560)
+
+    def test_least_executor_heap(self):
+        # Accumulo leaves nothing on a 3.75G node, but an executor still runs
+        tuning = self.tuning(spec(3840, 2))
+        self.assertEqual(tuning['memory_mib'], 896)
+        self.assertEqual(tuning['executors'], 1)
+        self.assertEqual(tuning['executor_memory_mib'], 512)
+        self.assertEqual(tuning['memory_overhead_mib'], 384)
+        self.assertEqual(tuning['cores'], 1)
+
+    def test_least_executor_heap_with_several_executors(self):
+        tuning = self.tuning(spec(3840, 4), executor_cores=1)
+        self.assertEqual(tuning['executors'], 3)
+        self.assertEqual(tuning['executor_memory_mib'], 512)
+
+    def test_catalog_types_get_spark_memory(self):
+        instance_spec = InstanceTypeFilters().instance_spec
+        small_types = []
+        for instance_type in InstanceTypeFilters().instance_types('hvm'):
+            node = instance_spec(instance_type)
+            accumulo = self.accumulo_tuning(node, 0.3, 0.25)
+            tuning = self.spark_tuning(node, accumulo)
+            self.assertGreaterEqual(tuning['memory_mib'],
+                                    MIN_EXECUTOR_HEAP_MIB + MIN_EXECUTOR_OVERHEAD_MIB,
+                                    instance_type)
+            self.assertGreaterEqual(tuning['executor_memory_mib'], MIN_EXECUTOR_HEAP_MIB,
+                                    instance_type)
+            if (node_memory(node) - accumulo['memory_mib'] - SHUFFLE_SERVICE_HEAP_MIB <
+                    MIN_EXECUTOR_HEAP_MIB + MIN_EXECUTOR_OVERHEAD_MIB):
+                small_types.append(instance_type)
+        self.assertEqual(small_types, ['c3.large', 'c4.large'])
+
+    def test_catalog_types_are_not_overcommitted(self):
+        instance_spec = InstanceTypeFilters().instance_spec
+        for instance_type in InstanceTypeFilters().instance_types('hvm'):
+            if instance_type in ('c3.large', 'c4.large'):
+                # too small to leave Spark an executor, see test_catalog_types_get_spark_memory
+                continue
+            node = instance_spec(instance_type)
+            accumulo = self.accumulo_tuning(node, 0.3, 0.25)
+            for executor_cores in (0, 1, 4):
+                tuning = self.spark_tuning(node, accumulo, executor_cores)
+                executors_mib = tuning['executors'] * (tuning['executor_memory_mib'] +
+                                                       tuning['memory_overhead_mib'])
+                self.assertLessEqual(
+                    accumulo['memory_mib'] + SHUFFLE_SERVICE_HEAP_MIB + executors_mib,
+                    node_memory(node), instance_type)
+                self.assertLessEqual(tuning['executors'] * tuning['executor_cores'],
+                                     tuning['cores'], instance_type)
+                self.assertEqual(accumulo['cores'] + tuning['cores'], node['vcpus'],
+                                 instance_type)
+
+
+class HdfsTuningTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hdfs_tuning = FilterModule().filters()['hdfs_tuning']
+
+    def test_namenode_handlers_grow_with_the_log_of_datanodes(self):
+        self.assertEqual(self.hdfs_tuning(spec(40960, 8), 64)['namenode_handlers'], 83)
+        self.assertEqual(self.hdfs_tuning(spec(40960, 8), 64)['namenode_service_handlers'], 41)
+        self.assertEqual(self.hdfs_tuning(spec(40960, 8), '64')['namenode_handlers'], 83)
+
+    def test_namenode_handler_bounds(self):
+        small = self.hdfs_tuning(spec(40960, 8), 1)
+        self.assertEqual((small['namenode_handlers'], small['namenode_service_handlers']),
+                         (10, 10))
+        self.assertEqual(self.hdfs_tuning(spec(40960, 8), 0)['namenode_handlers'], 10)
+        self.assertEqual(self.hdfs_tuning(spec(40960, 8), 100000)['namenode_handlers'], 200)
+
+    def test_datanode_threads_grow_with_volumes(self):
+        tuning = self.hdfs_tuning(spec(249856, 32, instance_store_count=8), 64)
+        self.assertEqual(tuning['volumes'], 8)
+        self.assertEqual(tuning['datanode_handlers'], 32)
+        self.assertEqual(tuning['max_transfer_threads'], 16384)
+
+    def test_nodes_without_instance_store(self):
+        tuning = self.hdfs_tuning(spec(40960, 8), 64)
+        self.assertEqual(tuning['volumes'], 1)
+        self.assertEqual(tuning['datanode_handlers'], 10)
+        self.assertEqual(tuning['max_transfer_threads'], 4096)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from packer import gt_packer
+from packer.gt_packer import GTAMIException, update_ansible_roles
+
+
+class RolesLockTest(unittest.TestCase):
+
+    PATHS = ('ANSIBLE_ROLES_FILE', 'ANSIBLE_ROLES_LOCK', 'ANSIBLE_ROLES_PATH', 'ROLE_CACHE_PATH')
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.paths = {name: getattr(gt_packer, name) for name in self.PATHS}
+        gt_packer.ANSIBLE_ROLES_FILE = os.path.join(self.path, 'roles.txt')
+        gt_packer.ANSIBLE_ROLES_LOCK = os.path.join(self.path, 'roles.lock')
+        gt_packer.ANSIBLE_ROLES_PATH = os.path.join(self.path, 'roles')
+        gt_packer.ROLE_CACHE_PATH = os.path.join(self.path, 'cache')
+        self.log_level = gt_packer.LOGGER.level
+        gt_packer.LOGGER.setLevel(logging.CRITICAL)
+        with open(gt_packer.ANSIBLE_ROLES_FILE, 'w') as f:
+            f.write('azavea.java,0.2.1\n')
+        self.cache_role('defaults: {}\n')
+
+    def tearDown(self):
+        gt_packer.LOGGER.setLevel(self.log_level)
+        for name, path in self.paths.iteritems():
+            setattr(gt_packer, name, path)
+        shutil.rmtree(self.path)
+
+    def cache_role(self, contents):
+        role_path = os.path.join(self.path, 'cache', 'azavea.java-0.2.1', 'defaults')
+        if not os.path.isdir(role_path):
+            os.makedirs(role_path)
+        with open(os.path.join(role_path, 'main.yml'), 'w') as f:
+            f.write(contents)
+
+    def write_lock(self, lock):
+        with open(gt_packer.ANSIBLE_ROLES_LOCK, 'w') as f:
+            json.dump(lock, f)
+
+    def read_lock(self):
+        with open(gt_packer.ANSIBLE_ROLES_LOCK, 'r') as f:
+            return json.load(f)
+
+    def installed(self):
+        return os.path.isdir(os.path.join(self.path, 'roles', 'azavea.java'))
+
+    def test_missing_lock_is_an_error(self):
+        self.assertRaises(GTAMIException, update_ansible_roles, offline=True)
+        self.assertFalse(self.installed())
+
+    def test_missing_hash_is_an_error(self):
+        self.write_lock({'azavea.java': {'version': '0.2.1', 'sha256': None}})
+        self.assertRaises(GTAMIException, update_ansible_roles, offline=True)
+        self.assertFalse(self.installed())
+
+    def test_other_version_is_an_error(self):
+        self.write_lock({'azavea.java': {'version': '0.2.0', 'sha256': 'abc'}})
+        self.assertRaises(GTAMIException, update_ansible_roles, offline=True)
+
+    def test_update_lock_records_hashes(self):
+        update_ansible_roles(offline=True, update_lock=True)
+        locked = self.read_lock()['azavea.java']
+        self.assertEqual(locked['version'], '0.2.1')
+        self.assertEqual(locked['sha256'],
+                         gt_packer.hash_role(os.path.join(self.path, 'cache', 'azavea.java-0.2.1')))
+        self.assertTrue(self.installed())
+
+    def test_locked_roles_are_installed(self):
+        update_ansible_roles(offline=True, update_lock=True)
+        shutil.rmtree(os.path.join(self.path, 'roles'))
+        update_ansible_roles(offline=True)
+        self.assertTrue(self.installed())
+
+    def test_changed_contents_are_an_error(self):
+        update_ansible_roles(offline=True, update_lock=True)
+        shutil.rmtree(os.path.join(self.path, 'roles'))
+        self.cache_role('defaults: {changed: true}\n')
+        self.assertRaises(GTAMIException, update_ansible_roles, offline=True)
@@ -0,0 +1,144 @@
+import unittest
+
+from datetime import datetime, timedelta
+
+from cfn.spot import (choose_pools, format_pools, parse_instance_types, parse_pools,
+                      score_pool, split_capacity)
+from cfn.template_utils import GTCloudFormationException
+
+
+START = datetime(2016, 3, 1)
+
+
+def history(*prices):
+    """Price points an hour apart"""
+    return [(START + timedelta(hours=hour), price) for hour, price in enumerate(prices)]
+
+
+def placed(pools):
+    return [(pool.instance_type, pool.zone, pool.instances) for pool in pools]
+
+
+class ParseInstanceTypesTest(unittest.TestCase):
+
+    def test_weights_from_vcpus(self):
+        self.assertEqual(parse_instance_types('r3.2xlarge, r3.4xlarge,r3.8xlarge'),
+                         [('r3.2xlarge', 1.0), ('r3.4xlarge', 2.0), ('r3.8xlarge', 4.0)])
+
+    def test_given_weights(self):
+        self.assertEqual(parse_instance_types('r3.2xlarge:1,r3.4xlarge:1.5'),
+                         [('r3.2xlarge', 1.0), ('r3.4xlarge', 1.5)])
+
+    def test_weight_far_from_vcpus(self):
+        self.assertRaises(GTCloudFormationException,
+                          parse_instance_types, 'r3.2xlarge,r3.4xlarge:5')
+        self.assertRaises(GTCloudFormationException,
+                          parse_instance_types, 'r3.2xlarge,r3.4xlarge:x')
+
+    def test_unknown_type(self):
+        self.assertRaises(GTCloudFormationException, parse_instance_types, 'r9.huge')
+
+
+class ScorePoolTest(unittest.TestCase):
+
+    def test_median_and_risk(self):
+        # above the bid for one of the four hours up to the end
+        points = history(0.1, 0.5, 0.1)
+        self.assertEqual(score_pool(points, 0.3, START + timedelta(hours=4)), (0.1, 0.25))
+
+    def test_last_price_holds_until_the_end(self):
+        points = history(0.1, 0.5)
+        self.assertEqual(score_pool(points, 0.3, START + timedelta(hours=4)), (0.5, 0.75))
+
+    def test_single_point(self):
+        points = history(0.5)
+        self.assertEqual(score_pool(points, 0.3, START), (0.5, 1.0))
+        self.assertEqual(score_pool(points, 0.6, START), (0.5, 0.0))
+
+
+class ChoosePoolsTest(unittest.TestCase):
+
+    instance_types = [('r3.xlarge', 1.0), ('r3.2xlarge', 2.0)]
+    zones = ['us-east-1a', 'us-east-1b']
+
+    def test_on_demand_spreads_over_zones_and_types(self):
+        pools = choose_pools(self.instance_types, self.zones, {}, None, 6)
+        self.assertEqual(placed(pools), [('r3.xlarge', 'us-east-1a', 1),
+                                         ('r3.2xlarge', 'us-east-1b', 1),
+                                         ('r3.xlarge', 'us-east-1b', 1),
+                                         ('r3.2xlarge', 'us-east-1a', 1)])
+
+    def test_capacity_is_split_evenly(self):
+        pools = choose_pools(self.instance_types, self.zones, {}, None, 12, max_pools=2)
+        # six units of capacity in each
+        self.assertEqual(placed(pools), [('r3.xlarge', 'us-east-1a', 6),
+                                         ('r3.2xlarge', 'us-east-1b', 3)])
+        self.assertEqual(sum(pool.instances * pool.weight for pool in pools), 12)
+
+    def test_at_most_a_pool_per_unit_of_capacity(self):
+        pools = choose_pools(self.instance_types, self.zones, {}, None, 1)
+        self.assertEqual(placed(pools), [('r3.xlarge', 'us-east-1a', 1)])
+
+    def test_cheapest_per_unit_first(self):
+        prices = {
+            ('r3.xlarge', 'us-east-1a'): history(0.10, 0.10),
+            ('r3.xlarge', 'us-east-1b'): history(0.05, 0.05),
+            ('r3.2xlarge', 'us-east-1a'): history(0.12, 0.12),
+            ('r3.2xlarge', 'us-east-1b'): history(0.30, 0.30)
+        }
+        pools = choose_pools(self.instance_types, self.zones, prices, 0.2, 4, max_pools=2)
+        self.assertEqual(placed(pools), [('r3.xlarge', 'us-east-1b', 2),
+                                         ('r3.2xlarge', 'us-east-1a', 1)])
+        self.assertAlmostEqual(pools[1].price, 0.06)
+        self.assertEqual(pools[1].interruption_risk, 0.0)
+
+    def test_leaves_out_risky_pools(self):
+        prices = {
+            # above a bid of 0.2 for half of the time
+            ('r3.xlarge', 'us-east-1a'): history(0.05, 0.5, 0.05, 0.05),
+            # above the bid now
+            ('r3.xlarge', 'us-east-1b'): history(0.05, 0.05, 0.05, 0.5),
+            ('r3.2xlarge', 'us-east-1a'): history(0.3, 0.3, 0.3, 0.3)
+        }
+        pools = choose_pools(self.instance_types, self.zones, prices, 0.2, 4)
+        self.assertEqual(placed(pools), [('r3.2xlarge', 'us-east-1a', 1),
+                                         ('r3.2xlarge', 'us-east-1b', 1)])
+
+    def test_pools_without_history_come_last(self):
+        prices = {('r3.2xlarge', 'us-east-1b'): history(0.3, 0.3)}
+        pools = choose_pools(self.instance_types, self.zones, prices, 0.2, 4, max_pools=1)
+        self.assertEqual(placed(pools), [('r3.2xlarge', 'us-east-1b', 2)])
+
+    def test_no_pool_under_the_bid(self):
+        prices = dict(((instance_type, zone), history(1.0))
+                      for instance_type, _ in self.instance_types for zone in self.zones)
+        self.assertRaises(GTCloudFormationException, choose_pools,
+                          self.instance_types, self.zones, prices, 0.2, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class RecordedPoolsTest(unittest.TestCase):
+
+    instance_types = [('r3.2xlarge', 1.0), ('r3.4xlarge', 2.0)]
+    zones = ['us-east-1a', 'us-east-1b']
+
+    def test_round_trip(self):
+        pools = choose_pools(self.instance_types, self.zones, {}, None, 6)
+        parsed = parse_pools(format_pools(pools), self.instance_types, self.zones)
+        self.assertEqual(placed(parsed), placed(pools))
+        self.assertEqual([pool.weight for pool in parsed], [pool.weight for pool in pools])
+
+    def test_unusable_pools_are_left_out(self):
+        parsed = parse_pools('r3.2xlarge:us-east-1a:2,r3.8xlarge:us-east-1a:1,'
+                             'r3.4xlarge:us-east-1c:1', self.instance_types, self.zones)
+        self.assertEqual(placed(parsed), [('r3.2xlarge', 'us-east-1a', 2)])
+
+    def test_split_capacity_again(self):
+        pools = parse_pools('r3.2xlarge:us-east-1a:2,r3.4xlarge:us-east-1b:1',
+                            self.instance_types, self.zones)
+        self.assertEqual(placed(split_capacity(pools, 8)),
+                         [('r3.2xlarge', 'us-east-1a', 4), ('r3.4xlarge', 'us-east-1b', 2)])
+        self.assertEqual(placed(split_capacity(pools, 1)), [('r3.2xlarge', 'us-east-1a', 1)])
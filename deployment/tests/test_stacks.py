@@ -0,0 +1,120 @@
+from cfn.stacks import build_stacks, plan_stacks
+from tests.test_majorkirby import FakeAWSTestCase
+
+
+CONFIG = {
+    'IPAccess': '1.2.3.4/32',
+    'KeyName': 'mykey',
+    'MesosLeaderInstanceType': 'm3.large',
+    'MesosFollowerInstanceType': 'm3.large',
+    'PrivateHostedZoneName': 'gt.internal',
+    'Region': 'us-east-1',
+    'StackType': 'accumulo',
+    'NameSpace': 'ci',
+    'AMICacheTTL': '0'
+}
+
+
+class PlanStacksTest(FakeAWSTestCase):
+
+    def plans(self, **config):
+        return {plan['node']: plan for plan in plan_stacks('default', dict(CONFIG, **config))}
+
+    def parameter(self, plan, name):
+        return [wiring['value'] for wiring in plan['parameters']
+                if wiring['parameter'] == name][0]
+
+    def test_every_stack_is_created(self):
+        plans = self.plans()
+        self.assertEqual(sorted(plans), ['MesosFollower', 'MesosLeader', 'R53PrivateHostedZone', 'VPC'])
+        self.assertTrue(all(plan['action'] == 'create' for plan in plans.itervalues()))
+
+    def test_looked_up_amis_are_shown(self):
+        plans = self.plans()
+        for node, parameter in [('MesosLeader', 'MesosLeaderAMI'),
+                                ('MesosFollower', 'MesosFollowerAMI')]:
+            ami = self.parameter(plans[node], parameter)
+            self.assertTrue(ami.startswith('ami-'))
+            self.assertEqual(plans[node]['detail'], 'AMI {}'.format(ami))
+
+    def test_configured_amis_are_shown(self):
+        plans = self.plans(MesosLeaderAMI='ami-12345678')
+        self.assertEqual(self.parameter(plans['MesosLeader'], 'MesosLeaderAMI'), 'ami-12345678')
+
+
+class LeaderInstanceTest(FakeAWSTestCase):
+
+    def leader_properties(self, **config):
+        self.assertTrue(build_stacks('default', dict(CONFIG, **config)))
+        for stack in self.aws.stacks['us-east-1'].itervalues():
+            if 'MesosLeader' in stack.resources:
+                return stack.resources['MesosLeader']['Properties']
+
+    def test_leader_outside_placement_group_is_not_ebs_optimized(self):
+        # making an existing leader EBS-optimized stops and starts it
+        for placement_group in ('none', 'followers'):
+            self.assertNotIn('EbsOptimized', self.leader_properties(
+                MesosLeaderInstanceType='c3.xlarge', MesosFollowerInstanceType='c3.xlarge',
+                MesosPlacementGroup=placement_group))
+
+
+SPOT_CONFIG = dict(
+    CONFIG,
+    MesosFollowerInstanceTypes='r3.xlarge,r3.2xlarge',
+    MesosFollowerZones='2',
+    MesosFollowerSpotPrice='0.2',
+    MesosFollowerPools='2',
+    NumFollowers='4'
+)
+
+
+class KeepSpotPoolsTest(FakeAWSTestCase):
+
+    def set_prices(self, prices):
+        self.aws.spot_prices = {'us-east-1': [
+            {'instance_type': instance_type, 'availability_zone': zone,
+             'timestamp': timestamp, 'price': price}
+            for (instance_type, zone), price in prices.iteritems()
+            for timestamp in ('2016-03-01T00:00:00.000Z', '2016-03-02T00:00:00.000Z')]}
+
+    def follower_pools(self, config=SPOT_CONFIG, **kwargs):
+        plans = {plan['node']: plan for plan in plan_stacks('default', config, **kwargs)}
+        return plans['MesosFollower']['detail'].split('pools: ')[1]
+
+    def setUp(self):
+        super(KeepSpotPoolsTest, self).setUp()
+        self.set_prices({('r3.xlarge', 'us-east-1a'): 0.05, ('r3.2xlarge', 'us-east-1b'): 0.12,
+                         ('r3.xlarge', 'us-east-1b'): 0.15, ('r3.2xlarge', 'us-east-1a'): 0.38})
+
+    def test_new_stack_chooses_pools(self):
+        self.assertEqual(self.follower_pools(),
+                         '2x r3.xlarge in us-east-1a, 1x r3.2xlarge in us-east-1b')
+
+    def test_deployed_pools_are_kept(self):
+        self.assertTrue(build_stacks('default', SPOT_CONFIG))
+        self.set_prices({('r3.xlarge', 'us-east-1b'): 0.05, ('r3.2xlarge', 'us-east-1a'): 0.12,
+                         ('r3.xlarge', 'us-east-1a'): 0.15, ('r3.2xlarge', 'us-east-1b'): 0.38})
+        self.assertEqual(self.follower_pools(),
+                         '2x r3.xlarge in us-east-1a, 1x r3.2xlarge in us-east-1b')
+        self.assertEqual(self.follower_pools(rechoose_spot_pools=True),
+                         '2x r3.xlarge in us-east-1b, 1x r3.2xlarge in us-east-1a')
+
+    def test_relaunch_keeps_the_follower_template(self):
+        self.assertTrue(build_stacks('default', SPOT_CONFIG))
+        follower = [stack for name, stack in self.aws.stacks['us-east-1'].iteritems()
+                    if name.startswith('MesosFollower')][0]
+        template_body = follower.template_body
+        self.set_prices({('r3.xlarge', 'us-east-1b'): 0.05, ('r3.2xlarge', 'us-east-1a'): 0.12,
+                         ('r3.xlarge', 'us-east-1a'): 0.15, ('r3.2xlarge', 'us-east-1b'): 0.38})
+        self.assertTrue(build_stacks('default', SPOT_CONFIG))
+        self.assertEqual(follower.template_body, template_body)
+
+    def test_kept_pools_share_new_capacity(self):
+        self.assertTrue(build_stacks('default', SPOT_CONFIG))
+        self.assertEqual(self.follower_pools(dict(SPOT_CONFIG, NumFollowers='8')),
+                         '4x r3.xlarge in us-east-1a, 2x r3.2xlarge in us-east-1b')
+
+    def test_pools_of_dropped_types_are_left_out(self):
+        self.assertTrue(build_stacks('default', SPOT_CONFIG))
+        config = dict(SPOT_CONFIG, MesosFollowerInstanceTypes='r3.xlarge,r3.4xlarge')
+        self.assertEqual(self.follower_pools(config), '4x r3.xlarge in us-east-1a')
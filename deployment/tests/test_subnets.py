@@ -0,0 +1,73 @@
+import unittest
+
+from cfn.subnets import plan_subnets, subnet_prefix
+from cfn.template_utils import GTCloudFormationException
+
+
+VPC_CIDR = '10.0.0.0/16'
+
+
+class SubnetPrefixTest(unittest.TestCase):
+
+    def test_room_for_followers_headroom_leader_and_aws(self):
+        # 121 followers and as many again, the leader and AWS fill a /24
+        self.assertEqual(subnet_prefix(121, 1), 24)
+        self.assertEqual(subnet_prefix(122, 1), 23)
+
+    def test_followers_are_shared_between_zones(self):
+        self.assertEqual(subnet_prefix(1000, 2), 22)
+        self.assertEqual(subnet_prefix(900, 4), 23)
+
+    def test_headroom(self):
+        self.assertEqual(subnet_prefix(240, 1, headroom=0), 24)
+        self.assertEqual(subnet_prefix(100, 1, headroom=3), 23)
+
+
+class PlanSubnetsTest(unittest.TestCase):
+
+    def test_keeps_the_24_layout(self):
+        self.assertEqual(plan_subnets(VPC_CIDR, 24, 1, 2), ['10.0.1.0/24'])
+        self.assertEqual(plan_subnets(VPC_CIDR, 24, 3, 2),
+                         ['10.0.1.0/24', '10.0.2.0/24', '10.0.3.0/24'])
+
+    def test_larger_subnets_are_aligned_after_the_first_24(self):
+        self.assertEqual(plan_subnets(VPC_CIDR, 22, 2, 400),
+                         ['10.0.4.0/22', '10.0.8.0/22'])
+        self.assertEqual(plan_subnets(VPC_CIDR, 17, 1, 2), ['10.0.128.0/17'])
+
+    def test_layout_does_not_depend_on_the_followers(self):
+        # a cluster growing within its subnets keeps them where they are
+        for zones in (1, 2, 3):
+            self.assertEqual(plan_subnets(VPC_CIDR, 24, zones, 2),
+                             plan_subnets(VPC_CIDR, 24, zones, 121 * zones))
+
+    def test_too_many_followers_for_the_subnets(self):
+        plan_subnets(VPC_CIDR, 24, 2, 243)
+        with self.assertRaises(GTCloudFormationException) as raised:
+            plan_subnets(VPC_CIDR, 24, 2, 244)
+        self.assertIn('MesosSubnetPrefix of 23 or less', str(raised.exception))
+
+    def test_headroom(self):
+        plan_subnets(VPC_CIDR, 24, 1, 200, headroom=0.2)
+        self.assertRaises(GTCloudFormationException,
+                          plan_subnets, VPC_CIDR, 24, 1, 200, headroom=1.0)
+
+    def test_prefix_bounds(self):
+        self.assertRaises(GTCloudFormationException, plan_subnets, VPC_CIDR, 25, 1, 2)
+        self.assertRaises(GTCloudFormationException, plan_subnets, VPC_CIDR, 16, 1, 2)
+
+    def test_smallest_prefix_fits_after_the_first_24(self):
+        # the largest subnets take the upper half of the VPC
+        self.assertEqual(plan_subnets(VPC_CIDR, 17, 1, 16000), ['10.0.128.0/17'])
+        with self.assertRaises(GTCloudFormationException) as raised:
+            plan_subnets(VPC_CIDR, 17, 1, 17000)
+        self.assertIn('spread them over more zones', str(raised.exception))
+
+    def test_subnets_must_fit_in_the_vpc(self):
+        self.assertRaises(GTCloudFormationException, plan_subnets, VPC_CIDR, 17, 2, 2)
+        self.assertRaises(GTCloudFormationException, plan_subnets, VPC_CIDR, 24, 256, 2)
+        self.assertEqual(len(plan_subnets(VPC_CIDR, 24, 255, 2)), 255)
+
+
+if __name__ == '__main__':
+    unittest.main()
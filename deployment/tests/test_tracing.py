@@ -0,0 +1,66 @@
+import unittest
+
+from cfn.tracing import chrome_trace, graphite_metrics
+
+
+class FakeNode(object):
+    """Stand-in for a StackNode which has been run"""
+
+    state = 'done'
+
+    def __init__(self, name, spans, api_calls=None):
+        self.name = name
+        self.stack_name = '{}-0123456789'.format(name)
+        self.spans = spans
+        self.api_calls = api_calls or {}
+
+    def get_stack_name(self, unique=True):
+        return self.stack_name if unique else self.name
+
+
+class ChromeTraceTest(unittest.TestCase):
+
+    def test_tracks(self):
+        nodes = [FakeNode('VPC', [('wait', 10.0, 10.5), ('create', 10.5, 12.0)],
+                          {'cloudformation': {'CreateStack': 1}}),
+                 FakeNode('Leader', [])]
+        events = chrome_trace(nodes)['traceEvents']
+
+        names = [event for event in events if event['ph'] == 'M']
+        self.assertEqual([(event['tid'], event['args']['name']) for event in names],
+                         [(1, 'VPC'), (2, 'Leader')])
+
+        stack, wait, create = [event for event in events if event['ph'] == 'X']
+        self.assertEqual((stack['name'], stack['ts'], stack['dur']),
+                         ('VPC', 10000000, 2000000))
+        self.assertEqual(stack['args']['api_calls'], {'cloudformation': {'CreateStack': 1}})
+        self.assertEqual((wait['name'], wait['ts'], wait['dur']), ('wait', 10000000, 500000))
+        self.assertEqual((create['name'], create['ts'], create['dur']),
+                         ('create', 10500000, 1500000))
+
+
+class GraphiteMetricsTest(unittest.TestCase):
+
+    def test_metrics(self):
+        nodes = [FakeNode('VPC', [('poll', 0.0, 1.0), ('update', 1.0, 1.5), ('poll', 1.5, 3.0)],
+                          {'cloudformation': {'DescribeStacks': 4}}),
+                 FakeNode('Mesos.Leader', [('render', 2.0, 6.0)]),
+                 FakeNode('Skipped', [])]
+        metrics = dict((path, value) for path, value, timestamp
+                       in graphite_metrics(nodes, 'gt', timestamp=100))
+        self.assertEqual(metrics, {
+            'gt.VPC.poll.seconds': 2.5,
+            'gt.VPC.update.seconds': 0.5,
+            'gt.VPC.api_calls.cloudformation.DescribeStacks': 4,
+            'gt.Mesos_Leader.render.seconds': 4.0,
+            'gt.total.seconds': 6.0
+        })
+
+    def test_timestamp(self):
+        nodes = [FakeNode('VPC', [('poll', 0.0, 1.0)])]
+        self.assertEqual(set(timestamp for _, _, timestamp
+                             in graphite_metrics(nodes, 'gt', timestamp=100.7)), set([100]))
+
+
+if __name__ == '__main__':
+    unittest.main()